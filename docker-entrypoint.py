@@ -105,6 +105,9 @@ KNOWN_COMMANDS = {
 TESTS_EXTRA_ENV = {
     "ZENTRAL_CONF_DIR": "/zentral/tests/conf",
     "ZENTRAL_FORCE_ES_OS_INDEX_REFRESH": "1",
+    "ZENTRAL_INCIDENTS_SYNC": "0",
+    "ZENTRAL_INVENTORY_SYNC": "0",
+    "ZENTRAL_OSQUERY_SYNC": "0",
     "ZENTRAL_PROBES_SYNC": "0",
     "ZENTRAL_QUIET": "1",
     "ZENTRAL_STORES_SYNC": "0",
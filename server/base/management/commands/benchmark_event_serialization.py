@@ -0,0 +1,115 @@
+import random
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from kombu.utils import json
+from zentral.contrib.munki.events import MunkiInstallEvent
+from zentral.contrib.osquery.events import OsqueryResultEvent
+from zentral.contrib.santa.events import SantaEventEvent
+from zentral.core.events.base import EventMetadata, EventRequest
+from zentral.utils.json import orjson
+
+
+def build_osquery_result_event(i):
+    return OsqueryResultEvent(
+        EventMetadata(request=EventRequest(user_agent="osquery/5.10.2", ip="203.0.113.10")),
+        {"name": f"pack/apps/1/installed-apps/{i % 10 + 1}/1/",
+         "action": "snapshot",
+         "hostIdentifier": str(uuid.uuid4()),
+         "calendarTime": "Mon Jan  1 00:00:00 2024 UTC",
+         "unixTime": 1704067200,
+         "epoch": 0,
+         "counter": i,
+         "numerics": False,
+         "decorations": {"serial_number": "0123456789", "hostname": "yolo"},
+         "snapshot": [{"name": f"app {j}",
+                       "bundle_identifier": f"com.example.app{j}",
+                       "bundle_short_version": "1.2.3",
+                       "path": f"/Applications/App {j}.app"}
+                      for j in range(20)]}
+    )
+
+
+def build_santa_event_event(i):
+    return SantaEventEvent(
+        EventMetadata(request=EventRequest(user_agent="santa-ruleset/2024.1", ip="203.0.113.10"),
+                      tags=["santa"]),
+        {"decision": random.choice(["ALLOW_BINARY", "ALLOW_CERTIFICATE", "BLOCK_UNKNOWN"]),
+         "file_name": f"binary{i}",
+         "file_path": "/usr/local/bin",
+         "file_sha256": uuid.uuid4().hex * 2,
+         "executing_user": "yolo",
+         "execution_time": 1704067200.123,
+         "logged_in_users": ["yolo"],
+         "current_sessions": ["yolo@console"],
+         "pid": i,
+         "ppid": 1,
+         "parent_name": "launchd",
+         "signing_chain": [{"cn": f"Developer ID Application: Example {j}",
+                            "org": "Example",
+                            "ou": "0123456789",
+                            "sha256": uuid.uuid4().hex * 2,
+                            "valid_from": 1514764800,
+                            "valid_until": 1893456000}
+                           for j in range(3)]}
+    )
+
+
+def build_munki_install_event(i):
+    return MunkiInstallEvent(
+        EventMetadata(request=EventRequest(user_agent="managedsoftwareupdate/6.3.3", ip="203.0.113.10")),
+        {"type": "install",
+         "name": f"package{i % 50}",
+         "display_name": f"Package {i % 50}",
+         "version": "1.0.0",
+         "status": 0,
+         "applesus": False,
+         "download_kbytes_per_sec": 12345,
+         "duration_seconds": 12,
+         "time": "2024-01-01T00:00:00+00:00",
+         "unattended": True}
+    )
+
+
+class Command(BaseCommand):
+    help = "Benchmark the event serialization used by the queues and the stores."
+    event_builders = (
+        ("osquery", build_osquery_result_event, 6),
+        ("santa", build_santa_event_event, 3),
+        ("munki", build_munki_install_event, 1),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=10000, help="number of events")
+        parser.add_argument("--readers", type=int, default=3,
+                            help="number of encodings of the same event (queue publish + stores)")
+
+    def build_events(self, count):
+        builders = [builder for _, builder, weight in self.event_builders for _ in range(weight)]
+        return [random.choice(builders)(i) for i in range(count)]
+
+    def benchmark(self, label, events, readers, encode):
+        start = time.perf_counter()
+        size = 0
+        for event in events:
+            for _ in range(readers):
+                size += len(encode(event))
+        duration = time.perf_counter() - start
+        self.stdout.write(f"{label:>24}: {duration:8.3f}s {len(events) / duration:10.0f} events/s {size} bytes")
+        return duration
+
+    def handle(self, *args, **kwargs):
+        count = kwargs["events"]
+        readers = kwargs["readers"]
+        mix = ", ".join(f"{weight}×{name}" for name, _, weight in self.event_builders)
+        self.stdout.write(f"{count} events ({mix}), {readers} encoding(s) per event, "
+                          f"orjson {'available' if orjson else 'not available'}")
+        legacy = self.benchmark(
+            "serialize + json.dumps", self.build_events(count), readers,
+            lambda event: json.dumps(event.serialize()).encode("utf-8")
+        )
+        cached = self.benchmark(
+            "serialize_bytes", self.build_events(count), readers,
+            lambda event: event.serialize_bytes()
+        )
+        self.stdout.write(f"speedup: {legacy / cached:.1f}×")
@@ -0,0 +1,142 @@
+import hashlib
+import random
+import threading
+import time
+import boto3
+from django.core.management.base import BaseCommand
+from zentral.core.stores.backends.all import StoreBackend
+from zentral.core.stores.backends.kinesis import KinesisStore
+from zentral.core.stores.models import Store
+from .benchmark_event_serialization import Command as SerializationBenchmarkCommand
+
+
+class KinesisStandIn:
+    """Local stand-in for the Kinesis PutRecords API, with the per shard limits"""
+    max_records_per_second = 1000
+    max_bytes_per_second = 2**20
+
+    def __init__(self, shard_count):
+        self.shard_count = shard_count
+        self.lock = threading.Lock()
+        now = time.monotonic()
+        self.shards = [[now, self.max_records_per_second, self.max_bytes_per_second] for _ in range(shard_count)]
+        self.put_records_calls = 0
+        self.records = 0
+        self.throttled_records = 0
+
+    def _get_shard(self, partition_key):
+        return int(hashlib.md5(partition_key.encode("utf-8")).hexdigest(), 16) % self.shard_count
+
+    def _accept(self, shard_idx, size):
+        shard = self.shards[shard_idx]
+        now = time.monotonic()
+        elapsed = now - shard[0]
+        shard[0] = now
+        shard[1] = min(self.max_records_per_second, shard[1] + elapsed * self.max_records_per_second)
+        shard[2] = min(self.max_bytes_per_second, shard[2] + elapsed * self.max_bytes_per_second)
+        if shard[1] < 1 or shard[2] < size:
+            return False
+        shard[1] -= 1
+        shard[2] -= size
+        return True
+
+    def put_records(self, Records, StreamName):
+        responses = []
+        failed_record_count = 0
+        with self.lock:
+            self.put_records_calls += 1
+            for record in Records:
+                self.records += 1
+                shard_idx = self._get_shard(record["PartitionKey"])
+                if self._accept(shard_idx, len(record["Data"]) + len(record["PartitionKey"])):
+                    responses.append({"SequenceNumber": str(self.records), "ShardId": f"shardId-{shard_idx:012d}"})
+                else:
+                    self.throttled_records += 1
+                    failed_record_count += 1
+                    responses.append({"ErrorCode": "ProvisionedThroughputExceededException",
+                                      "ErrorMessage": "Rate exceeded for shard"})
+        return {"FailedRecordCount": failed_record_count, "Records": responses}
+
+
+class Command(BaseCommand):
+    help = "Benchmark the Kinesis store bulk_store method, with and without the KPL record aggregation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=10000, help="number of events")
+        parser.add_argument("--event-source", default="mix",
+                            choices=["mix"] + [name for name, _, _ in SerializationBenchmarkCommand.event_builders],
+                            help="type of the events")
+        parser.add_argument("--batch-size", type=int, default=KinesisStore.max_batch_size,
+                            help="number of events per bulk_store call")
+        parser.add_argument("--shards", type=int, default=1, help="number of shards of the stand-in")
+        parser.add_argument("--serialization-format", default="zentral",
+                            choices=KinesisStore.serialization_format_choices)
+        parser.add_argument("--endpoint-url",
+                            help="use a local Kinesis compatible endpoint instead of the in-process stand-in")
+        parser.add_argument("--stream", default="zentral-benchmark", help="stream name, with --endpoint-url")
+        parser.add_argument("--region-name", default="us-east-1", help="region name, with --endpoint-url")
+
+    def get_client(self, options):
+        endpoint_url = options["endpoint_url"]
+        if not endpoint_url:
+            return KinesisStandIn(options["shards"])
+        client = boto3.client("kinesis", endpoint_url=endpoint_url, region_name=options["region_name"],
+                              aws_access_key_id="benchmark", aws_secret_access_key="benchmark")
+        stream = options["stream"]
+        if stream not in client.list_streams()["StreamNames"]:
+            client.create_stream(StreamName=stream, ShardCount=options["shards"])
+            client.get_waiter("stream_exists").wait(StreamName=stream)
+        return client
+
+    def get_store(self, options, aggregation):
+        store = KinesisStore(Store(name="Kinesis benchmark", backend=StoreBackend.Kinesis), load=False)
+        store.stream = options["stream"]
+        store.batch_size = options["batch_size"]
+        store.serialization_format = options["serialization_format"]
+        store.aggregation = aggregation
+        store.client = self.get_client(options)
+        store.configured = True
+        return store
+
+    def build_events(self, options):
+        count = options["events"]
+        event_source = options["event_source"]
+        if event_source == "mix":
+            return SerializationBenchmarkCommand().build_events(count)
+        for name, builder, _ in SerializationBenchmarkCommand.event_builders:
+            if name == event_source:
+                return [builder(i) for i in range(count)]
+
+    def benchmark(self, label, options, aggregation):
+        store = self.get_store(options, aggregation)
+        events = self.build_events(options)
+        batch_size = options["batch_size"]
+        bulk_store_calls = 0
+        start = time.perf_counter()
+        while events:
+            # the events not stored are requeued, like in the store workers
+            batch, events = events[:batch_size], events[batch_size:]
+            stored_event_keys = set(store.bulk_store(batch))
+            bulk_store_calls += 1
+            events.extend(event for event in batch
+                          if (str(event.metadata.uuid), event.metadata.index) not in stored_event_keys)
+        duration = time.perf_counter() - start
+        self.stdout.write(f"{label:>12}: {duration:8.3f}s {options['events'] / duration:10.0f} events/s "
+                          f"{bulk_store_calls} bulk_store call(s)")
+        if isinstance(store.client, KinesisStandIn):
+            self.stdout.write(f"{'':>12}  {store.client.put_records_calls} PutRecords call(s), "
+                              f"{store.client.records} record(s), "
+                              f"{store.client.throttled_records} throttled record(s), "
+                              f"final PutRecords count {store.put_records_count}")
+        return duration
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        target = options["endpoint_url"] or f"in-process stand-in, {options['shards']} shard(s)"
+        events = self.build_events(options)
+        average_size = sum(len(event.serialize_bytes()) for event in events) / len(events)
+        self.stdout.write(f"{options['events']} {options['event_source']} events, "
+                          f"{average_size:.0f} bytes on average, batch size {options['batch_size']}, {target}")
+        plain = self.benchmark("records", options, False)
+        aggregated = self.benchmark("aggregated", options, True)
+        self.stdout.write(f"speedup: {plain / aggregated:.1f}×")
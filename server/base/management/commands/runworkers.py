@@ -1,25 +1,46 @@
 import json
 import logging
+import math
 from multiprocessing import Process
 import random
 import time
 import yaml
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from zentral.conf import settings
+from zentral.core.queues import queues
 from zentral.core.queues.workers import get_workers
 
 
 logger = logging.getLogger("zentral.server.base.management.commands.runworkers")
 
 
+def parse_replicas(replicas):
+    """Parse the "worker name=count" replica specifications"""
+    parsed_replicas = {}
+    for replica in replicas:
+        worker_name, _, count = replica.rpartition("=")
+        worker_name = worker_name.strip()
+        try:
+            count = int(count)
+        except ValueError:
+            count = 0
+        if not worker_name or count < 1:
+            raise CommandError(f"Invalid replicas specification: '{replica}'")
+        parsed_replicas[worker_name] = count
+    return parsed_replicas
+
+
 class Command(BaseCommand):
     help = 'Run Zentral workers.'
     RESTART_DELAY = (10, 20)  # range for the restart delay in seconds
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.workers = {}
         self.processes = {}
         self.prometheus_targets = {}
         self.processes_to_restart = {}
+        self.last_autoscaling = None
 
     def add_arguments(self, parser):
         parser.add_argument('--list-workers', action='store_true', dest='list_workers', default=False,
@@ -27,10 +48,23 @@ class Command(BaseCommand):
         parser.add_argument('--json', action='store_true', dest='json_output', default=False,
                             help='output workers list in json format')
 
+        # replicas
+        parser.add_argument("--replicas", action="append", default=[],
+                            help='number of processes for a worker, e.g. "enrich worker=4"')
+
+        # autoscaling
+        parser.add_argument("--autoscaling", action="store_true",
+                            help="adjust the number of replicas from the queue depths")
+        parser.add_argument("--autoscaling-max-replicas", type=int)
+        parser.add_argument("--autoscaling-messages-per-replica", type=int)
+        parser.add_argument("--autoscaling-interval", type=int)
+
         # prometheus metrics exporter
         parser.add_argument("--prometheus", action="store_true")
         parser.add_argument("--prometheus-sd-file")
         parser.add_argument("--prometheus-base-port", type=int, default=9900)
+        parser.add_argument("--prometheus-replica-port-offset", type=int, default=100,
+                            help="port offset between the replicas of a worker")
         parser.add_argument("--external-hostname", default="localhost")
 
         # statsd metrics exporter
@@ -41,12 +75,16 @@ class Command(BaseCommand):
 
         parser.add_argument("worker", nargs="*")
 
-    def start_worker(self, idx, worker):
-        logger.info("Starting worker '%s'", worker.name)
+    def get_prometheus_port(self, idx, replica):
+        # stable port for each worker replica
+        return self.prometheus_base_port + idx + replica * self.prometheus_replica_port_offset
+
+    def start_worker(self, idx, worker, replica=0):
+        logger.info("Starting worker '%s' replica %s", worker.name, replica)
         metrics_exporter = None
         if self.prometheus:
             from zentral.utils.prometheus import PrometheusMetricsExporter
-            prometheus_port = self.prometheus_base_port + idx
+            prometheus_port = self.get_prometheus_port(idx, replica)
             metrics_exporter = PrometheusMetricsExporter(prometheus_port, worker=worker.name)
         elif self.statsd:
             from zentral.utils.statsd import StatsdMetricsExporter
@@ -56,23 +94,78 @@ class Command(BaseCommand):
                     name=worker.name)
         p.daemon = 1
         p.start()
-        self.processes[idx] = (worker, p)
+        self.processes[(idx, replica)] = (worker, p)
         if self.prometheus:
-            self.prometheus_targets[idx] = {
+            self.prometheus_targets[(idx, replica)] = {
                 "targets": ["{}:{}".format(self.external_hostname, prometheus_port)],
-                "labels": {"job": worker.name}
+                "labels": {"job": worker.name, "replica": str(replica)}
             }
 
+    def stop_worker(self, idx, replica):
+        worker, p = self.processes.pop((idx, replica))
+        self.processes_to_restart.pop((idx, replica), None)
+        self.prometheus_targets.pop((idx, replica), None)
+        logger.info("Stopping worker '%s' replica %s", worker.name, replica)
+        try:
+            p.terminate()
+            p.join(10)
+            p.close()
+        except ValueError:
+            logger.error("The worker '%s' replica %s is still running.", worker.name, replica)
+
+    def get_replica_count(self, idx):
+        return len([r for i, r in self.processes if i == idx])
+
     def write_prometheus_sd_file(self):
         if self.prometheus_sd_file:
             with open(self.prometheus_sd_file, "w") as f:
                 yaml.dump(list(self.prometheus_targets.values()), f, allow_unicode=True)
 
+    # autoscaling
+
+    def get_desired_replica_count(self, idx, worker):
+        min_replicas = self.replicas.get(worker.name, 1)
+        max_replicas = max(min_replicas, self.autoscaling_max_replicas)
+        try:
+            queue_depth = queues.get_worker_queue_depth(worker)
+        except Exception:
+            logger.exception("Could not get the worker '%s' queue depth", worker.name)
+            queue_depth = None
+        current_replicas = self.get_replica_count(idx)
+        if queue_depth is None:
+            return current_replicas
+        desired_replicas = math.ceil(queue_depth / self.autoscaling_messages_per_replica)
+        if desired_replicas < current_replicas:
+            # scale down progressively
+            desired_replicas = current_replicas - 1
+        return min(max(desired_replicas, min_replicas), max_replicas)
+
+    def autoscale_workers(self):
+        if not self.autoscaling:
+            return
+        if self.last_autoscaling and time.monotonic() - self.last_autoscaling < self.autoscaling_interval:
+            return
+        self.last_autoscaling = time.monotonic()
+        updated = False
+        for idx, worker in self.workers.items():
+            current_replicas = self.get_replica_count(idx)
+            desired_replicas = self.get_desired_replica_count(idx, worker)
+            if desired_replicas == current_replicas:
+                continue
+            logger.info("Scaling worker '%s' from %s to %s replicas", worker.name, current_replicas, desired_replicas)
+            for replica in range(current_replicas, desired_replicas):
+                self.start_worker(idx, worker, replica)
+            for replica in range(current_replicas - 1, desired_replicas - 1, -1):
+                self.stop_worker(idx, replica)
+            updated = True
+        if updated and self.prometheus:
+            self.write_prometheus_sd_file()
+
     def watch_workers(self):
         while True:
             time.sleep(random.uniform(1, 3))
-            for idx, (worker, p) in self.processes.items():
-                if idx in self.processes_to_restart:
+            for (idx, replica), (worker, p) in self.processes.items():
+                if (idx, replica) in self.processes_to_restart:
                     continue
                 if not p.is_alive() or (p.exitcode is not None and p.exitcode < 0):
                     proc_is_dead = True
@@ -88,24 +181,45 @@ class Command(BaseCommand):
                         proc_is_dead = False
                     if proc_is_dead:
                         delay = random.uniform(*self.RESTART_DELAY)
-                        logger.error("Worker '%s' is dead. Exit code %s. Restarting in %ss",
-                                     worker.name,  -1 * p_exitcode, int(delay))
-                        self.processes_to_restart[idx] = (time.time() + delay, worker)
+                        logger.error("Worker '%s' replica %s is dead. Exit code %s. Restarting in %ss",
+                                     worker.name, replica, -1 * p_exitcode, int(delay))
+                        self.processes_to_restart[(idx, replica)] = (time.time() + delay, worker)
                 else:
-                    logger.debug("Worker '%s' OK", worker.name)
-            for idx, (deadline, worker) in list(self.processes_to_restart.items()):
+                    logger.debug("Worker '%s' replica %s OK", worker.name, replica)
+            for (idx, replica), (deadline, worker) in list(self.processes_to_restart.items()):
                 if deadline < time.time():
-                    self.start_worker(idx, worker)
-                    self.processes_to_restart.pop(idx)
+                    self.start_worker(idx, worker, replica)
+                    self.processes_to_restart.pop((idx, replica))
+            self.autoscale_workers()
 
     def handle(self, *args, **options):
         list_workers = options['list_workers']
         json_output = options['json_output']
+        workers_config = settings.get("workers", {})
+
+        # replicas
+        self.replicas = parse_replicas(f"{worker_name}={count}"
+                                       for worker_name, count in workers_config.get("replicas", {}).items())
+        self.replicas.update(parse_replicas(options['replicas']))
+
+        # autoscaling
+        autoscaling_config = workers_config.get("autoscaling", {})
+        self.autoscaling = options['autoscaling'] or autoscaling_config.get("enabled", False)
+        for key, default in (("max_replicas", 4),
+                             ("messages_per_replica", 1000),
+                             ("interval", 30)):
+            value = options[f"autoscaling_{key}"]
+            if value is None:
+                value = autoscaling_config.get(key, default)
+            if int(value) < 1:
+                raise CommandError(f"Invalid autoscaling {key.replace('_', ' ')}")
+            setattr(self, f"autoscaling_{key}", int(value))
 
         # prometheus metrics exporter
         self.prometheus = options['prometheus']
         self.prometheus_sd_file = None if list_workers else options.get('prometheus_sd_file')
         self.prometheus_base_port = options['prometheus_base_port']
+        self.prometheus_replica_port_offset = options['prometheus_replica_port_offset']
         self.external_hostname = options['external_hostname']
 
         # statsd metrics exporter
@@ -122,7 +236,11 @@ class Command(BaseCommand):
                 continue
             elif workers and worker.name not in workers:
                 continue
-            self.start_worker(idx, worker)
+            if self.prometheus and idx >= self.prometheus_replica_port_offset:
+                raise CommandError("The prometheus replica port offset must be greater than the number of workers")
+            self.workers[idx] = worker
+            for replica in range(self.replicas.get(worker.name, 1)):
+                self.start_worker(idx, worker, replica)
         if list_workers:
             if json_output:
                 self.stdout.write(json.dumps({"workers": all_workers}))
@@ -11,6 +11,30 @@ import redis
 logger = logging.getLogger("server.base.notifier")
 
 
+def build_redis_kwargs(config, decode_responses=True):
+    config = config or {}
+    url = config.get("url")
+    if not url:
+        url = "redis://redis:6379/15"
+    parsed_url = urlparse(url)
+    if parsed_url.path:
+        try:
+            db = int(parsed_url.path.lstrip("/"))
+        except Exception:
+            raise ValueError("Could not parse path")
+    else:
+        db = 0
+    return {
+        "host": parsed_url.hostname,
+        "port": parsed_url.port,
+        "db": db,
+        "ssl": parsed_url.scheme in ("rediss", "valkeys"),
+        "username": config.get("username"),
+        "password": config.get("password"),
+        "decode_responses": decode_responses,
+    }
+
+
 class Notifier:
     _reconnection_delay_range = (1.0, 3.0)
 
@@ -24,27 +48,7 @@ class Notifier:
         self._build_kwargs(config)
 
     def _build_kwargs(self, config):
-        config = config or {}
-        url = config.get("url")
-        if not url:
-            url = "redis://redis:6379/15"
-        parsed_url = urlparse(url)
-        if parsed_url.path:
-            try:
-                db = int(parsed_url.path.lstrip("/"))
-            except Exception:
-                raise ValueError("Could not parse path")
-        else:
-            db = 0
-        self._kwargs = {
-            "host": parsed_url.hostname,
-            "port": parsed_url.port,
-            "db": db,
-            "ssl": parsed_url.scheme in ("rediss", "valkeys"),
-            "username": config.get("username"),
-            "password": config.get("password"),
-            "decode_responses": True,
-        }
+        self._kwargs = build_redis_kwargs(config)
 
     def _get_client(self):
         if self._client is None:
@@ -318,3 +318,63 @@ class EventFilterSetTestCase(SimpleTestCase):
                 ],
             }).match_serialized_event(event.serialize())
         )
+
+    # compiled filter set
+
+    def get_filter_set_mapping(self):
+        return {
+            "included_event_filters": [
+                {"event_type": ["zentral_login"], "routing_key": ["yolo", "fomo"]},
+                {"tags": ["jomo"]},
+                {"event_type": ["enrollment_secret_verification"]},
+            ],
+            "excluded_event_filters": [
+                {"routing_key": ["yili"]},
+                {"tags": ["zentral"], "routing_key": ["fomo"]},
+            ],
+        }
+
+    def test_compiled_match_same_as_uncompiled(self):
+        filter_set = EventFilterSet.from_mapping(self.get_filter_set_mapping())
+        compiled_filter_set = EventFilterSet.from_mapping(self.get_filter_set_mapping())
+        compiled_filter_set.compile()
+        self.assertTrue(compiled_filter_set.compiled)
+        for routing_key in (None, "yolo", "fomo", "yili", "jomo"):
+            for event_with_tags in (True, False):
+                event = self.make_event(routing_key=routing_key, event_with_tags=event_with_tags)
+                serialized_event = event.serialize()
+                for _ in range(2):  # second time from the compiled decisions
+                    self.assertEqual(compiled_filter_set.match_serialized_event(serialized_event),
+                                     filter_set.match_serialized_event(serialized_event))
+
+    def test_filter_batch(self):
+        filter_set = EventFilterSet.from_mapping(self.get_filter_set_mapping())
+        self.assertFalse(filter_set.compiled)
+        serialized_events = [self.make_event(routing_key=routing_key).serialize()
+                             for routing_key in ("yolo", "fomo", "yili", None, "yolo")]
+        self.assertEqual(filter_set.filter_batch(serialized_events),
+                         [serialized_events[0], serialized_events[4]])
+        self.assertTrue(filter_set.compiled)
+        self.assertEqual(filter_set.get_drop_counters(),
+                         {"excluded_event_filters.0": 1,
+                          "excluded_event_filters.1": 1,
+                          "included_event_filters": 1})
+
+    def test_filter_batch_empty_set(self):
+        filter_set = EventFilterSet.from_mapping({})
+        serialized_events = [self.make_event().serialize()]
+        self.assertEqual(filter_set.filter_batch(iter(serialized_events)), serialized_events)
+        self.assertEqual(filter_set.get_drop_counters(), {})
+
+    def test_filter_batch_invalid_event(self):
+        filter_set = EventFilterSet.from_mapping(self.get_filter_set_mapping())
+        with self.assertRaises(ValueError) as cm:
+            filter_set.filter_batch([{"un": 1}])
+        self.assertEqual(cm.exception.args[0], "Invalid serialized event")
+
+    def test_compiled_decisions_bounded(self):
+        filter_set = EventFilterSet.from_mapping(self.get_filter_set_mapping())
+        filter_set.max_compiled_decisions = 2
+        filter_set.filter_batch([self.make_event(routing_key=str(i)).serialize() for i in range(5)])
+        self.assertEqual(len(filter_set._compiled_decisions), 1)
+        self.assertEqual(filter_set.get_drop_counters(), {"included_event_filters": 5})
@@ -1,5 +1,6 @@
 from django.core.cache import cache
 from django.test import TestCase, override_settings
+from kombu.utils import json
 from zentral.contrib.inventory.models import MachineSnapshotCommit
 from zentral.core.events.base import EventMetadata, EventRequest, BaseEvent, register_event_type
 
@@ -109,3 +110,21 @@ class EventSerializationTestCase(TestCase):
         self.assertEqual(d["_zentral"]["routing_key"], "yolo123")
         event2 = TestEvent3.deserialize(d)
         self.assertEqual(event2.metadata.routing_key, "yolo123")
+
+    def test_event_serialize_bytes(self):
+        event = make_event(with_msn=False)
+        data = event.serialize_bytes(machine_metadata=False)
+        self.assertEqual(json.loads(data), event.serialize(machine_metadata=False))
+        # cached
+        self.assertIs(event.serialize_bytes(machine_metadata=False), data)
+        self.assertIsNot(event.serialize_bytes(machine_metadata=True), data)
+
+    def test_event_serialize_bytes_cleared_on_metadata_update(self):
+        event = make_event(with_msn=False)
+        data = event.serialize_bytes()
+        event.metadata.add_objects({"yolo": [(1,)]})
+        data2 = event.serialize_bytes()
+        self.assertIsNot(data2, data)
+        self.assertEqual(json.loads(data2)["_zentral"]["objects"], {"yolo": ["1"]})
+        event.clear_serialized_bytes()
+        self.assertIsNot(event.serialize_bytes(), data2)
@@ -0,0 +1,80 @@
+import json
+from unittest.mock import patch
+from django.test import SimpleTestCase
+from zentral.core.incidents.cache import IncidentStateCache
+
+
+class IncidentStateCacheTestCase(SimpleTestCase):
+    key = {"yolo": "fomo"}
+
+    def test_disabled(self):
+        cache = IncidentStateCache()
+        cache.set_incident_state("yolo", self.key, (1, 100, "OPEN"), 0)
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (False, None))
+        self.assertEqual(cache.get_machine_incident_status("yolo", self.key, "12345678"), (False, None))
+
+    @patch("zentral.core.incidents.cache.notifier")
+    def test_set_get(self, notifier):
+        cache = IncidentStateCache(with_sync=True)
+        cache.set_incident_state("yolo", self.key, None, 0)
+        cache.set_machine_incident_status("yolo", self.key, "12345678", "OPEN", 0)
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (True, None))
+        self.assertEqual(cache.get_machine_incident_status("yolo", self.key, "12345678"), (True, "OPEN"))
+        self.assertEqual(cache.get_machine_incident_status("yolo", self.key, "87654321"), (False, None))
+        self.assertEqual(cache.get_incident_state("yolo", {"yolo": "other"}), (False, None))
+        notifier.add_callback.assert_called_once()
+
+    @patch("zentral.core.incidents.cache.notifier")
+    def test_other_incident_machine_statuses_reset(self, notifier):
+        cache = IncidentStateCache(with_sync=True)
+        cache.set_incident_state("yolo", self.key, (1, 100, "OPEN"), 0)
+        cache.set_machine_incident_status("yolo", self.key, "12345678", "OPEN", 0)
+        # same incident
+        cache.set_incident_state("yolo", self.key, (1, 200, "OPEN"), 0)
+        self.assertEqual(cache.get_machine_incident_status("yolo", self.key, "12345678"), (True, "OPEN"))
+        # other incident
+        cache.set_incident_state("yolo", self.key, (2, 200, "OPEN"), 0)
+        self.assertEqual(cache.get_machine_incident_status("yolo", self.key, "12345678"), (False, None))
+
+    @patch("zentral.core.incidents.cache.time.monotonic")
+    @patch("zentral.core.incidents.cache.notifier")
+    def test_ttl(self, notifier, monotonic):
+        monotonic.return_value = 100
+        cache = IncidentStateCache(ttl=10, with_sync=True)
+        cache.set_incident_state("yolo", self.key, None, 0)
+        monotonic.return_value = 109
+        cache.set_machine_incident_status("yolo", self.key, "12345678", None, 0)
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (True, None))
+        monotonic.return_value = 110
+        # expiry not extended by the machine incident status update
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (False, None))
+        self.assertEqual(cache.get_machine_incident_status("yolo", self.key, "12345678"), (False, None))
+
+    @patch("zentral.core.incidents.cache.notifier")
+    def test_invalidated_during_fetch(self, notifier):
+        cache = IncidentStateCache(with_sync=True)
+        generation = cache.get_generation()
+        cache.invalidate("yolo", {"other": "key"})
+        cache.set_incident_state("yolo", self.key, None, generation)
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (False, None))
+
+    @patch("zentral.core.incidents.cache.notifier")
+    def test_notifications(self, notifier):
+        cache = IncidentStateCache(with_sync=True)
+        cache.set_incident_state("yolo", self.key, None, 0)
+        cache.set_incident_state("fomo", self.key, None, 0)
+        cache.notify("yolo", self.key)
+        data = notifier.send_notification.call_args.args[1]
+        self.assertEqual(json.loads(data)["key"], cache.get_cache_key("yolo", self.key))
+        # own notification, ignored
+        cache._notification_handler(data)
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (True, None))
+        # other process notification
+        other_cache = IncidentStateCache(with_sync=True)
+        other_cache.notify("yolo", self.key)
+        cache._notification_handler(notifier.send_notification.call_args.args[1])
+        self.assertEqual(cache.get_incident_state("yolo", self.key), (False, None))
+        self.assertEqual(cache.get_incident_state("fomo", self.key), (True, None))
+        # invalid notification, everything is cleared
+        cache._notification_handler("yolo")
+        self.assertEqual(cache.get_incident_state("fomo", self.key), (False, None))
@@ -1,13 +1,17 @@
 from datetime import datetime
+from unittest.mock import call, patch, Mock
+from django.db import OperationalError
 from django.http import HttpRequest
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 from zentral.core.events.base import BaseEvent, EventMetadata
+from zentral.core.incidents.cache import IncidentStateCache
 from zentral.core.incidents.events import (IncidentCreatedEvent, IncidentSeverityUpdatedEvent,
                                            IncidentStatusUpdatedEvent, MachineIncidentCreatedEvent,
                                            MachineIncidentStatusUpdatedEvent)
 from zentral.core.incidents.models import Incident, IncidentUpdate, MachineIncident, Severity, Status
-from zentral.core.incidents.utils import apply_incident_updates, update_incident_status, update_machine_incident_status
+from zentral.core.incidents.utils import (_select_for_update, apply_incident_updates,
+                                          update_incident_status, update_machine_incident_status)
 
 
 class TestEvent(BaseEvent):
@@ -565,3 +569,130 @@ class IncidentTestCase(TestCase):
             {"incident": [(incident.pk,)],
              "machine_incident": [(machine_incident.pk,)]}
         )
+
+
+class IncidentStateCacheUtilsTestCase(TestCase):
+    def setUp(self):
+        self.cache = IncidentStateCache(with_sync=True)
+        cache_patcher = patch("zentral.core.incidents.utils.incident_state_cache", self.cache)
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+        notifier_patcher = patch("zentral.core.incidents.cache.notifier")
+        self.notifier = notifier_patcher.start()
+        self.addCleanup(notifier_patcher.stop)
+
+    def _create_event(self, severity=Severity.CRITICAL, serial_number="12345678", incident_type=None, key=None):
+        incident_type = incident_type or get_random_string(12)
+        key = key or {"key": get_random_string(12)}
+        incident_update = IncidentUpdate(incident_type, key, severity)
+        return TestEvent(
+            EventMetadata(
+                machine_serial_number=serial_number,
+                incident_updates=[incident_update],
+            ), {}
+        ), incident_type, key
+
+    def test_open_machine_incident_cached_noop(self):
+        original_event, incident_type, key = self._create_event()
+        with self.captureOnCommitCallbacks(execute=True):
+            events = apply_incident_updates(original_event)
+        self.assertEqual(len(events), 2)
+        self.notifier.send_notification.assert_called()
+        incident = Incident.objects.get(incident_type=incident_type, key=key)
+        self.assertEqual(self.cache.get_incident_state(incident_type, key),
+                         (True, (incident.pk, Severity.CRITICAL.value, Status.OPEN.value)))
+        self.assertEqual(self.cache.get_machine_incident_status(incident_type, key, "12345678"),
+                         (True, Status.OPEN.value))
+        # same update, answered from the cache, without queries
+        original_event, _, _ = self._create_event(incident_type=incident_type, key=key)
+        with self.assertNumQueries(2):  # savepoint & release
+            self.assertEqual(apply_incident_updates(original_event), [])
+        self.assertEqual(self.cache.get_counters(), {"applied": 1, "cached": 1})
+
+    def test_open_other_machine_incident_cached_incident(self):
+        original_event, incident_type, key = self._create_event()
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_incident_updates(original_event)
+        # other machine, the cached open incident is not locked
+        original_event, _, _ = self._create_event(incident_type=incident_type, key=key, serial_number="87654321")
+        with self.captureOnCommitCallbacks(execute=True):
+            events = apply_incident_updates(original_event)
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], MachineIncidentCreatedEvent)
+        self.assertEqual(
+            MachineIncident.objects.filter(incident__incident_type=incident_type, incident__key=key).count(),
+            2
+        )
+        # stale cached severity, the incident is fetched from the DB
+        original_event, _, _ = self._create_event(incident_type=incident_type, key=key,
+                                                  severity=Severity.CRITICAL)
+        incident = Incident.objects.get(incident_type=incident_type, key=key)
+        self.cache.set_incident_state(incident_type, key, (incident.pk, Severity.MAJOR.value, Status.OPEN.value),
+                                      self.cache.get_generation())
+        with self.captureOnCommitCallbacks(execute=True):
+            events = apply_incident_updates(original_event)
+        self.assertEqual(len(events), 0)  # CRITICAL already in the DB
+        self.assertEqual(self.cache.get_incident_state(incident_type, key)[1][1], Severity.CRITICAL.value)
+
+    def test_open_machine_incident_cached_incident_closed(self):
+        original_event, incident_type, key = self._create_event()
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_incident_updates(original_event)
+        incident = Incident.objects.get(incident_type=incident_type, key=key)
+        # closed by another process, the cached state is stale
+        Incident.objects.filter(pk=incident.pk).update(status=Status.CLOSED.value)
+        MachineIncident.objects.filter(incident=incident).update(status=Status.CLOSED.value)
+        self.assertEqual(self.cache.get_incident_state(incident_type, key)[1][0], incident.pk)
+        original_event, _, _ = self._create_event(incident_type=incident_type, key=key, serial_number="87654321")
+        with self.captureOnCommitCallbacks(execute=True):
+            events = apply_incident_updates(original_event)
+        self.assertEqual(len(events), 2)
+        self.assertIsInstance(events[0], IncidentCreatedEvent)
+        self.assertIsInstance(events[1], MachineIncidentCreatedEvent)
+        new_incident = Incident.objects.get(incident_type=incident_type, key=key, status=Status.OPEN.value)
+        self.assertNotEqual(new_incident.pk, incident.pk)
+        self.assertEqual(new_incident.machineincident_set.get().serial_number, "87654321")
+        self.assertEqual(self.cache.get_incident_state(incident_type, key)[1][0], new_incident.pk)
+        # the machine incident statuses of the closed incident are not cached anymore
+        self.assertEqual(self.cache.get_machine_incident_status(incident_type, key, "12345678"), (False, None))
+
+    def test_close_machine_incident_cached_noop(self):
+        original_event, incident_type, key = self._create_event(severity=Severity.NONE)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(apply_incident_updates(original_event), [])
+        self.assertEqual(self.cache.get_machine_incident_status(incident_type, key, "12345678"), (True, None))
+        self.notifier.send_notification.assert_not_called()
+        original_event, _, _ = self._create_event(incident_type=incident_type, key=key, severity=Severity.NONE)
+        with self.assertNumQueries(2):  # savepoint & release
+            self.assertEqual(apply_incident_updates(original_event), [])
+        self.assertEqual(self.cache.get_counters(), {"applied": 1, "cached": 1})
+
+    def test_open_close_machine_incident(self):
+        original_event, incident_type, key = self._create_event()
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_incident_updates(original_event)
+        original_event, _, _ = self._create_event(incident_type=incident_type, key=key, severity=Severity.NONE)
+        with self.captureOnCommitCallbacks(execute=True):
+            events = apply_incident_updates(original_event)
+        self.assertEqual(len(events), 2)
+        self.assertEqual(self.cache.get_incident_state(incident_type, key), (True, None))
+        self.assertEqual(self.cache.get_machine_incident_status(incident_type, key, "12345678"), (True, None))
+
+    def test_manual_update_invalidation(self):
+        original_event, incident_type, key = self._create_event(serial_number=None)
+        with self.captureOnCommitCallbacks(execute=True):
+            events = apply_incident_updates(original_event)
+        incident = Incident.objects.get(pk=events[0].payload["pk"])
+        self.assertTrue(self.cache.get_incident_state(incident_type, key)[0])
+        request = HttpRequest()
+        request.user = None
+        with self.captureOnCommitCallbacks(execute=True):
+            update_incident_status(incident, Status.IN_PROGRESS, request)
+        self.assertEqual(self.cache.get_incident_state(incident_type, key), (False, None))
+
+    def test_lock_contention(self):
+        queryset = Mock()
+        queryset.select_for_update.return_value.get.side_effect = [OperationalError("could not obtain lock"), 17]
+        self.assertEqual(_select_for_update(queryset, pk=1), 17)
+        self.assertEqual(queryset.select_for_update.call_args_list, [call(nowait=True), call()])
+        self.assertEqual(self.cache.get_counters(), {"lock_contention": 1})
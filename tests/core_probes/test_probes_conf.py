@@ -1,8 +1,9 @@
 from django.test import TestCase
 from django.utils.crypto import get_random_string
-from zentral.core.probes.conf import all_probes, all_probes_dict
+from zentral.core.probes.conf import all_probes, all_probes_dict, ProbeIndex, ProbeList
 from zentral.core.probes.models import ProbeSource
 from zentral.core.probes.probe import Probe
+from .test_probe import _build_event
 
 
 class ProbesConfTestCase(TestCase):
@@ -26,3 +27,52 @@ class ProbesConfTestCase(TestCase):
         self.assertEqual(all_probes_dict[self.probe.pk], self.probe)
         with self.assertRaises(KeyError):
             all_probes_dict[self.inactive_probe.pk]
+
+
+class ProbeIndexTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        def create_probe(prefix, body):
+            return Probe(ProbeSource.objects.create(name=prefix + get_random_string(12),
+                                                    status=ProbeSource.ACTIVE,
+                                                    body=body))
+        cls.event_type_probe = create_probe("a", {"filters": {"metadata": [{"event_types": ["zentral_login"]}]}})
+        cls.tag_probe = create_probe("b", {"filters": {"metadata": [{"event_tags": ["zentral"]}]}})
+        cls.routing_key_probe = create_probe("c", {"filters": {"metadata": [{"event_routing_keys": ["yolo"]}]}})
+        cls.payload_probe = create_probe("d", {"filters": {"payload": [[{"attribute": "user.username",
+                                                                         "operator": "IN",
+                                                                         "values": ["fomo"]}]]}})
+        cls.error_probe = create_probe("e", {"filters": {"metadata": [{}]}})
+
+    def setUp(self):
+        self.probe_list = ProbeList()
+
+    def test_index_buckets(self):
+        index = ProbeIndex(list(self.probe_list))
+        self.assertEqual(index.probe_count, 4)  # error probe not loaded
+        self.assertEqual(index.wildcard, [(3, self.payload_probe)])
+        self.assertEqual(index.event_types, {"zentral_login": [(0, self.event_type_probe)]})
+        self.assertEqual(index.event_tags, {"zentral": [(1, self.tag_probe)]})
+        self.assertEqual(index.routing_keys, {"yolo": [(2, self.routing_key_probe)]})
+
+    def test_event_filtered(self):
+        event = _build_event("zentral_login", tags=["zentral"], payload={"user": {"username": "fomo"}})
+        self.assertEqual(self.probe_list.event_filtered(event),
+                         [self.event_type_probe, self.tag_probe, self.payload_probe])
+        event = _build_event("zentral_logout", tags=["zentral"], payload={"user": {"username": "fomo"}})
+        event.metadata.routing_key = "yolo"
+        self.assertEqual(self.probe_list.event_filtered(event),
+                         [self.tag_probe, self.routing_key_probe, self.payload_probe])
+        event = _build_event("zentral_logout")
+        self.assertEqual(self.probe_list.event_filtered(event), [])
+        self.assertEqual(self.probe_list.get_index_stats(),
+                         {"events": 3, "candidates": 7, "hits": 6, "probes": 4})
+
+    def test_clear_rebuilds_index(self):
+        event = _build_event("zentral_login")
+        self.assertEqual(self.probe_list.event_filtered(event), [self.event_type_probe])
+        self.event_type_probe.source.status = ProbeSource.INACTIVE
+        self.event_type_probe.source.save()
+        self.assertEqual(self.probe_list.event_filtered(event), [self.event_type_probe])
+        self.probe_list.clear()
+        self.assertEqual(self.probe_list.event_filtered(event), [])
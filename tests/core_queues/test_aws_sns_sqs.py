@@ -241,6 +241,26 @@ class AWSSNSSQSQueuesTestCase(TestCase):
                 "arn:fomo",
             )
 
+    def test_get_worker_queue_depth(self):
+        client = boto3.client(
+            "sqs", region_name="eu-central-1",
+            aws_access_key_id="a", aws_secret_access_key="b"
+        )
+        stub = Stubber(client)
+        stub.add_response(
+            "get_queue_attributes",
+            {"Attributes": {"ApproximateNumberOfMessages": "42"}},
+            {"QueueUrl": "https://www.example.com/fomo",
+             "AttributeNames": ["ApproximateNumberOfMessages"]},
+        )
+        stub.activate()
+        with patch("zentral.core.queues.backends.aws_sns_sqs.boto3.client", return_value=client):
+            eq = self.get_queues()
+            self.assertEqual(eq.get_worker_queue_depth(Mock(queue_url="https://www.example.com/fomo")), 42)
+            self.assertIsNone(eq.get_worker_queue_depth(Mock(queue_url=None)))
+        # the shared client is not used
+        self.assertNotIn("sqs_client", eq.__dict__)
+
     @patch("zentral.core.queues.backends.aws_sns_sqs.EventQueues.get_queue_arn")
     def test_setup_queue_subscription(self, get_queue_arn):
         get_queue_arn.return_value = "arn:queue"
@@ -0,0 +1,462 @@
+from unittest.mock import Mock, patch
+import uuid
+from django.test import SimpleTestCase
+from kombu import Producer
+from zentral.core.queues.backends.kombu import (BatchEnrichWorker, BatchProcessWorker, BulkStoreWorker,
+                                                EnrichWorker, EventQueues, MultiplexedStoreWorker,
+                                                ProcessWorker, StoreWorker, enrich_events_queue,
+                                                enriched_events_exchange, get_store_events_queue)
+
+
+def build_event_d(event_type="zentral_login", index=0):
+    return {"_zentral": {"id": str(uuid.uuid4()), "index": index, "type": event_type}}
+
+
+def build_message(delivery_tag):
+    message = Mock(name=f"message {delivery_tag}")
+    message.delivery_tag = delivery_tag
+    return message
+
+
+class KombuQueuesTestCase(SimpleTestCase):
+    @staticmethod
+    def get_queues(**kwargs):
+        config_d = {"backend_url": "memory://"}
+        config_d.update(kwargs)
+        return EventQueues(config_d)
+
+    @staticmethod
+    def get_event_store(batch_size=1, included=True, bulk_store=None):
+        event_store = Mock()
+        event_store.name = "yolo"
+        event_store.batch_size = batch_size
+        event_store.worker_batch_size = batch_size
+        event_store.max_batch_age_seconds = 17
+        event_store.is_serialized_event_included.return_value = included
+        event_store.filter_batch.side_effect = lambda events: list(events) if included else []
+        if bulk_store:
+            event_store.bulk_store.side_effect = bulk_store
+        return event_store
+
+    # worker selection
+
+    def test_default_workers(self):
+        eq = self.get_queues()
+        self.assertIsInstance(eq.get_enrich_worker(Mock()), EnrichWorker)
+        self.assertNotIsInstance(eq.get_enrich_worker(Mock()), BatchEnrichWorker)
+        self.assertNotIsInstance(eq.get_process_worker(Mock()), BatchProcessWorker)
+        self.assertNotIsInstance(eq.get_store_worker(self.get_event_store()), BulkStoreWorker)
+
+    def test_batch_workers(self):
+        eq = self.get_queues(batch_size=50, max_batch_age_seconds=2, requeue_delay_seconds=3)
+        worker = eq.get_enrich_worker(Mock())
+        self.assertIsInstance(worker, BatchEnrichWorker)
+        self.assertEqual(worker.batch_size, 50)
+        self.assertEqual(worker.max_batch_age_seconds, 2)
+        self.assertEqual(worker.requeue_delay_seconds, 3)
+        self.assertIsInstance(eq.get_process_worker(Mock()), ProcessWorker)
+        self.assertIsInstance(eq.get_process_worker(Mock()), BatchProcessWorker)
+        self.assertIsInstance(eq.get_store_worker(self.get_event_store()), StoreWorker)
+        self.assertNotIsInstance(eq.get_store_worker(self.get_event_store()), BulkStoreWorker)
+
+    def test_bulk_store_worker(self):
+        eq = self.get_queues()
+        worker = eq.get_store_worker(self.get_event_store(batch_size=100))
+        self.assertIsInstance(worker, BulkStoreWorker)
+        self.assertEqual(worker.batch_size, 100)
+        self.assertEqual(worker.max_batch_age_seconds, 17)
+
+    # queue depth
+
+    def test_worker_queue_depth(self):
+        eq = self.get_queues()
+        enrich_worker = eq.get_enrich_worker(Mock())
+        with eq.connection.channel() as channel:
+            producer = channel.Producer()
+            for i in range(3):
+                producer.publish(build_event_d(index=i), exchange=enrich_events_queue.exchange,
+                                 declare=[enrich_events_queue])
+        # the shared connection is not used
+        with patch.object(eq, "connection") as connection:
+            self.assertEqual(eq.get_worker_queue_depth(enrich_worker), 3)
+            self.assertIsNone(eq.get_worker_queue_depth(eq.get_preprocess_worker()))
+        connection.channel.assert_not_called()
+
+    # batch enrich
+
+    def get_enrich_worker(self, enrich_event, batch_size=2):
+        eq = self.get_queues(batch_size=batch_size)
+        worker = eq.get_enrich_worker(enrich_event)
+        worker.metrics_exporter = None
+        worker._producer_connection = Mock()
+        return worker
+
+    @patch("kombu.mixins.Producer")
+    def test_batch_enrich_multiple_ack(self, producer):
+        event = Mock(event_type="zentral_login")
+        worker = self.get_enrich_worker(Mock(side_effect=lambda body: [event]))
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(build_event_d(), message1)
+        self.assertEqual(len(worker.batch), 1)
+        worker.add_message_to_batch(build_event_d(), message2)
+        self.assertEqual(worker.batch, [])
+        self.assertEqual(producer.return_value.publish.call_count, 2)
+        message1.ack.assert_not_called()
+        message2.ack.assert_called_once_with(multiple=True)
+
+    @patch("zentral.core.queues.backends.kombu.time.monotonic")
+    @patch("kombu.mixins.Producer")
+    def test_batch_enrich_delayed_requeue(self, producer, monotonic):
+        monotonic.return_value = 100
+
+        def enrich_event(body):
+            if body["_zentral"]["index"] == 1:
+                raise ValueError("yolo")
+            return [Mock(event_type="zentral_login")]
+
+        worker = self.get_enrich_worker(enrich_event)
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(build_event_d(index=1), message1)
+        worker.add_message_to_batch(build_event_d(index=2), message2)
+        # individual acks, because of the pending requeue
+        message1.ack.assert_not_called()
+        message2.ack.assert_called_once_with()
+        self.assertEqual(list(worker.delayed_requeues), [(101, message1)])
+        # requeue delay not reached
+        monotonic.return_value = 100.5
+        worker.on_iteration()
+        message1.requeue.assert_not_called()
+        # requeue delay reached
+        monotonic.return_value = 101
+        worker.on_iteration()
+        message1.requeue.assert_called_once_with()
+        self.assertEqual(len(worker.delayed_requeues), 0)
+
+    @patch("zentral.core.queues.backends.kombu.time.monotonic")
+    @patch("kombu.mixins.Producer")
+    def test_batch_enrich_max_batch_age(self, producer, monotonic):
+        monotonic.return_value = 100
+        worker = self.get_enrich_worker(Mock(return_value=[Mock(event_type="zentral_login")]), batch_size=10)
+        message = build_message(1)
+        worker.add_message_to_batch(build_event_d(), message)
+        worker.on_iteration()
+        message.ack.assert_not_called()
+        monotonic.return_value = 101.1
+        worker.on_iteration()
+        message.ack.assert_called_once_with(multiple=True)
+        self.assertEqual(worker.batch, [])
+        self.assertIsNone(worker.batch_start_ts)
+
+    def test_connection_revived_resets_batch(self):
+        worker = self.get_enrich_worker(Mock(), batch_size=10)
+        worker.add_message_to_batch(build_event_d(), build_message(1))
+        worker.delayed_requeues.append((1, build_message(2)))
+        worker.on_connection_revived()
+        self.assertEqual(worker.batch, [])
+        self.assertEqual(len(worker.delayed_requeues), 0)
+
+    def test_enrich_cache_counters(self):
+        counters = {"machine_cache_lookups": {"hit": 2, "miss": 1},
+                    "incident_updates": {"cached": 1}}
+        eq = self.get_queues(batch_size=2)
+        worker = eq.get_enrich_worker(Mock(), lambda: counters.items())
+        worker.metrics_exporter = Mock()
+        worker.inc_cache_counters()
+        counters["machine_cache_lookups"] = {"hit": 3, "miss": 1}
+        worker.inc_cache_counters()
+        self.assertEqual(
+            sorted(c.args for c in worker.metrics_exporter.inc.call_args_list),
+            [("incident_updates", "cached")]
+            + [("machine_cache_lookups", "hit")] * 3
+            + [("machine_cache_lookups", "miss")]
+        )
+
+    def test_enrich_no_cache_counters(self):
+        worker = self.get_enrich_worker(Mock())
+        worker.metrics_exporter = Mock()
+        worker.inc_cache_counters()
+        worker.metrics_exporter.inc.assert_not_called()
+
+    # batch process
+
+    def test_batch_process(self):
+        process_event = Mock()
+        eq = self.get_queues(batch_size=2)
+        worker = eq.get_process_worker(process_event)
+        worker.metrics_exporter = None
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(build_event_d(), message1)
+        worker.add_message_to_batch(build_event_d(), message2)
+        self.assertEqual(process_event.call_count, 2)
+        message2.ack.assert_called_once_with(multiple=True)
+
+    @patch("zentral.core.queues.backends.kombu.time.monotonic")
+    def test_batch_process_event_error(self, monotonic):
+        monotonic.return_value = 100
+
+        def process_event(body):
+            if body["_zentral"]["index"] == 2:
+                raise ValueError("yolo")
+
+        eq = self.get_queues(batch_size=3)
+        worker = eq.get_process_worker(process_event)
+        worker.metrics_exporter = None
+        messages = [build_message(i) for i in range(1, 4)]
+        for i, message in enumerate(messages, start=1):
+            worker.add_message_to_batch(build_event_d(index=i), message)
+        # the other events are processed and acked, only the failing one is requeued
+        messages[0].ack.assert_called_once_with()
+        messages[1].ack.assert_not_called()
+        messages[2].ack.assert_called_once_with()
+        self.assertEqual(list(worker.delayed_requeues), [(101, messages[1])])
+
+    @patch("zentral.core.queues.backends.kombu.time.monotonic")
+    def test_batch_process_batch_error(self, monotonic):
+        monotonic.return_value = 100
+        eq = self.get_queues(batch_size=2)
+        worker = eq.get_process_worker(Mock())
+        worker.metrics_exporter = None
+
+        def process_batch(batch):
+            yield batch[0][1], True
+            raise ValueError("yolo")
+
+        worker.process_batch = process_batch
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(build_event_d(), message1)
+        worker.add_message_to_batch(build_event_d(), message2)
+        message1.ack.assert_called_once_with()
+        self.assertEqual(list(worker.delayed_requeues), [(101, message2)])
+
+    # bulk store
+
+    def test_bulk_store_partial_failure(self):
+        event_d1 = build_event_d()
+        event_d2 = build_event_d()
+
+        def bulk_store(events):
+            for event_d in events:
+                if event_d is event_d1:
+                    yield (event_d["_zentral"]["id"], event_d["_zentral"]["index"])
+
+        event_store = self.get_event_store(batch_size=2, bulk_store=bulk_store)
+        worker = self.get_queues().get_store_worker(event_store)
+        worker.metrics_exporter = None
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(event_d1, message1)
+        worker.add_message_to_batch(event_d2, message2)
+        message1.ack.assert_called_once_with()
+        message2.ack.assert_not_called()
+        self.assertEqual([m for _, m in worker.delayed_requeues], [message2])
+
+    def test_bulk_store_skipped_events(self):
+        event_store = self.get_event_store(batch_size=2, included=False, bulk_store=lambda events: list(events))
+        worker = self.get_queues().get_store_worker(event_store)
+        worker.metrics_exporter = None
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(build_event_d(), message1)
+        worker.add_message_to_batch(build_event_d(), message2)
+        message2.ack.assert_called_once_with(multiple=True)
+        self.assertEqual(len(worker.delayed_requeues), 0)
+
+    def test_bulk_store_exception(self):
+        def bulk_store(events):
+            list(events)
+            raise ValueError("yolo")
+
+        event_store = self.get_event_store(batch_size=2, bulk_store=bulk_store)
+        worker = self.get_queues().get_store_worker(event_store)
+        worker.metrics_exporter = None
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.add_message_to_batch(build_event_d(), message1)
+        worker.add_message_to_batch(build_event_d(), message2)
+        message1.ack.assert_not_called()
+        message2.ack.assert_not_called()
+        self.assertEqual([m for _, m in worker.delayed_requeues], [message1, message2])
+
+    # multiplexed store worker
+
+    def test_default_store_workers(self):
+        eq = self.get_queues()
+        workers = list(eq.get_store_workers([self.get_event_store(), self.get_event_store()]))
+        self.assertEqual(len(workers), 2)
+        self.assertTrue(all(isinstance(w, StoreWorker) for w in workers))
+
+    def test_multiplexed_store_worker(self):
+        eq = self.get_queues(multiplexed_store_worker=True)
+        workers = list(eq.get_store_workers([self.get_event_store(), self.get_event_store(batch_size=50)]))
+        self.assertEqual(len(workers), 1)
+        worker = workers[0]
+        self.assertIsInstance(worker, MultiplexedStoreWorker)
+        self.assertEqual(len(worker.dispatchers), 2)
+        self.assertEqual(worker.prefetch_count, 100)
+        self.assertEqual(list(eq.get_store_workers([])), [])
+
+    def get_multiplexed_store_worker(self, *event_stores):
+        eq = self.get_queues(multiplexed_store_worker=True, requeue_delay_seconds=0)
+        worker = list(eq.get_store_workers(event_stores))[0]
+        worker.metrics_exporter = Mock()
+        return worker
+
+    @staticmethod
+    def flush_dispatchers(worker):
+        for dispatcher in worker.dispatchers:
+            batch = []
+            while not dispatcher.input_queue.empty():
+                batch.append(dispatcher.input_queue.get_nowait())
+            if batch:
+                dispatcher.flush_batch(batch)
+
+    def test_multiplexed_store_worker_dispatch(self):
+        stored_events = []
+
+        def store(event_d):
+            event_d.pop("_zentral")  # the stores mutate the events
+            stored_events.append(event_d)
+
+        def bulk_store(events):
+            for event_d in events:
+                metadata = event_d.pop("_zentral")
+                stored_events.append(event_d)
+                yield metadata["id"], metadata["index"]
+
+        store1 = self.get_event_store()
+        store1.store.side_effect = store
+        store2 = self.get_event_store(batch_size=10, bulk_store=bulk_store)
+        store2.name = "fomo"
+        store3 = self.get_event_store(included=False)
+        worker = self.get_multiplexed_store_worker(store1, store2, store3)
+        message1 = build_message(1)
+        message2 = build_message(2)
+        worker.dispatch_event(build_event_d(), message1)
+        worker.dispatch_event(build_event_d(), message2)
+        self.flush_dispatchers(worker)
+        worker.on_iteration()
+        message1.ack.assert_called_once_with()
+        message2.ack.assert_called_once_with()
+        self.assertEqual(worker.pending_messages, {})
+        self.assertEqual(len(stored_events), 4)
+        self.assertEqual(
+            sorted(c.args for c in worker.metrics_exporter.inc.call_args_list),
+            [("skipped_events", "yolo")] * 2 + [("stored_events", "fomo")] * 2 + [("stored_events", "yolo")] * 2
+        )
+
+    def test_multiplexed_store_worker_partial_ack(self):
+        worker = self.get_multiplexed_store_worker(self.get_event_store(), self.get_event_store())
+        message = build_message(1)
+        worker.dispatch_event(build_event_d(), message)
+        worker.dispatchers[0].flush_batch([worker.dispatchers[0].input_queue.get_nowait()])
+        worker.on_iteration()
+        message.ack.assert_not_called()
+        self.flush_dispatchers(worker)
+        worker.on_iteration()
+        message.ack.assert_called_once_with()
+
+    @patch("zentral.core.queues.backends.kombu.save_dead_letter")
+    def test_multiplexed_store_worker_failure_isolation(self, save_dead_letter):
+        attempts = []
+
+        def bulk_store(events):
+            for event_d in events:
+                attempts.append(event_d["_zentral"].pop("id"))
+            raise ValueError("yolo")
+
+        failing_store = self.get_event_store(batch_size=10, bulk_store=bulk_store)
+        failing_store.name = "fomo"
+        store = self.get_event_store()
+        worker = self.get_multiplexed_store_worker(failing_store, store)
+        event_d = build_event_d()
+        message = build_message(1)
+        worker.dispatch_event(event_d, message)
+        self.flush_dispatchers(worker)
+        worker.on_iteration()
+        # retried with a fresh copy each time
+        self.assertEqual(attempts, [event_d["_zentral"]["id"]] * 3)
+        save_dead_letter.assert_called_once()
+        self.assertEqual(save_dead_letter.call_args.args[0]["_zentral"]["id"], event_d["_zentral"]["id"])
+        self.assertEqual(save_dead_letter.call_args.args[1], "event store fomo error")
+        store.store.assert_called_once()
+        message.ack.assert_called_once_with()
+
+    def test_multiplexed_store_worker_connection_revived(self):
+        event_store = self.get_event_store()
+        worker = self.get_multiplexed_store_worker(event_store)
+        dispatcher = worker.dispatchers[0]
+        message1 = build_message(1)
+        worker.dispatch_event(build_event_d(), message1)
+        message2 = build_message(2)
+        worker.dispatch_event(build_event_d(), message2)
+        # message1 already in the dispatcher batch
+        batch = [dispatcher.input_queue.get_nowait()]
+        worker.on_connection_revived()
+        self.assertEqual(worker.pending_messages, {})
+        self.assertTrue(dispatcher.input_queue.empty())
+        message3 = build_message(3)
+        worker.dispatch_event(build_event_d(), message3)
+        batch.append(dispatcher.input_queue.get_nowait())
+        dispatcher.flush_batch(batch)
+        worker.on_iteration()
+        # only the event of the message from the new channel is stored
+        event_store.store.assert_called_once()
+        message1.ack.assert_not_called()
+        message2.ack.assert_not_called()
+        message3.ack.assert_called_once_with()
+
+    def test_multiplexed_store_worker_unbind_store_queues(self):
+        event_store = self.get_event_store()
+        other_event_store = self.get_event_store()
+        other_event_store.name = "fomo"
+        worker = self.get_multiplexed_store_worker(event_store, other_event_store)
+        store_queue = get_store_events_queue(event_store)
+        with worker.connection.channel() as channel:
+            store_queue(channel).declare()
+            Producer(channel).publish({"yolo": 1}, exchange=enriched_events_exchange)
+        worker.unbind_store_queues()
+        with worker.connection.channel() as channel:
+            Producer(channel).publish({"yolo": 2}, exchange=enriched_events_exchange)
+            # the store queue is kept, but does not receive the enriched events anymore
+            _, message_count, _ = store_queue(channel).queue_declare(passive=True)
+        self.assertEqual(message_count, 1)
+
+    def test_multiplexed_store_worker_queue_depth(self):
+        eq = self.get_queues(multiplexed_store_worker=True)
+        worker = list(eq.get_store_workers([self.get_event_store()]))[0]
+        with eq.connection.channel() as channel:
+            worker.input_queue(channel).declare()
+        self.assertEqual(eq.get_worker_queue_depth(worker), 0)
+
+    def test_multiplexed_store_worker_dispatcher_thread(self):
+        event_store = self.get_event_store(batch_size=10)
+        event_store.max_batch_age_seconds = 0.1
+        event_store.bulk_store.side_effect = lambda events: [(e["_zentral"]["id"], e["_zentral"]["index"])
+                                                             for e in events]
+        worker = self.get_multiplexed_store_worker(event_store)
+        dispatcher = worker.dispatchers[0]
+        dispatcher.start()
+        message = build_message(1)
+        worker.dispatch_event(build_event_d(), message)
+        # batch flushed when the max batch age is reached
+        worker.done_message_keys.put(worker.done_message_keys.get(timeout=2))
+        worker.on_iteration()
+        message.ack.assert_called_once_with()
+
+    @patch("kombu.mixins.ConsumerMixin.run")
+    def test_multiplexed_store_worker_run_closes_stores(self, consumer_run):
+        consumer_run.side_effect = KeyboardInterrupt
+        event_store = self.get_event_store(batch_size=10)
+        other_event_store = self.get_event_store()
+        other_event_store.name = "fomo"
+        worker = self.get_multiplexed_store_worker(event_store, other_event_store)
+        with self.assertRaises(KeyboardInterrupt):
+            worker.run()
+        for dispatcher in worker.dispatchers:
+            self.assertFalse(dispatcher.is_alive())
+        event_store.close.assert_called_once_with()
+        other_event_store.close.assert_called_once_with()
@@ -0,0 +1,338 @@
+from unittest.mock import Mock, call, patch
+import uuid
+from django.test import SimpleTestCase
+import redis
+from zentral.core.queues.backends.redis_streams import (EnrichWorker, EventQueues, PreprocessWorker,
+                                                        ProcessWorker, StoreWorker)
+from zentral.core.queues.exceptions import RetryLater
+from zentral.utils.json import dumps_bytes
+
+
+def build_event_d(event_type="zentral_login", index=0):
+    return {"_zentral": {"id": str(uuid.uuid4()), "index": index, "type": event_type}}
+
+
+def build_message(message_id, body):
+    return message_id, {b"data": dumps_bytes(body)}
+
+
+class RedisStreamsQueuesTestCase(SimpleTestCase):
+    @staticmethod
+    def get_queues(**kwargs):
+        config_d = {"url": "redis://redis:6379/2"}
+        config_d.update(kwargs)
+        eq = EventQueues(config_d)
+        eq.client = Mock()
+        return eq
+
+    @staticmethod
+    def get_event_store(batch_size=1, included=True, bulk_store=None):
+        event_store = Mock()
+        event_store.pk = "0c3f5c8d-0f3a-4b8a-8d6f-0ddf21b0f5a8"
+        event_store.name = "yolo"
+        event_store.batch_size = batch_size
+        event_store.worker_batch_size = batch_size
+        event_store.filter_batch.side_effect = lambda events: list(events) if included else []
+        if bulk_store:
+            event_store.bulk_store.side_effect = bulk_store
+        return event_store
+
+    @staticmethod
+    def setup_worker(worker):
+        worker.client = Mock()
+        worker.consumer = "host-1"
+        return worker
+
+    # configuration
+
+    def test_defaults(self):
+        eq = EventQueues({})
+        self.assertEqual(eq.prefix, "zentral:")
+        self.assertEqual(eq.max_len, 100000)
+        self.assertEqual(eq.batch_size, 100)
+        self.assertEqual(eq.max_deliveries, 5)
+        self.assertEqual(eq.consumer_max_idle_seconds, 3600)
+        self.assertEqual(eq.events_stream, "zentral:events")
+        self.assertEqual(eq.enriched_events_stream, "zentral:enriched_events")
+        self.assertEqual(eq.get_raw_events_stream("yolo"), "zentral:raw_events:yolo")
+
+    @patch("zentral.core.queues.backends.redis_streams.redis.Redis")
+    def test_notifier_connection(self, redis_client):
+        eq = EventQueues({"prefix": "ztl:"})
+        eq.get_client()
+        kwargs = redis_client.call_args.kwargs
+        self.assertEqual(kwargs["db"], 15)  # notifier default
+        self.assertFalse(kwargs["decode_responses"])
+
+    @patch("zentral.core.queues.backends.redis_streams.redis.Redis")
+    def test_own_connection(self, redis_client):
+        eq = EventQueues({"url": "rediss://redis.example.com:6380/3", "password": "yolo"})
+        eq.get_client()
+        kwargs = redis_client.call_args.kwargs
+        self.assertEqual(kwargs["host"], "redis.example.com")
+        self.assertEqual(kwargs["port"], 6380)
+        self.assertEqual(kwargs["db"], 3)
+        self.assertTrue(kwargs["ssl"])
+        self.assertEqual(kwargs["password"], "yolo")
+
+    # post events
+
+    def test_post_raw_event(self):
+        eq = self.get_queues(max_len=10)
+        eq.post_raw_event("osquery_log", {"un": 1})
+        eq.client.xadd.assert_called_once_with("zentral:raw_events:osquery_log", {"data": b'{"un":1}'},
+                                               maxlen=10, approximate=True)
+
+    def test_post_event(self):
+        eq = self.get_queues()
+        event = Mock()
+        event.serialize_bytes.return_value = b"{}"
+        eq.post_event(event)
+        event.serialize_bytes.assert_called_once_with(machine_metadata=False)
+        eq.client.xadd.assert_called_once_with("zentral:events", {"data": b"{}"},
+                                               maxlen=100000, approximate=True)
+
+    # consumer groups
+
+    def test_ensure_group_exists(self):
+        client = Mock()
+        client.xgroup_create.side_effect = redis.ResponseError("BUSYGROUP Consumer Group name already exists")
+        EventQueues.ensure_group(client, "zentral:events", "enrich", "0")
+        client.xgroup_create.assert_called_once_with("zentral:events", "enrich", id="0", mkstream=True)
+
+    def test_ensure_group_error(self):
+        client = Mock()
+        client.xgroup_create.side_effect = redis.ResponseError("WRONGTYPE")
+        with self.assertRaises(redis.ResponseError):
+            EventQueues.ensure_group(client, "zentral:events", "enrich", "0")
+
+    def test_store_worker_queue(self):
+        eq = self.get_queues()
+        event_store = self.get_event_store()
+        eq.setup_store_worker_queue(event_store)
+        eq.client.xgroup_create.assert_called_once_with(
+            "zentral:enriched_events", f"store:{event_store.pk}", id="$", mkstream=True
+        )
+        eq.mark_store_worker_queue_for_deletion(event_store)
+        eq.client.xgroup_destroy.assert_called_once_with("zentral:enriched_events", f"store:{event_store.pk}")
+
+    def test_worker_queue_depth(self):
+        eq = self.get_queues()
+        eq.client.xinfo_groups.return_value = [
+            {"name": b"enrich", "pending": 2, "lag": 42},
+            {"name": b"yolo", "pending": 0, "lag": 1},
+        ]
+        self.assertEqual(eq.get_worker_queue_depth(eq.get_enrich_worker(Mock())), 42)
+        eq.client.xinfo_groups.assert_called_once_with("zentral:events")
+        eq.client.xinfo_groups.return_value = [{"name": b"enrich", "pending": 2, "lag": None}]
+        self.assertIsNone(eq.get_worker_queue_depth(eq.get_enrich_worker(Mock())))
+        self.assertIsNone(eq.get_worker_queue_depth(Mock()))
+
+    # read
+
+    def test_read_messages(self):
+        eq = self.get_queues(batch_size=2, block_seconds=0.5)
+        worker = self.setup_worker(eq.get_enrich_worker(Mock()))
+        event_d = build_event_d()
+        worker.client.xautoclaim.return_value = [b"0-0", [], []]
+        worker.client.xreadgroup.return_value = [
+            [b"zentral:events", [build_message(b"1-0", event_d), (b"2-0", {b"data": b"{"})]]
+        ]
+        self.assertEqual(worker.read_messages(), [("zentral:events", b"1-0", event_d)])
+        worker.client.xreadgroup.assert_called_once_with("enrich", "host-1", {"zentral:events": ">"},
+                                                         count=2, block=500)
+        # undecodable message acked
+        worker.client.xack.assert_called_once_with("zentral:events", "enrich", b"2-0")
+        worker.client.xautoclaim.assert_called_once_with("zentral:events", "enrich", "host-1", 60000, count=2)
+
+    @patch("zentral.core.queues.backends.redis_streams.time.monotonic")
+    def test_claim_messages(self, monotonic):
+        monotonic.return_value = 100
+        eq = self.get_queues(claim_min_idle_seconds=10)
+        worker = self.setup_worker(eq.get_process_worker(Mock()))
+        event_d = build_event_d()
+        worker.client.xautoclaim.return_value = [b"0-0", [build_message(b"1-0", event_d), (b"2-0", None)], []]
+        worker.client.pipeline.return_value.execute.return_value = [[{"message_id": b"1-0", "times_delivered": 2}]]
+        self.assertEqual(worker.read_messages(), [("zentral:enriched_events", b"1-0", event_d)])
+        worker.client.xreadgroup.assert_not_called()
+        worker.client.pipeline.return_value.xpending_range.assert_called_once_with(
+            "zentral:enriched_events", "process", min=b"1-0", max=b"1-0", count=1
+        )
+        # claim interval not reached
+        worker.client.xreadgroup.return_value = []
+        monotonic.return_value = 105
+        self.assertEqual(worker.read_messages(), [])
+        worker.client.xautoclaim.assert_called_once()
+
+    @patch("zentral.core.queues.backends.redis_streams.save_dead_letter")
+    def test_claim_messages_max_deliveries(self, save_dead_letter):
+        eq = self.get_queues(max_deliveries=3)
+        worker = self.setup_worker(eq.get_process_worker(Mock()))
+        event_d1 = build_event_d()
+        event_d2 = build_event_d()
+        worker.client.xautoclaim.return_value = [
+            b"0-0", [build_message(b"1-0", event_d1), build_message(b"2-0", event_d2)], []
+        ]
+        worker.client.pipeline.return_value.execute.return_value = [
+            [{"message_id": b"1-0", "times_delivered": 4}],
+            [{"message_id": b"2-0", "times_delivered": 3}],
+        ]
+        self.assertEqual(worker.claim_messages(), [("zentral:enriched_events", b"2-0", event_d2)])
+        save_dead_letter.assert_called_once_with(event_d1, "process worker max deliveries")
+        worker.client.xack.assert_called_once_with("zentral:enriched_events", "process", b"1-0")
+
+    # consumers
+
+    def test_delete_idle_consumers(self):
+        eq = self.get_queues(consumer_max_idle_seconds=10)
+        worker = self.setup_worker(eq.get_enrich_worker(Mock()))
+        worker.client.xinfo_consumers.return_value = [
+            {"name": b"host-1", "pending": 0, "idle": 20000},  # this worker
+            {"name": b"host-2", "pending": 0, "idle": 20000},  # idle, no pending messages
+            {"name": b"host-3", "pending": 1, "idle": 20000},  # pending messages
+            {"name": b"host-4", "pending": 0, "idle": 5000},  # active
+        ]
+        worker.delete_idle_consumers("zentral:events")
+        worker.client.xinfo_consumers.assert_called_once_with("zentral:events", "enrich")
+        worker.client.xgroup_delconsumer.assert_called_once_with("zentral:events", "enrich", "host-2")
+
+    # process
+
+    def test_enrich_batch(self):
+        eq = self.get_queues()
+
+        def enrich_event(body):
+            event = Mock(event_type="zentral_login")
+            event.serialize_bytes.return_value = b"{}"
+            yield event
+            if body["_zentral"]["index"] == 1:
+                # failure after a first produced event
+                raise ValueError("yolo")
+
+        worker = self.setup_worker(eq.get_enrich_worker(enrich_event))
+        worker.handle_batch([("zentral:events", b"1-0", build_event_d(index=1)),
+                             ("zentral:events", b"2-0", build_event_d(index=2))])
+        worker.client.pipeline.assert_called_once_with(transaction=True)
+        pipeline = worker.client.pipeline.return_value
+        pipeline.xadd.assert_called_once_with("zentral:enriched_events", {"data": b"{}"},
+                                              maxlen=100000, approximate=True)
+        pipeline.xack.assert_called_once_with("zentral:events", "enrich", b"2-0")
+        pipeline.execute.assert_called_once_with()
+
+    def test_preprocess_batch(self):
+        eq = self.get_queues()
+        worker = self.setup_worker(eq.get_preprocess_worker())
+        event = Mock(event_type="zentral_login")
+        event.serialize_bytes.return_value = b"{}"
+        ok_preprocessor = Mock(routing_key="ok")
+        ok_preprocessor.process_raw_event.return_value = [event]
+        retry_preprocessor = Mock(routing_key="retry")
+        retry_preprocessor.process_raw_event.side_effect = RetryLater()
+        worker.preprocessors = {"zentral:raw_events:ok": ok_preprocessor,
+                                "zentral:raw_events:retry": retry_preprocessor}
+        self.assertEqual(worker.get_streams(), ["zentral:raw_events:ok", "zentral:raw_events:retry"])
+        worker.handle_batch([("zentral:raw_events:ok", b"1-0", {"un": 1}),
+                             ("zentral:raw_events:retry", b"1-0", {"deux": 2})])
+        pipeline = worker.client.pipeline.return_value
+        pipeline.xadd.assert_called_once_with("zentral:events", {"data": b"{}"}, maxlen=100000, approximate=True)
+        event.serialize_bytes.assert_called_once_with(machine_metadata=False)
+        pipeline.xack.assert_called_once_with("zentral:raw_events:ok", "preprocess", b"1-0")
+
+    def test_process_batch(self):
+        process_event = Mock()
+        eq = self.get_queues()
+        worker = self.setup_worker(eq.get_process_worker(process_event))
+        self.assertIsInstance(worker, ProcessWorker)
+        worker.handle_batch([("zentral:enriched_events", b"1-0", build_event_d()),
+                             ("zentral:enriched_events", b"2-0", build_event_d())])
+        self.assertEqual(process_event.call_count, 2)
+        worker.client.pipeline.return_value.xack.assert_called_once_with(
+            "zentral:enriched_events", "process", b"1-0", b"2-0"
+        )
+
+    def test_process_batch_error(self):
+        eq = self.get_queues()
+
+        def process_event(body):
+            if body["_zentral"]["index"] == 1:
+                raise ValueError("yolo")
+
+        worker = self.setup_worker(eq.get_process_worker(process_event))
+        worker.handle_batch([("zentral:enriched_events", b"1-0", build_event_d(index=1)),
+                             ("zentral:enriched_events", b"2-0", build_event_d(index=2))])
+        # failed message left pending
+        worker.client.pipeline.return_value.xack.assert_called_once_with(
+            "zentral:enriched_events", "process", b"2-0"
+        )
+
+    def test_store_skipped_events(self):
+        eq = self.get_queues()
+        event_store = self.get_event_store(included=False)
+        worker = self.setup_worker(eq.get_store_worker(event_store))
+        self.assertIsInstance(worker, StoreWorker)
+        self.assertEqual(worker.group, f"store:{event_store.pk}")
+        worker.handle_batch([("zentral:enriched_events", b"1-0", build_event_d())])
+        event_store.store.assert_not_called()
+        worker.client.pipeline.return_value.xack.assert_called_once_with(
+            "zentral:enriched_events", f"store:{event_store.pk}", b"1-0"
+        )
+
+    @patch("zentral.core.queues.backends.redis_streams.save_dead_letter")
+    def test_store_error_dead_letter(self, save_dead_letter):
+        eq = self.get_queues()
+        event_store = self.get_event_store()
+        event_store.store.side_effect = ValueError("yolo")
+        worker = self.setup_worker(eq.get_store_worker(event_store))
+        event_d = build_event_d()
+        worker.handle_batch([("zentral:enriched_events", b"1-0", event_d)])
+        save_dead_letter.assert_called_once_with(event_d, "event store yolo error")
+        worker.client.pipeline.return_value.xack.assert_called_once_with(
+            "zentral:enriched_events", f"store:{event_store.pk}", b"1-0"
+        )
+
+    def test_bulk_store_partial_failure(self):
+        event_d1 = build_event_d()
+        event_d2 = build_event_d()
+
+        def bulk_store(events):
+            for event_d in events:
+                if event_d is event_d1:
+                    yield (event_d["_zentral"]["id"], event_d["_zentral"]["index"])
+
+        eq = self.get_queues()
+        event_store = self.get_event_store(batch_size=50, bulk_store=bulk_store)
+        worker = self.setup_worker(eq.get_store_worker(event_store))
+        self.assertEqual(worker.batch_size, 50)
+        worker.handle_batch([("zentral:enriched_events", b"1-0", event_d1),
+                             ("zentral:enriched_events", b"2-0", event_d2)])
+        worker.client.pipeline.return_value.xack.assert_called_once_with(
+            "zentral:enriched_events", f"store:{event_store.pk}", b"1-0"
+        )
+
+    # run
+
+    @patch("zentral.core.queues.backends.redis_streams.signal.signal")
+    def test_run(self, patched_signal):
+        eq = self.get_queues()
+        client = Mock()
+        client.xgroup_create.side_effect = [redis.ConnectionError("yolo"), None]
+        client.xautoclaim.return_value = [b"0-0", [], []]
+        client.xinfo_consumers.return_value = []
+        event_d = build_event_d()
+        client.xreadgroup.return_value = [[b"zentral:events", [build_message(b"1-0", event_d)]]]
+        enrich_event = Mock(return_value=[])
+        worker = eq.get_enrich_worker(enrich_event)
+        worker.stop_event = Mock()
+        worker.stop_event.is_set.side_effect = [False, False, True]
+        with patch.object(eq, "get_client", return_value=client):
+            worker.run()
+        self.assertIsInstance(worker, EnrichWorker)
+        self.assertEqual(client.xgroup_create.call_args_list,
+                         [call("zentral:events", "enrich", id="0", mkstream=True)] * 2)
+        client.xinfo_consumers.assert_called_once_with("zentral:events", "enrich")
+        worker.stop_event.wait.assert_called_once()
+        enrich_event.assert_called_once_with(event_d)
+        client.pipeline.return_value.xack.assert_called_once_with("zentral:events", "enrich", b"1-0")
+
+    def test_preprocess_worker(self):
+        self.assertIsInstance(self.get_queues().get_preprocess_worker(), PreprocessWorker)
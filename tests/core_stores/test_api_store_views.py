@@ -87,7 +87,9 @@ class StoreAPIViewsTestCase(TestCase):
               'description': '',
               'event_filters': {},
               'events_url_authorized_roles': [],
-              'http_kwargs': {'concurrency': 1,
+              'http_kwargs': {'batch_size': 1,
+                              'compression': 'none',
+                              'concurrency': 1,
                               'endpoint_url': 'https://www.example.com',
                               'max_retries': 3,
                               'password': None,
@@ -244,7 +246,9 @@ class StoreAPIViewsTestCase(TestCase):
              'description': description,
              'event_filters': {},
              'events_url_authorized_roles': [],
-             'http_kwargs': {'concurrency': 1,
+             'http_kwargs': {'batch_size': 1,
+                             'compression': 'none',
+                             'concurrency': 1,
                              'endpoint_url': 'https://www.example.com/post',
                              'headers': [],
                              'max_retries': 3,
@@ -266,7 +270,9 @@ class StoreAPIViewsTestCase(TestCase):
              'object': {'model': 'stores.store',
                         'new_value': {'admin_console': False,
                                       'backend': 'HTTP',
-                                      'backend_kwargs': {'concurrency': 1,
+                                      'backend_kwargs': {'batch_size': 1,
+                                                         'compression': 'none',
+                                                         'concurrency': 1,
                                                          'endpoint_url': 'https://www.example.com/post',
                                                          'headers': [],
                                                          'max_retries': 3,
@@ -313,7 +319,9 @@ class StoreAPIViewsTestCase(TestCase):
             'description': description,
             'event_filters': {},
             'events_url_authorized_roles': [],
-            'http_kwargs': {'concurrency': 1,
+            'http_kwargs': {'batch_size': 1,
+                            'compression': 'none',
+                            'concurrency': 1,
                             'endpoint_url': 'https://www.example.com/post',
                             'max_retries': 3,
                             'password': None,
@@ -335,7 +343,9 @@ class StoreAPIViewsTestCase(TestCase):
                         'pk': str(store.pk),
                         'new_value': {'admin_console': False,
                                       'backend': 'HTTP',
-                                      'backend_kwargs': {'concurrency': 1,
+                                      'backend_kwargs': {'batch_size': 1,
+                                                         'compression': 'none',
+                                                         'concurrency': 1,
                                                          'endpoint_url': 'https://www.example.com/post',
                                                          'max_retries': 3,
                                                          'request_timeout': 120,
@@ -408,6 +418,8 @@ class StoreAPIViewsTestCase(TestCase):
                  "request_timeout": 120,
                  "max_retries": 3,
                  "concurrency": 1,
+                 "batch_size": 1,
+                 "compression": "none",
                  "verify_tls": True,
             },
             'created_at': store.created_at.isoformat(),
@@ -444,6 +456,8 @@ class StoreAPIViewsTestCase(TestCase):
                         "request_timeout": 120,
                         "max_retries": 3,
                         "concurrency": 1,
+                        "batch_size": 1,
+                        "compression": "none",
                         "verify_tls": True,
                     },
                     "created_at": store.created_at,
@@ -484,7 +498,9 @@ class StoreAPIViewsTestCase(TestCase):
              'description': '',
              'event_filters': {},
              'events_url_authorized_roles': [],
-             'http_kwargs': {'concurrency': 1,
+             'http_kwargs': {'batch_size': 1,
+                             'compression': 'none',
+                             'concurrency': 1,
                              'endpoint_url': 'https://www.example.com',
                              'max_retries': 3,
                              'password': None,
@@ -583,6 +599,8 @@ class StoreAPIViewsTestCase(TestCase):
                  "request_timeout": 120,
                  "max_retries": 5,
                  "concurrency": 1,
+                 "batch_size": 1,
+                 "compression": "none",
                  "username": None,
                  "password": None,
                  "verify_tls": False,
@@ -602,7 +620,9 @@ class StoreAPIViewsTestCase(TestCase):
                   "prev_value": prev_value,
                   "new_value": {'admin_console': False,
                                 'backend': 'HTTP',
-                                'backend_kwargs': {'concurrency': 1,
+                                'backend_kwargs': {'batch_size': 1,
+                                                   'compression': 'none',
+                                                   'concurrency': 1,
                                                    'endpoint_url': 'https://www.example.com/post',
                                                    'max_retries': 5,
                                                    'request_timeout': 120,
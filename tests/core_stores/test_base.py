@@ -23,3 +23,14 @@ class TestBaseStore(TestCase):
         })
         event = build_login_event(routing_key="yolo")
         self.assertFalse(store.is_serialized_event_included(event.serialize()))
+
+    def test_event_filters_filter_batch(self):
+        store = force_store(event_filters={
+            "included_event_filters": [{"event_type": ["zentral_login", "zentral_logout"]}],
+            "excluded_event_filters": [{"routing_key": ["yolo"]}, {"event_type": ["munki_event"]}],
+        })
+        self.assertTrue(store.event_filter_set.compiled)
+        serialized_events = [build_login_event(routing_key=routing_key).serialize()
+                             for routing_key in ("jomo", "yolo", "fomo")]
+        self.assertEqual(store.filter_batch(serialized_events), [serialized_events[0], serialized_events[2]])
+        self.assertEqual(store.event_filter_set.get_drop_counters(), {"excluded_event_filters.0": 1})
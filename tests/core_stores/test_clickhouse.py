@@ -229,8 +229,8 @@ class TestClickHouseStore(TestCase):
               {'id': str(event.metadata.uuid),
                'index': 0,
                'namespace': 'zentral'},
-              f'{{"user": {{"username": "{username}"}}, '
-              '"dt": {"__type__": "datetime", "__value__": "1982-05-26T00:00:00"}}'))
+              f'{{"user":{{"username":"{username}"}},'
+              '"dt":{"__type__":"datetime","__value__":"1982-05-26T00:00:00"}}'))
         )
 
     def test_event_serialization_max(self):
@@ -259,7 +259,7 @@ class TestClickHouseStore(TestCase):
                'namespace': 'zentral',
                'objects': {'fomo': ['a'], 'yolo': ['un|deux', 'trois|quatre']},
                'probes': [{'name': probe.name, 'pk': probe.pk}]},
-              f'{{"user": {{"username": "{username}"}}}}'))
+              f'{{"user":{{"username":"{username}"}}}}'))
         )
 
     def test_dict_event_serialization(self):
@@ -276,7 +276,7 @@ class TestClickHouseStore(TestCase):
               {'id': str(event.metadata.uuid),
                'index': 0,
                'namespace': 'zentral'},
-              f'{{"user": {{"username": "{username}"}}}}'))
+              f'{{"user":{{"username":"{username}"}}}}'))
         )
 
     # event storage
@@ -297,10 +297,203 @@ class TestClickHouseStore(TestCase):
         get_client.return_value = mocked_client
         store = self.get_store()
         event = build_login_event()
-        event_keys = store.bulk_store([event])
+        event_keys = list(store.bulk_store([event]))
         self.assertEqual(event_keys, [(str(event.metadata.uuid), 0)])
         mocked_client.command.assert_called()
+        mocked_client.create_insert_context.assert_called_once_with(
+            "zentral_events",
+            column_names=ClickHouseStore.column_names,
+            column_oriented=True,
+            settings={},
+        )
         mocked_client.insert.assert_called_once()
+        # column oriented data
+        columns = mocked_client.insert.call_args.kwargs["data"]
+        self.assertEqual(len(columns), len(ClickHouseStore.column_names))
+        self.assertEqual(columns[1], ["zentral_login"])
+        self.assertEqual(mocked_client.insert.call_args.kwargs["context"],
+                         mocked_client.create_insert_context.return_value)
+
+    @patch("zentral.core.stores.backends.clickhouse.ClickHouseStore.insert_chunk_size", 2)
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_bulk_store_chunks(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        store = self.get_store()
+        events = [build_login_event() for _ in range(3)]
+        self.assertEqual(
+            list(store.bulk_store(events)),
+            [(str(event.metadata.uuid), 0) for event in events]
+        )
+        self.assertEqual(
+            [len(c.kwargs["data"][0]) for c in mocked_client.insert.call_args_list],
+            [2, 1]
+        )
+        mocked_client.create_insert_context.assert_called_once()
+
+    @patch("zentral.core.stores.backends.clickhouse.ClickHouseStore.insert_chunk_size", 2)
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_bulk_store_partial_failure(self, get_client):
+        mocked_client = Mock()
+        mocked_client.insert.side_effect = [None, ValueError("yolo")]
+        get_client.return_value = mocked_client
+        store = self.get_store()
+        events = [build_login_event() for _ in range(3)]
+        event_keys = []
+        with self.assertRaises(ValueError):
+            for event_key in store.bulk_store(events):
+                event_keys.append(event_key)
+        # the first chunk is stored
+        self.assertEqual(event_keys, [(str(event.metadata.uuid), 0) for event in events[:2]])
+        # the context is reset
+        self.assertIsNone(mocked_client.create_insert_context.return_value.data)
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_async_insert_settings(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        for wait_for_async_insert, expected_wait in ((None, 1), (True, 1), (False, 0)):
+            store = self.get_store(async_insert=True, wait_for_async_insert=wait_for_async_insert)
+            store.store(build_login_event())
+            self.assertEqual(
+                mocked_client.create_insert_context.call_args.kwargs["settings"],
+                {"async_insert": 1, "wait_for_async_insert": expected_wait}
+            )
+
+    # needle events
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_migrate_needles_table(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        store = self.get_store()
+        store.migrate()
+        statements = [c.args[0] for c in mocked_client.command.call_args_list]
+        self.assertFalse(any("zentral_events_needles" in s for s in statements))
+        mocked_client.reset_mock()
+        store = self.get_store(needles_table=True)
+        store.migrate()
+        statements = [c.args[0] for c in mocked_client.command.call_args_list]
+        self.assertIn("CREATE TABLE IF NOT EXISTS `database`.`zentral_events_needles`", statements[-2])
+        self.assertTrue(statements[-1].startswith(
+            "CREATE MATERIALIZED VIEW IF NOT EXISTS `database`.`zentral_events_needles_mv`"
+        ))
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_migrate_needles_table_existing_events(self, get_client):
+        mocked_client = Mock()
+        # EXISTS TABLE → 0, new needles table on a store with events
+        mocked_client.command.return_value = 0
+        get_client.return_value = mocked_client
+        store = self.get_store(needles_table=True)
+        store.migrate()
+        statements = [c.args[0] for c in mocked_client.command.call_args_list]
+        self.assertEqual(statements[0], "EXISTS TABLE `database`.`zentral_events_needles`")
+        self.assertTrue(statements[-2].startswith(
+            "CREATE MATERIALIZED VIEW IF NOT EXISTS `database`.`zentral_events_needles_mv`"
+        ))
+        backfill = statements[-1]
+        self.assertIn("INSERT INTO `database`.`zentral_events_needles`", backfill)
+        self.assertIn("FROM `database`.`zentral_events`\nARRAY JOIN needles", backfill)
+        self.assertIn("WHERE created_at < toDateTime64('", backfill)
+        # needles table already created → no backfill
+        mocked_client.reset_mock()
+        mocked_client.command.return_value = 1
+        store.migrate()
+        statements = [c.args[0] for c in mocked_client.command.call_args_list]
+        self.assertFalse(any(s.startswith("INSERT INTO") for s in statements))
+
+    def get_event_result(self, event):
+        event_d = event.serialize()
+        metadata = event_d.pop("_zentral")
+        return {"created_at": event.metadata.created_at,
+                "type": metadata.pop("type"),
+                "tags": metadata.pop("tags"),
+                "metadata": metadata,
+                "payload": event_d}
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_fetch_machine_events_keyset_cursor(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        events = [build_login_event() for _ in range(2)]
+        mocked_client.query.return_value.named_results.return_value = [self.get_event_result(e) for e in events]
+        store = self.get_store()
+        store.configured = True
+        from_dt = datetime(2024, 1, 1)
+        fetched_events, cursor = store.fetch_machine_events("0123", from_dt, limit=2,
+                                                            cursor=["2024-02-01T00:00:00", "yolo", 1])
+        self.assertEqual([e.metadata.uuid for e in fetched_events], [e.metadata.uuid for e in events])
+        self.assertEqual(cursor, [store._serialize_datetime(events[1].metadata.created_at),
+                                  str(events[1].metadata.uuid), 0])
+        query_ctx_kwargs = mocked_client.create_query_context.call_args.kwargs
+        self.assertIn("has(needles, {needle:String})", query_ctx_kwargs["query"])
+        self.assertIn("(metadata.id.:String, metadata.index.:Int64) > ({cursor_id:String}, {cursor_index:Int64})",
+                      query_ctx_kwargs["query"])
+        self.assertEqual(
+            query_ctx_kwargs["parameters"],
+            {"needle": "_s:0123",
+             "from_dt": "2024-01-01T00:00:00",
+             "cursor_created_at": "2024-02-01T00:00:00",
+             "cursor_id": "yolo",
+             "cursor_index": 1,
+             "limit": 2}
+        )
+        # last page
+        fetched_events, cursor = store.fetch_machine_events("0123", from_dt, limit=3)
+        self.assertEqual(len(fetched_events), 2)
+        self.assertIsNone(cursor)
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_fetch_machine_events_legacy_cursor(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        mocked_client.query.return_value.named_results.return_value = []
+        store = self.get_store()
+        store.configured = True
+        self.assertEqual(
+            store.fetch_machine_events("0123", datetime(2024, 1, 1), cursor="2024-02-01T00:00:00"),
+            ([], None)
+        )
+        query_ctx_kwargs = mocked_client.create_query_context.call_args.kwargs
+        self.assertIn("created_at < toDateTime64({cursor_created_at:String}, 9, 'UTC')", query_ctx_kwargs["query"])
+        self.assertNotIn("cursor_id", query_ctx_kwargs["parameters"])
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_fetch_object_events_needles_table(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        events = [build_login_event() for _ in range(3)]
+        event_keys = [{"created_at": e.metadata.created_at, "type": "zentral_login",
+                       "id": str(e.metadata.uuid), "idx": 0}
+                      for e in reversed(events[:2])]
+        # events not returned in the needle order
+        events_results = [self.get_event_result(e) for e in events]
+        mocked_client.query.return_value.named_results.side_effect = [event_keys, events_results]
+        store = self.get_store(needles_table=True)
+        store.configured = True
+        fetched_events, cursor = store.fetch_object_events("yolo", "fomo", datetime(2024, 1, 1),
+                                                           event_type="zentral_login", limit=2)
+        self.assertEqual([e.metadata.uuid for e in fetched_events], [events[1].metadata.uuid, events[0].metadata.uuid])
+        self.assertEqual(cursor, [store._serialize_datetime(events[0].metadata.created_at),
+                                  str(events[0].metadata.uuid), 0])
+        keys_query_kwargs, events_query_kwargs = [c.kwargs for c in mocked_client.create_query_context.call_args_list]
+        self.assertIn("FROM `zentral_events_needles` WHERE needle = {needle:String}", keys_query_kwargs["query"])
+        self.assertEqual(keys_query_kwargs["parameters"]["needle"], "_o:yolo:fomo")
+        self.assertEqual(keys_query_kwargs["parameters"]["event_type"], "zentral_login")
+        self.assertEqual(events_query_kwargs["parameters"]["types"], ["zentral_login"])
+        self.assertEqual(events_query_kwargs["parameters"]["ids"],
+                         sorted(str(e.metadata.uuid) for e in events[:2]))
+
+    @patch("zentral.core.stores.backends.clickhouse.clickhouse_connect.get_client")
+    def test_fetch_probe_events_needles_table_empty(self, get_client):
+        mocked_client = Mock()
+        get_client.return_value = mocked_client
+        mocked_client.query.return_value.named_results.return_value = []
+        store = self.get_store(needles_table=True)
+        store.configured = True
+        self.assertEqual(store.fetch_probe_events(Mock(pk=1), datetime(2024, 1, 1)), ([], None))
+        mocked_client.create_query_context.assert_called_once()
 
     # get_app_hist_data with timezones
 
@@ -350,7 +543,7 @@ class TestClickHouseStore(TestCase):
              "send_receive_timeout": ["Ensure this value is greater than or equal to 1."],
              "table_engine": ["This value does not match the required pattern."],
              "ttl_days": ["Ensure this value is greater than or equal to 1."],
-             "batch_size": ["Ensure this value is less than or equal to 1000."]}
+             "batch_size": ["Ensure this value is less than or equal to 10000."]}
         )
 
     def test_serializer_auth_conflict_username(self):
@@ -377,6 +570,20 @@ class TestClickHouseStore(TestCase):
             {"non_field_errors": ["Cannot use both access_token and username/password"]},
         )
 
+    def test_serializer_batch_size_without_async_insert(self):
+        s = ClickHouseStoreSerializer(data={"host": "clickhouse", "batch_size": 5000})
+        self.assertFalse(s.is_valid())
+        self.assertEqual(
+            s.errors,
+            {"batch_size": ["Ensure this value is less than or equal to 1000 without async_insert."]},
+        )
+
+    def test_serializer_batch_size_with_async_insert(self):
+        s = ClickHouseStoreSerializer(data={"host": "clickhouse", "batch_size": 5000, "async_insert": True})
+        self.assertTrue(s.is_valid())
+        self.assertEqual(s.data["batch_size"], 5000)
+        self.assertTrue(s.data["wait_for_async_insert"])
+
     def test_serializer_defaults(self):
         s = ClickHouseStoreSerializer(data={"host": "clickhouse"})
         self.assertTrue(s.is_valid())
@@ -396,7 +603,10 @@ class TestClickHouseStore(TestCase):
              'table_engine': 'MergeTree',
              'table_name': 'zentral_events',
              'ttl_days': 90,
-             'batch_size': 100}
+             'batch_size': 100,
+             'async_insert': False,
+             'wait_for_async_insert': True,
+             'needles_table': False}
         )
 
     def test_serializer_full(self):
@@ -415,7 +625,10 @@ class TestClickHouseStore(TestCase):
             'table_engine': 'ReplicatedMergeTree',
             'table_name': 'table_name',
             'ttl_days': 678,
-            'batch_size': 910
+            'batch_size': 910,
+            'async_insert': False,
+            'wait_for_async_insert': True,
+            'needles_table': True,
         }
         s = ClickHouseStoreSerializer(data=data)
         self.assertTrue(s.is_valid())
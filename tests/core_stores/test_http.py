@@ -1,8 +1,11 @@
+import gzip
+import json
 from unittest.mock import Mock
 from django.test import TestCase
 from django.utils.crypto import get_random_string
+import requests
 from accounts.models import Group
-from zentral.core.stores.backends.http import HTTPStore, HTTPStoreSerializer
+from zentral.core.stores.backends.http import HTTPStore, HTTPStoreSerializer, zstd
 from .utils import build_login_event, force_store
 
 
@@ -131,6 +134,91 @@ class HttpStoreTestCase(TestCase):
         store.store(event)
         mock_post.assert_called_once()
 
+    def test_store_gzip(self):
+        mock_post = Mock()
+        store = self.get_store(compression="gzip")
+        store.client.session.post = mock_post
+        event = build_login_event()
+        store.store(event)
+        _, kwargs = mock_post.call_args
+        self.assertEqual(kwargs["headers"], {"Content-Encoding": "gzip"})
+        self.assertEqual(json.loads(gzip.decompress(kwargs["data"]))["id"], str(event.metadata.uuid))
+
+    def test_batch_size(self):
+        store = self.get_store(concurrency=3)
+        self.assertEqual(store.batch_size, 1)
+        self.assertEqual(store.worker_batch_size, 1)
+        store = self.get_store(batch_size=50, concurrency=3)
+        self.assertEqual(store.batch_size, 50)
+        self.assertEqual(store.worker_batch_size, 150)
+
+    def test_close(self):
+        store = self.get_store(batch_size=50)
+        # nothing to close
+        store.close()
+        executor = store.executor
+        session = store.client.session
+        session.close = Mock()
+        store.close()
+        self.assertTrue(executor._shutdown)
+        session.close.assert_called_once_with()
+        # new executor and client if the store is used again
+        self.assertIsNot(store.executor, executor)
+        self.assertIsNot(store.client.session, session)
+
+    def test_bulk_store_not_available(self):
+        store = self.get_store()
+        with self.assertRaises(RuntimeError) as cm:
+            list(store.bulk_store([build_login_event()]))
+        self.assertEqual(cm.exception.args[0], "bulk_store is not available when batch_size < 2")
+
+    def test_bulk_store(self):
+        mock_post = Mock()
+        store = self.get_store(batch_size=2, concurrency=2, compression="zstd")
+        store.client.session.post = mock_post
+        events = [build_login_event() for _ in range(5)]
+        self.assertEqual(
+            sorted(store.bulk_store(events)),
+            sorted((str(event.metadata.uuid), event.metadata.index) for event in events)
+        )
+        self.assertEqual(mock_post.call_count, 3)
+        posted_ids = []
+        for _, kwargs in mock_post.call_args_list:
+            self.assertEqual(kwargs["headers"], {"Content-Type": "application/x-ndjson", "Content-Encoding": "zstd"})
+            lines = zstd.decompress(kwargs["data"]).decode("utf-8").splitlines()
+            self.assertTrue(1 <= len(lines) <= 2)
+            posted_ids.extend(json.loads(line)["id"] for line in lines)
+        self.assertEqual(sorted(posted_ids), sorted(str(event.metadata.uuid) for event in events))
+
+    def test_bulk_store_partial_failure(self):
+        events = [build_login_event() for _ in range(4)]
+        failed_event_id = str(events[2].metadata.uuid)
+
+        def post(url, data, headers):
+            if failed_event_id.encode("utf-8") in data:
+                raise requests.exceptions.ConnectionError("yolo")
+            return Mock()
+
+        store = self.get_store(batch_size=2)
+        store.client.session.post = Mock(side_effect=post)
+        with self.assertLogs("zentral.core.stores.backends.http", level="ERROR"):
+            stored_event_keys = list(store.bulk_store(events))
+        # only the keys of the events of the successful request
+        self.assertEqual(
+            stored_event_keys,
+            [(str(event.metadata.uuid), event.metadata.index) for event in events[:2]]
+        )
+
+    def test_bulk_client_retries_post(self):
+        store = self.get_store(batch_size=2, concurrency=4, max_retries=2)
+        adapter = store.client.session.get_adapter(store.endpoint_url)
+        self.assertIsNone(adapter.max_retries.allowed_methods)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        store = self.get_store()
+        adapter = store.client.session.get_adapter(store.endpoint_url)
+        self.assertNotIn("POST", adapter.max_retries.allowed_methods)
+
     # serializer
 
     def test_serializer_missing_fields(self):
@@ -145,14 +233,18 @@ class HttpStoreTestCase(TestCase):
         s = HTTPStoreSerializer(data={
             "endpoint_url": "https://",
             "request_timeout": 3600,
-            "max_retries": 42
+            "max_retries": 42,
+            "batch_size": 501,
+            "compression": "lzma",
         })
         self.assertFalse(s.is_valid())
         self.assertEqual(
             s.errors,
             {"endpoint_url": ["Invalid URL netloc"],
              "request_timeout": ["Ensure this value is less than or equal to 600."],
-             "max_retries": ["Ensure this value is less than or equal to 5."]},
+             "max_retries": ["Ensure this value is less than or equal to 5."],
+             "batch_size": ["Ensure this value is less than or equal to 500."],
+             "compression": ['"lzma" is not a valid choice.']},
         )
 
     def test_serializer_incorrect_endpoint_url_type(self):
@@ -211,7 +303,9 @@ class HttpStoreTestCase(TestCase):
              'password': None,
              'concurrency': 1,
              'request_timeout': 120,
-             'max_retries': 3}
+             'max_retries': 3,
+             'batch_size': 1,
+             'compression': 'none'}
         )
 
     def test_serializer_full(self):
@@ -224,6 +318,8 @@ class HttpStoreTestCase(TestCase):
             "concurrency": 2,
             "request_timeout": 42,
             "max_retries": 2,
+            "batch_size": 100,
+            "compression": "zstd",
         })
         self.assertTrue(s.is_valid())
         self.assertEqual(
@@ -235,5 +331,7 @@ class HttpStoreTestCase(TestCase):
              'headers': [{"name": "X-Yolo", "value": "Fomo"}],
              'concurrency': 2,
              'request_timeout': 42,
-             'max_retries': 2}
+             'max_retries': 2,
+             'batch_size': 100,
+             'compression': 'zstd'}
         )
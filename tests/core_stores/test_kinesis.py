@@ -1,3 +1,4 @@
+import hashlib
 import json
 import uuid
 from unittest.mock import patch, Mock
@@ -10,6 +11,45 @@ from zentral.core.stores.backends.kinesis import KinesisStore, KinesisStoreSeria
 from .utils import build_login_event, force_store
 
 
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def iter_fields(data):
+    offset = 0
+    while offset < len(data):
+        key, offset = read_varint(data, offset)
+        if key & 7 == 2:
+            length, offset = read_varint(data, offset)
+            value = data[offset:offset + length]
+            offset += length
+        else:
+            value, offset = read_varint(data, offset)
+        yield key >> 3, value
+
+
+def deaggregate(data):
+    assert data[:4] == b"\xf3\x89\x9a\xc2"
+    message, digest = data[4:-16], data[-16:]
+    assert hashlib.md5(message).digest() == digest
+    partition_keys = []
+    records = []
+    for field_number, value in iter_fields(message):
+        if field_number == 1:
+            partition_keys.append(value.decode("utf-8"))
+        elif field_number == 3:
+            record = dict(iter_fields(value))
+            records.append((partition_keys[record[1]], record[3]))
+    return records
+
+
 class KinesisStoreTestCase(TestCase):
     maxDiff = None
 
@@ -124,6 +164,21 @@ class KinesisStoreTestCase(TestCase):
         self.assertNotIn("tags", loaded_metadata)
         self.assertNotIn("type", loaded_metadata)
 
+    def test_zentral_serialization_reuses_serialized_bytes(self):
+        event = build_login_event()
+        data = event.serialize_bytes()
+        store = self.get_store(serialization_format="zentral")
+        serialized_event, partition_key, event_id, event_index = store._serialize_event(event)
+        self.assertIs(serialized_event, data)
+        self.assertEqual(event_id, str(event.metadata.uuid))
+        self.assertEqual(event_index, event.metadata.index)
+        self.assertEqual(partition_key, f"{event_id}{event_index}")
+        # same result with the event dict
+        self.assertEqual(
+            json.loads(store._serialize_event(event.serialize())[0]),
+            json.loads(serialized_event)
+        )
+
     def test_store_zentral_format(self):
         store = self.get_store()
         store.configured = True
@@ -189,6 +244,103 @@ class KinesisStoreTestCase(TestCase):
             [(str(event2.metadata.uuid), event2.metadata.index)]
         )
 
+    def test_bulk_store_aggregation(self):
+        store = self.get_store(batch_size=50, serialization_format="zentral", aggregation=True)
+        store.configured = True
+        mock_client = Mock()
+        mock_client.put_records.return_value = {"FailedRecordCount": 0}
+        store.client = mock_client
+        events = [build_login_event() for _ in range(3)]
+        self.assertEqual(
+            list(store.bulk_store(events)),
+            [(str(event.metadata.uuid), event.metadata.index) for event in events]
+        )
+        mock_client.put_records.assert_called_once()
+        records = mock_client.put_records.call_args.kwargs["Records"]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["PartitionKey"], f"{events[0].metadata.uuid}{events[0].metadata.index}")
+        self.assertEqual(
+            deaggregate(records[0]["Data"]),
+            [(f"{event.metadata.uuid}{event.metadata.index}", event.serialize_bytes()) for event in events]
+        )
+
+    def test_bulk_store_aggregation_max_size(self):
+        store = self.get_store(batch_size=50, serialization_format="zentral", aggregation=True)
+        store.configured = True
+        events = [build_login_event() for _ in range(5)]
+        store.aggregated_record_max_size = 2 * len(events[0].serialize_bytes()) + 200
+        mock_client = Mock()
+        mock_client.put_records.return_value = {"FailedRecordCount": 0}
+        store.client = mock_client
+        self.assertEqual(len(list(store.bulk_store(events))), 5)
+        records = mock_client.put_records.call_args.kwargs["Records"]
+        self.assertEqual([len(deaggregate(record["Data"])) for record in records], [2, 2, 1])
+        for record in records:
+            self.assertTrue(len(record["Data"]) + len(record["PartitionKey"]) <= store.aggregated_record_max_size)
+
+    def test_bulk_store_put_records_count(self):
+        store = self.get_store(batch_size=50, serialization_format="zentral")
+        store.configured = True
+        store.put_records_count = 2
+        mock_client = Mock()
+        mock_client.put_records.return_value = {"FailedRecordCount": 0}
+        store.client = mock_client
+        events = [build_login_event() for _ in range(5)]
+        self.assertEqual(len(list(store.bulk_store(events))), 5)
+        self.assertEqual([len(call.kwargs["Records"]) for call in mock_client.put_records.call_args_list],
+                         [2, 3])
+        # additive increase after each successful call
+        self.assertEqual(store.put_records_count, 4)
+
+    @patch("zentral.core.stores.backends.kinesis.time.sleep")
+    def test_bulk_store_retry_failed_records(self, sleep):
+        store = self.get_store(batch_size=50, serialization_format="zentral")
+        store.configured = True
+        mock_client = Mock()
+        mock_client.put_records.side_effect = [
+            {"FailedRecordCount": 1,
+             "Records": [{"SequenceNumber": 1, "ShardId": 2},
+                         {"ErrorCode": "ProvisionedThroughputExceededException"},
+                         {"SequenceNumber": 3, "ShardId": 2}]},
+            {"FailedRecordCount": 0},
+        ]
+        store.client = mock_client
+        events = [build_login_event() for _ in range(3)]
+        self.assertEqual(
+            list(store.bulk_store(events)),
+            [(str(event.metadata.uuid), event.metadata.index) for event in (events[0], events[2], events[1])]
+        )
+        sleep.assert_called_once_with(0.1)
+        # only the failed record is retried
+        self.assertEqual(
+            mock_client.put_records.call_args.kwargs["Records"],
+            [{"Data": events[1].serialize_bytes(),
+              "PartitionKey": f"{events[1].metadata.uuid}{events[1].metadata.index}"}]
+        )
+        # multiplicative decrease after the throttling, then additive increase
+        self.assertEqual(store.put_records_count, 275)
+
+    @patch("zentral.core.stores.backends.kinesis.time.sleep")
+    def test_bulk_store_retry_max_attempts(self, sleep):
+        store = self.get_store(batch_size=50, serialization_format="zentral", aggregation=True)
+        store.configured = True
+        mock_client = Mock()
+        mock_client.put_records.return_value = {
+            "FailedRecordCount": 1,
+            "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"}]
+        }
+        store.client = mock_client
+        events = [build_login_event() for _ in range(3)]
+        with self.assertLogs("zentral.core.stores.backends.kinesis", level="ERROR") as cm:
+            self.assertEqual(list(store.bulk_store(events)), [])
+        self.assertEqual(
+            cm.output,
+            ["ERROR:zentral.core.stores.backends.kinesis:1 record(s) not stored after 3 attempts"]
+        )
+        self.assertEqual(mock_client.put_records.call_count, 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.1, 0.2])
+        self.assertEqual(store.put_records_count, 62)
+
     # serializer
 
     def test_serializer_missing_fields(self):
@@ -232,7 +384,8 @@ class KinesisStoreTestCase(TestCase):
              "assume_role_arn": None,
              "region_name": "us-central-1",
              "batch_size": 1,
-             "serialization_format": "zentral"},
+             "serialization_format": "zentral",
+             "aggregation": False},
         )
 
     def test_serializer_key_full(self):
@@ -253,7 +406,8 @@ class KinesisStoreTestCase(TestCase):
              "aws_secret_access_key": "fomo",
              "assume_role_arn": None,
              "batch_size": 42,
-             "serialization_format": "firehose_v1"},
+             "serialization_format": "firehose_v1",
+             "aggregation": False},
         )
 
     def test_serializer_role_full(self):
@@ -273,5 +427,6 @@ class KinesisStoreTestCase(TestCase):
              "aws_secret_access_key": None,
              "assume_role_arn": "arn::role",
              "batch_size": 42,
-             "serialization_format": "firehose_v1"},
+             "serialization_format": "firehose_v1",
+             "aggregation": False},
         )
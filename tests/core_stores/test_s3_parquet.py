@@ -1,3 +1,4 @@
+from datetime import datetime
 import json
 import os.path
 import shutil
@@ -6,6 +7,7 @@ import uuid
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 from pyarrow.fs import LocalFileSystem
+import pyarrow.parquet as pq
 from accounts.events import EventMetadata, EventRequest, LoginEvent
 from accounts.models import Group
 from zentral.core.stores.backends.all import StoreBackend
@@ -209,8 +211,110 @@ class S3ParquetStoreTestCase(TestCase):
             [(str(event.metadata.uuid), event.metadata.index)]
         )
         self.assertTrue(os.path.isfile(filepath))
+        self.assertEqual(store._batch_index, 2)
         shutil.rmtree(os.path.join("/tmp", prefix))
 
+    @patch("zentral.core.stores.backends.s3_parquet.S3ParquetStore._get_filesystem")
+    def test_bulk_store_row_groups(self, get_fs):
+        get_fs.return_value = LocalFileSystem()
+        prefix = get_random_string(12) + "/"
+        store = self.get_store(bucket="/tmp", prefix=prefix, batch_size=50, row_group_size=2)
+        store.wait_and_configure_if_necessary()
+        filepath = store._get_parquet_path()
+        store._fs.create_dir(os.path.dirname(filepath))
+        events = [build_login_event() for _ in range(5)]
+        self.assertEqual(
+            list(store.bulk_store(events)),
+            [(str(event.metadata.uuid), event.metadata.index) for event in events]
+        )
+        parquet_file = pq.ParquetFile(filepath)
+        self.assertEqual(parquet_file.metadata.num_rows, 5)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        shutil.rmtree(os.path.join("/tmp", prefix))
+
+    @patch("zentral.core.stores.backends.s3_parquet.S3ParquetStore._get_filesystem")
+    def test_bulk_store_date_partitioning(self, get_fs):
+        get_fs.return_value = LocalFileSystem()
+        prefix = get_random_string(12) + "/"
+        store = self.get_store(bucket="/tmp", prefix=prefix, batch_size=50, partitioning="date")
+        store.wait_and_configure_if_necessary()
+        event1 = build_login_event()
+        event1.metadata.created_at = datetime(2026, 1, 1, 12)
+        event2 = build_login_event()
+        event2.metadata.created_at = datetime(2026, 1, 2, 12)
+        event3 = build_login_event()
+        event3.metadata.created_at = datetime(2026, 1, 1, 13)
+        partition1 = "event_date=2026-01-01/"
+        partition2 = "event_date=2026-01-02/"
+        for partition in (partition1, partition2):
+            store._fs.create_dir(os.path.join("/tmp", prefix, partition))
+        self.assertEqual(
+            list(store.bulk_store([event1, event2, event3])),
+            [(str(event.metadata.uuid), event.metadata.index) for event in (event1, event3, event2)]
+        )
+        self.assertEqual(store._batch_index, 2)
+        filepath1 = os.path.join("/tmp", prefix, partition1, f"{store._writer_id}_00000001.parquet")
+        self.assertEqual(
+            [r["id"] for r in pq.read_table(filepath1).to_pylist()],
+            [f"{event.metadata.uuid}_{event.metadata.index:06d}" for event in (event1, event3)]
+        )
+        filepath2 = os.path.join("/tmp", prefix, partition2, f"{store._writer_id}_00000001.parquet")
+        self.assertEqual(
+            [r["id"] for r in pq.read_table(filepath2).to_pylist()],
+            [f"{event2.metadata.uuid}_{event2.metadata.index:06d}"]
+        )
+        shutil.rmtree(os.path.join("/tmp", prefix))
+
+    @patch("zentral.core.stores.backends.s3_parquet.S3ParquetStore._get_filesystem")
+    def test_bulk_store_date_type_partitioning(self, get_fs):
+        get_fs.return_value = LocalFileSystem()
+        prefix = get_random_string(12) + "/"
+        store = self.get_store(bucket="/tmp", prefix=prefix, batch_size=50, partitioning="date_type")
+        store.wait_and_configure_if_necessary()
+        event1 = build_login_event()
+        event1.metadata.created_at = datetime(2026, 1, 1, 12)
+        event2 = build_login_event()
+        event2.metadata.created_at = datetime(2026, 1, 1, 13)
+        event_d2 = event2.serialize()
+        event_d2["_zentral"]["type"] = "zentral_logout"
+        partition1 = "event_date=2026-01-01/event_type=zentral_login/"
+        partition2 = "event_date=2026-01-01/event_type=zentral_logout/"
+        for partition in (partition1, partition2):
+            store._fs.create_dir(os.path.join("/tmp", prefix, partition))
+        self.assertEqual(
+            list(store.bulk_store([event1, event_d2])),
+            [(str(event.metadata.uuid), event.metadata.index) for event in (event1, event2)]
+        )
+        # one file per partition for the batch
+        for partition, event in ((partition1, event1), (partition2, event2)):
+            filepath = os.path.join("/tmp", prefix, partition, f"{store._writer_id}_00000001.parquet")
+            self.assertEqual(
+                [r["id"] for r in pq.read_table(filepath).to_pylist()],
+                [f"{event.metadata.uuid}_{event.metadata.index:06d}"]
+            )
+        shutil.rmtree(os.path.join("/tmp", prefix))
+
+    @patch("zentral.core.stores.backends.s3_parquet.copy_files")
+    @patch("zentral.core.stores.backends.s3_parquet.S3ParquetStore._get_filesystem")
+    def test_bulk_store_partial_upload(self, get_fs, copy_files):
+        get_fs.return_value = LocalFileSystem()
+        copy_files.side_effect = [None, OSError("yolo")]
+        store = self.get_store(bucket="/tmp", batch_size=50, partitioning="date")
+        event1 = build_login_event()
+        event1.metadata.created_at = datetime(2026, 1, 1, 12)
+        event2 = build_login_event()
+        event2.metadata.created_at = datetime(2026, 1, 2, 12)
+        keys = []
+        with self.assertRaises(OSError):
+            for key in store.bulk_store([event1, event2]):
+                keys.append(key)
+        # only the keys of the uploaded partition
+        self.assertEqual(keys, [(str(event1.metadata.uuid), event1.metadata.index)])
+        self.assertEqual(copy_files.call_args_list[0].args[1],
+                         f"/tmp/yolo/event_date=2026-01-01/{store._writer_id}_00000001.parquet")
+        # the next batch does not overwrite the uploaded files
+        self.assertEqual(store._batch_index, 2)
+
     # serializer
 
     def test_serializer_missing_fields(self):
@@ -228,6 +332,8 @@ class S3ParquetStoreTestCase(TestCase):
             "region_name": "",
             "batch_size": 1234678,
             "max_batch_age_seconds": 12345678,
+            "partitioning": "yolo",
+            "row_group_size": 1,
         })
         self.assertFalse(s.is_valid())
         self.assertEqual(
@@ -235,7 +341,9 @@ class S3ParquetStoreTestCase(TestCase):
             {"bucket": ["This field may not be blank."],
              "region_name": ["This field may not be blank."],
              "batch_size": ["Ensure this value is less than or equal to 100000."],
-             "max_batch_age_seconds": ["Ensure this value is less than or equal to 1200."]}
+             "max_batch_age_seconds": ["Ensure this value is less than or equal to 1200."],
+             "partitioning": ['"yolo" is not a valid choice.'],
+             "row_group_size": ["Ensure this value is greater than or equal to 1000."]}
         )
 
     def test_serializer_role_with_key_error(self):
@@ -267,7 +375,9 @@ class S3ParquetStoreTestCase(TestCase):
              "assume_role_arn": None,
              "region_name": "us-central-1",
              "batch_size": 10000,
-             "max_batch_age_seconds": 300},
+             "max_batch_age_seconds": 300,
+             "partitioning": "none",
+             "row_group_size": 10000},
         )
 
     def test_serializer_key_full(self):
@@ -290,7 +400,9 @@ class S3ParquetStoreTestCase(TestCase):
              "aws_secret_access_key": "fomo",
              "assume_role_arn": None,
              "batch_size": 100,
-             "max_batch_age_seconds": 17},
+             "max_batch_age_seconds": 17,
+             "partitioning": "none",
+             "row_group_size": 10000},
         )
 
     def test_serializer_role_full(self):
@@ -312,7 +424,9 @@ class S3ParquetStoreTestCase(TestCase):
              "aws_secret_access_key": None,
              "assume_role_arn": "arn::role",
              "batch_size": 100,
-             "max_batch_age_seconds": 17},
+             "max_batch_age_seconds": 17,
+             "partitioning": "none",
+             "row_group_size": 10000},
         )
 
     # provisioning
@@ -801,7 +801,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.put(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)  # audit event + machine filtering values cache
         tag.refresh_from_db()
         self.assertEqual(tag.name, updated_name)
         event = post_event.call_args_list[0].args[0]
@@ -879,7 +879,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.delete(reverse('inventory_api:tag', args=(tag.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)  # audit event + machine filtering values cache
         self.assertEqual(Tag.objects.filter(pk=tag.pk).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
@@ -0,0 +1,133 @@
+from unittest.mock import patch
+from django.test import SimpleTestCase, TestCase
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.cache import MachineFilteringValuesCache
+from zentral.contrib.inventory.models import MetaBusinessUnit, MetaMachine, Tag
+from zentral.contrib.inventory.utils import add_machine_tags
+
+
+class MachineFilteringValuesCacheTestCase(SimpleTestCase):
+    def test_disabled(self):
+        cache = MachineFilteringValuesCache()
+        cache.set("yolo", {"fomo": 1}, 0)
+        self.assertEqual(cache.get("yolo"), (None, None))
+        self.assertEqual(cache.get_stats(), {"hits": 0, "misses": 0, "entries": 0})
+
+    @patch("zentral.contrib.inventory.cache.notifier")
+    def test_hit_miss(self, notifier):
+        cache = MachineFilteringValuesCache(with_sync=True)
+        self.assertEqual(cache.get("yolo"), (None, 0))
+        cache.set("yolo", {"fomo": 1}, 0)
+        self.assertEqual(cache.get("yolo"), ({"fomo": 1}, 0))
+        self.assertEqual(cache.get_stats(), {"hits": 1, "misses": 1, "entries": 1})
+        notifier.add_callback.assert_called_once()
+        self.assertEqual(notifier.add_callback.call_args.args[0], "inventory.machine")
+
+    @patch("zentral.contrib.inventory.cache.notifier")
+    def test_lru(self, notifier):
+        cache = MachineFilteringValuesCache(max_size=2, with_sync=True)
+        for serial_number in ("1", "2"):
+            cache.set(serial_number, serial_number, 0)
+        cache.get("1")
+        cache.set("3", "3", 0)
+        self.assertEqual(cache.get("1"), ("1", 0))
+        self.assertEqual(cache.get("2"), (None, 0))
+        self.assertEqual(cache.get("3"), ("3", 0))
+
+    @patch("zentral.contrib.inventory.cache.time.monotonic")
+    @patch("zentral.contrib.inventory.cache.notifier")
+    def test_ttl(self, notifier, monotonic):
+        monotonic.return_value = 100
+        cache = MachineFilteringValuesCache(ttl=10, with_sync=True)
+        cache.set("yolo", "fomo", 0)
+        monotonic.return_value = 109
+        self.assertEqual(cache.get("yolo"), ("fomo", 0))
+        monotonic.return_value = 110
+        self.assertEqual(cache.get("yolo"), (None, 0))
+        self.assertEqual(cache.get_stats()["entries"], 0)
+
+    @patch("zentral.contrib.inventory.cache.notifier")
+    def test_invalidated_during_fetch(self, notifier):
+        cache = MachineFilteringValuesCache(with_sync=True)
+        _, generation = cache.get("yolo")
+        cache.clear("fomo")
+        cache.set("yolo", "stale", generation)
+        self.assertEqual(cache.get("yolo"), (None, 1))
+
+    @patch("zentral.contrib.inventory.cache.notifier")
+    def test_notification_handler(self, notifier):
+        cache = MachineFilteringValuesCache(with_sync=True)
+        cache.set("yolo", "yolo", 0)
+        cache.set("fomo", "fomo", 0)
+        cache._notification_handler("yolo")
+        self.assertEqual(cache.get("yolo"), (None, 1))
+        self.assertEqual(cache.get("fomo"), ("fomo", 1))
+        cache._notification_handler("")
+        self.assertEqual(cache.get("fomo"), (None, 2))
+
+    @patch("zentral.contrib.inventory.cache.notifier")
+    def test_invalidate(self, notifier):
+        cache = MachineFilteringValuesCache(with_sync=True)
+        cache.set("yolo", "yolo", 0)
+        cache.invalidate("yolo")
+        notifier.send_notification.assert_called_once_with("inventory.machine", "yolo")
+        cache.invalidate()
+        notifier.send_notification.assert_called_with("inventory.machine", "")
+        self.assertEqual(cache.get("yolo"), (None, 2))
+
+
+class MetaMachineFilteringValuesCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = MachineFilteringValuesCache(with_sync=True)
+        patcher = patch("zentral.contrib.inventory.models.machine_filtering_values_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        notifier_patcher = patch("zentral.contrib.inventory.cache.notifier")
+        self.notifier = notifier_patcher.start()
+        self.addCleanup(notifier_patcher.stop)
+
+    def test_cached_probe_filtering_values(self):
+        serial_number = get_random_string(12)
+        self.assertEqual(MetaMachine(serial_number).cached_probe_filtering_values,
+                         MetaMachine(serial_number).cached_probe_filtering_values)
+        self.assertEqual(self.cache.get_stats(), {"hits": 1, "misses": 1, "entries": 1})
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_add_machine_tags_invalidation(self, post_event):
+        serial_number = get_random_string(12)
+        MetaMachine(serial_number).cached_probe_filtering_values
+        tag = Tag.objects.create(name=get_random_string(12))
+        with self.captureOnCommitCallbacks(execute=True):
+            add_machine_tags(serial_number, [tag])
+            # invalidated only after the commit
+            self.notifier.send_notification.assert_not_called()
+        self.notifier.send_notification.assert_called_once_with("inventory.machine", serial_number)
+        platform, type, mbu_pks, tag_pks = MetaMachine(serial_number).cached_probe_filtering_values
+        self.assertEqual(tag_pks, {tag.pk})
+        self.assertEqual(self.cache.get_stats()["misses"], 2)
+
+    def test_meta_business_unit_tag_invalidation(self):
+        self.cache.set("yolo", "yolo", 0)
+        mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        tag = Tag.objects.create(name=get_random_string(12))
+        with self.captureOnCommitCallbacks(execute=True):
+            mbu.metabusinessunittag_set.create(tag=tag)
+        self.notifier.send_notification.assert_called_once_with("inventory.machine", "")
+        self.assertEqual(self.cache.get("yolo"), (None, 1))
+
+    def test_tag_rename_invalidation(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        self.cache.set("yolo", "yolo", 0)
+        tag.name = get_random_string(12)
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.save()
+        self.notifier.send_notification.assert_called_once_with("inventory.machine", "")
+        self.assertEqual(self.cache.get("yolo"), (None, 1))
+
+    def test_tag_delete_invalidation(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        self.cache.set("yolo", "yolo", 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.delete()
+        self.notifier.send_notification.assert_called_once_with("inventory.machine", "")
+        self.assertEqual(self.cache.get("yolo"), (None, 1))
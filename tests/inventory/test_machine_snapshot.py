@@ -14,7 +14,8 @@ from zentral.contrib.inventory.models import (BusinessUnit,
                                               MetaBusinessUnitTag,
                                               MetaMachine,
                                               Source,
-                                              Tag)
+                                              Tag,
+                                              machine_snapshot_commit_cache)
 from zentral.contrib.inventory.utils.db import inventory_events_from_machine_snapshot_commit
 from zentral.utils.mt_models import MTOError
 
@@ -165,6 +166,157 @@ class MachineSnapshotTestCase(TestCase):
                                    "many_to_one: True, many_to_many: False"):
             MachineSnapshot.objects.commit(tree)
 
+    def test_machine_snapshot_bulk_commit_source_error(self):
+        tree = copy.deepcopy(self.machine_snapshot_source_error)
+        with self.assertRaises(MTOError,
+                               msg="Field 'source' of MachineSnapshot has "
+                                   "many_to_one: True, many_to_many: False"):
+            MachineSnapshot.objects.bulk_commit(tree)
+        self.assertEqual(MachineSnapshot.objects.count(), 0)
+
+    def test_machine_snapshot_bulk_commit_same_as_commit(self):
+        tree = copy.deepcopy(self.machine_snapshot5)
+        ms, created = MachineSnapshot.objects.bulk_commit(tree)
+        self.assertTrue(created)
+        ms.refresh_from_db()
+        self.assertEqual(ms.hash(), ms.mt_hash)
+        self.assertEqual(ms.extra_facts, self.extra_facts)
+        self.assertEqual(ms.business_unit, self.business_unit)
+        self.assertEqual(ms.osx_app_instances.count(), 1)
+        self.assertEqual(ms.certificates.count(), 2)
+        osx_app_instance = ms.osx_app_instances.first()
+        self.assertEqual(osx_app_instance.signed_by.common_name, "Apple Root CA")
+        self.assertEqual(osx_app_instance.hash(), osx_app_instance.mt_hash)
+        tree = copy.deepcopy(self.machine_snapshot5)
+        ms2, created = MachineSnapshot.objects.commit(tree)
+        self.assertFalse(created)
+        self.assertEqual(ms2, ms)
+
+    def test_machine_snapshot_bulk_commit_existing_tree(self):
+        tree = copy.deepcopy(self.machine_snapshot3)
+        ms, _ = MachineSnapshot.objects.commit(tree)
+        tree = copy.deepcopy(self.machine_snapshot3)
+        with self.assertNumQueries(1):
+            ms2, created = MachineSnapshot.objects.bulk_commit(tree)
+        self.assertFalse(created)
+        self.assertEqual(ms2, ms)
+
+    def test_machine_snapshot_bulk_commit_existing_subtrees(self):
+        tree = copy.deepcopy(self.machine_snapshot2)
+        ms, _ = MachineSnapshot.objects.bulk_commit(tree)
+        tree = copy.deepcopy(self.machine_snapshot3)
+        ms2, created = MachineSnapshot.objects.bulk_commit(tree)
+        self.assertTrue(created)
+        ms2.refresh_from_db()
+        self.assertEqual(ms2.hash(), ms2.mt_hash)
+        self.assertEqual(ms2.osx_app_instances.count(), 2)
+        self.assertEqual(ms.os_version, ms2.os_version)
+        self.assertEqual(Certificate.objects.count(), 1)
+
+    def test_machine_snapshot_bulk_commit_new_business_unit(self):
+        tree = copy.deepcopy(self.machine_snapshot2)
+        tree["business_unit"].pop("mt_hash")
+        tree["business_unit"]["reference"] = "bulle 2"
+        ms, created = MachineSnapshot.objects.bulk_commit(tree)
+        self.assertTrue(created)
+        # committed with the regular path, to get a meta business unit
+        self.assertEqual(ms.business_unit.reference, "bulle 2")
+        self.assertEqual(ms.business_unit.meta_business_unit.name, "bulle")
+        self.assertNotEqual(ms.business_unit, self.business_unit)
+        ms.refresh_from_db()
+        self.assertEqual(ms.hash(), ms.mt_hash)
+
+    def test_machine_snapshot_bulk_commit_query_count(self):
+        osx_app_instances = []
+        for i in range(50):
+            osx_app_instances.append({'app': dict(self.osx_app, bundle_version=str(i)),
+                                      'bundle_path': f"/Applications/Baller{i}.app",
+                                      'signed_by': self.certificate})
+        tree = copy.deepcopy(self.machine_snapshot2)
+        tree["osx_app_instances"] = osx_app_instances
+        # 1 root lookup, 7 mt_hash IN, 5 × (insert + mt_hash IN), 1 m2m insert, 2 savepoint, 1 get
+        with self.assertNumQueries(22):
+            ms, created = MachineSnapshot.objects.bulk_commit(tree)
+        self.assertTrue(created)
+        ms.refresh_from_db()
+        self.assertEqual(ms.hash(), ms.mt_hash)
+        self.assertEqual(ms.osx_app_instances.count(), 50)
+
+    def test_machine_snapshot_commit_cache_fast_path(self):
+        machine_snapshot_commit_cache.clear()
+        stats = machine_snapshot_commit_cache.get_stats()
+        tree = copy.deepcopy(self.machine_snapshot)
+        with self.captureOnCommitCallbacks(execute=True):
+            msc, ms, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertEqual(machine_snapshot_commit_cache.get_stats()["misses"], stats["misses"] + 1)
+        tree = copy.deepcopy(self.machine_snapshot)
+        tree["last_seen"] = msc.last_seen + timedelta(minutes=5)
+        # 2 savepoint, 1 current machine snapshot update, 1 commit insert
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(4):
+            msc2, ms2, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertEqual(machine_snapshot_commit_cache.get_stats()["hits"], stats["hits"] + 1)
+        self.assertEqual(ms2, ms)
+        self.assertEqual(msc2.version, 2)
+        self.assertEqual(msc2.parent, msc)
+        self.assertEqual(last_seen, msc.last_seen + timedelta(minutes=5))
+        self.assertEqual(
+            list(inventory_events_from_machine_snapshot_commit(msc2)),
+            [('inventory_heartbeat', last_seen, {'source': self.source})]
+        )
+        cms = CurrentMachineSnapshot.objects.get(serial_number=self.serial_number, source=ms.source)
+        self.assertEqual(cms.machine_snapshot, ms)
+        self.assertEqual(cms.last_seen, last_seen)
+        # same last_seen → no new commit
+        tree = copy.deepcopy(self.machine_snapshot)
+        tree["last_seen"] = last_seen
+        with self.assertNumQueries(3):
+            msc3, ms3, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertIsNone(msc3)
+        self.assertEqual(ms3, ms)
+        self.assertEqual(MachineSnapshotCommit.objects.filter(serial_number=self.serial_number).count(), 2)
+        self.assertEqual(machine_snapshot_commit_cache.get_stats()["fallbacks"], stats["fallbacks"])
+
+    def test_machine_snapshot_commit_cache_different_tree(self):
+        machine_snapshot_commit_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            MachineSnapshotCommit.objects.commit_machine_snapshot_tree(copy.deepcopy(self.machine_snapshot))
+        hits = machine_snapshot_commit_cache.get_stats()["hits"]
+        msc, ms, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(copy.deepcopy(self.machine_snapshot2))
+        self.assertEqual(machine_snapshot_commit_cache.get_stats()["hits"], hits)
+        self.assertEqual(msc.version, 2)
+        self.assertEqual(CurrentMachineSnapshot.objects.get(serial_number=self.serial_number).machine_snapshot, ms)
+
+    def test_machine_snapshot_commit_cache_stale_entry(self):
+        machine_snapshot_commit_cache.clear()
+        tree = copy.deepcopy(self.machine_snapshot)
+        with self.captureOnCommitCallbacks(execute=True):
+            msc, ms, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        fallbacks = machine_snapshot_commit_cache.get_stats()["fallbacks"]
+        MetaMachine(self.serial_number).archive()
+        self.assertEqual(CurrentMachineSnapshot.objects.count(), 0)
+        msc2, ms2, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(copy.deepcopy(self.machine_snapshot))
+        self.assertEqual(machine_snapshot_commit_cache.get_stats()["fallbacks"], fallbacks + 1)
+        self.assertEqual(ms2, ms)
+        self.assertEqual(msc2.version, 2)
+        self.assertEqual(CurrentMachineSnapshot.objects.get(serial_number=self.serial_number).machine_snapshot, ms)
+
+    def test_machine_snapshot_commit_cache_conflict(self):
+        machine_snapshot_commit_cache.clear()
+        tree = copy.deepcopy(self.machine_snapshot)
+        with self.captureOnCommitCallbacks(execute=True):
+            msc, ms, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        # concurrent commit, not seen by the cache
+        MachineSnapshotCommit.objects.create(serial_number=self.serial_number, source=ms.source, version=2,
+                                             machine_snapshot=ms, parent=msc,
+                                             last_seen=msc.last_seen + timedelta(minutes=1))
+        tree = copy.deepcopy(self.machine_snapshot)
+        tree["last_seen"] = msc.last_seen + timedelta(minutes=2)
+        fallbacks = machine_snapshot_commit_cache.get_stats()["fallbacks"]
+        msc3, ms3, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        self.assertEqual(machine_snapshot_commit_cache.get_stats()["fallbacks"], fallbacks + 1)
+        self.assertEqual(msc3.version, 3)
+        self.assertEqual(ms3, ms)
+
     def test_machine_snapshot_commit_update(self):
         tree = copy.deepcopy(self.machine_snapshot)
         msc1, ms1, _ = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
@@ -436,7 +436,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)  # audit event + machine filtering values cache
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertContains(response, updated_name)
         tag = response.context["tag_list"][0]
@@ -518,7 +518,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)  # audit event + machine filtering values cache
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertNotContains(response, tag.name)
         event = post_event.call_args_list[0].args[0]
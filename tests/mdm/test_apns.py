@@ -5,7 +5,8 @@ from django.utils.crypto import get_random_string
 import httpx
 from zentral.contrib.inventory.models import MetaBusinessUnit
 from zentral.contrib.mdm.apns import (apns_client_cache, APNSClient,
-                                      send_enrolled_device_notification, send_enrolled_user_notification)
+                                      send_enrolled_device_notification, send_enrolled_device_notifications,
+                                      send_enrolled_user_notification, send_enrolled_user_notifications)
 from zentral.contrib.mdm.events import MDMDeviceNotificationEvent
 from .utils import force_dep_enrollment_session, force_enrolled_user, force_push_certificate
 
@@ -196,3 +197,55 @@ class MDMAPNSTestCase(TestCase):
         self.assertEqual(event.metadata.machine_serial_number, session.enrolled_device.serial_number)
         self.assertEqual(event.payload["status"], "success")
         self.assertEqual(event.payload["user_id"], enrolled_user.user_id)
+
+    # bulk
+
+    @patch("zentral.contrib.mdm.apns.time.sleep")
+    @patch("zentral.contrib.mdm.apns.httpx.Client.post")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_send_enrolled_device_notifications(self, post_event, post, sleep):
+        mocked_reponse = Mock()
+        mocked_reponse.status_code = 200
+        post.return_value = mocked_reponse
+        enrolled_devices = []
+        for _ in range(5):
+            session, _, _ = force_dep_enrollment_session(
+                self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+            )
+            enrolled_devices.append(session.enrolled_device)
+        enrolled_devices[0].token = None
+        results = list(send_enrolled_device_notifications(enrolled_devices, max_workers=2))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0], (enrolled_devices[0], None, None))
+        self.assertEqual({r[0] for r in results[1:]}, set(enrolled_devices[1:]))
+        self.assertTrue(all(r[1] for r in results[1:]))
+        self.assertEqual(post.call_count, 4)
+        sleep.assert_not_called()
+        self.assertEqual(
+            [call_args.args[0] for call_args in post_event.call_args_list],
+            [r[2] for r in results[1:]]
+        )
+        for _, _, event in results[1:]:
+            self.assertIsInstance(event, MDMDeviceNotificationEvent)
+            self.assertEqual(event.payload["status"], "success")
+            self.assertNotIn("user_id", event.payload)
+
+    @patch("zentral.contrib.mdm.apns.time.sleep")
+    @patch("zentral.contrib.mdm.apns.httpx.Client.post")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_send_enrolled_user_notifications_failure(self, post_event, post, sleep):
+        mocked_reponse = Mock()
+        mocked_reponse.status_code = 400  # no retries if < 500
+        post.return_value = mocked_reponse
+        session, _, _ = force_dep_enrollment_session(
+            self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+        )
+        enrolled_user = force_enrolled_user(session.enrolled_device)
+        results = list(send_enrolled_user_notifications([enrolled_user], post_events=False))
+        self.assertEqual(len(results), 1)
+        target, success, event = results[0]
+        self.assertEqual(target, enrolled_user)
+        self.assertFalse(success)
+        self.assertEqual(event.payload["status"], "failure")
+        self.assertEqual(event.payload["user_id"], enrolled_user.user_id)
+        post_event.assert_not_called()
@@ -2,8 +2,10 @@ from datetime import datetime
 import copy
 import os.path
 import plistlib
+from unittest.mock import patch
 from urllib.parse import urlparse
 import uuid
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
 from django.urls import reverse, NoReverseMatch
@@ -15,6 +17,7 @@ from zentral.contrib.monolith.models import (Enrollment,
                                              ManifestCatalog, ManifestSubManifest,
                                              PkgInfo, PkgInfoName,
                                              SubManifest, SubManifestPkgInfo)
+from zentral.contrib.monolith.utils import render_catalog_data
 from .utils import force_catalog, force_manifest, force_repository
 
 
@@ -297,6 +300,29 @@ class MonolithAPIViewsTestCase(TestCase):
         catalog = plistlib.loads(response.content)
         self.assertEqual(len(catalog), 2)
 
+    # we want to use the cache for this test
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_get_catalog_tag_renamed(self):
+        cache.clear()
+        pkg_info1, catalog, sub_manifest = self._force_smpi(name="ceci_n_est_pas_un_nom", version="1.2.3")
+        self._force_smpi(
+            name=pkg_info1.name.name,
+            version="1.2.4",
+            catalog=catalog,
+            sub_manifest=sub_manifest,
+            zentral_monolith={"shards": {"default": 0,
+                                         "tags": {"INCL1": 60}}}  # with NAME + VERSION + SN → 59, included
+        )
+        url = reverse("monolith_public:repository_catalog", args=(self.manifest.get_catalog_munki_name(),))
+        response = self._make_munki_request(url, serial_number="12345678", tags=["INCL1"])
+        self.assertEqual(len(plistlib.loads(response.content)), 2)
+        # tag renamed, without a manifest version bump
+        Tag.objects.filter(name="INCL1").update(name="INCL2")
+        # enrolled machine and tags cache expiry
+        cache.delete(f"{self.enrollment.secret.secret}12345678")
+        response = self._make_munki_request(url, serial_number="12345678")
+        self.assertEqual(len(plistlib.loads(response.content)), 1)
+
     def test_get_catalog_two_pkgsinfo_tag_shard_excluded(self):
         pkg_info1, catalog, sub_manifest = self._force_smpi(name="ceci_n_est_pas_un_nom", version="1.2.3")
         pkg_info2, _, _ = self._force_smpi(
@@ -344,6 +370,62 @@ class MonolithAPIViewsTestCase(TestCase):
         self.assertTrue(all(p.get("zentral_monolith") is None for p in catalog))
         self.assertEqual(catalog[0]["version"], "1.2.3")
 
+    def test_get_catalog_not_modified(self):
+        self._force_smpi()
+        url = reverse("monolith_public:repository_catalog", args=(self.manifest.get_catalog_munki_name(),))
+        response = self._make_munki_request(url, serial_number="12345678")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        response = self.client.get(url,
+                                   HTTP_AUTHORIZATION=f"Bearer {self.enrollment.secret.secret}",
+                                   HTTP_X_ZENTRAL_SERIAL_NUMBER="12345678",
+                                   HTTP_X_ZENTRAL_UUID=str(uuid.uuid4()),
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+
+    # we want to use the cache for this test
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("zentral.contrib.monolith.public_views.render_catalog_data", wraps=render_catalog_data)
+    def test_get_catalog_shard_buckets(self, render):
+        cache.clear()
+        pkg_info1, catalog, sub_manifest = self._force_smpi(name="ceci_n_est_pas_un_nom", version="1.2.3")
+        self._force_smpi(
+            name=pkg_info1.name.name,
+            version="1.2.4",
+            catalog=catalog,
+            sub_manifest=sub_manifest,
+            zentral_monolith={"shards": {"default": 60}}
+        )
+        url = reverse("monolith_public:repository_catalog", args=(self.manifest.get_catalog_munki_name(),))
+        etags = {}
+        for serial_number, expected_versions in (("12345678", ["1.2.3", "1.2.4"]),  # NAME + VERSION + SN → 59
+                                                 ("45678901", ["1.2.3", "1.2.4"]),  # NAME + VERSION + SN → 50
+                                                 ("87654321", ["1.2.3"])):  # NAME + VERSION + SN → 85
+            response = self._make_munki_request(url, serial_number=serial_number)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(sorted(p["version"] for p in plistlib.loads(response.content)), expected_versions)
+            etags[serial_number] = response["ETag"]
+        # one rendering per bucket
+        self.assertEqual(render.call_count, 2)
+        self.assertEqual(etags["12345678"], etags["45678901"])
+        self.assertNotEqual(etags["12345678"], etags["87654321"])
+
+    @patch("zentral.contrib.monolith.public_views.MAX_CACHED_CATALOG_SHARDED_PKGINFOS", 0)
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    @patch("zentral.contrib.monolith.public_views.render_catalog_data", wraps=render_catalog_data)
+    def test_get_catalog_too_many_shard_buckets(self, render):
+        cache.clear()
+        self._force_smpi(name="ceci_n_est_pas_un_nom", version="1.2.4", zentral_monolith={"shards": {"default": 60}})
+        url = reverse("monolith_public:repository_catalog", args=(self.manifest.get_catalog_munki_name(),))
+        for serial_number in ("12345678", "45678901"):
+            response = self._make_munki_request(url, serial_number=serial_number)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(plistlib.loads(response.content)), 1)
+        # rendered catalogs not cached
+        self.assertEqual(render.call_count, 2)
+
     # manifest
 
     def test_manifest(self):
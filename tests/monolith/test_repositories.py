@@ -189,3 +189,117 @@ class MonolithRepositoriesTestCase(TestCase):
             [call(pkg_info_to_unarchive, AuditEvent.Action.UPDATED, prev_value),
              call(manifest, AuditEvent.Action.UPDATED, manifest_prev_value)]
         )
+
+    @patch("zentral.contrib.monolith.repository_backends.base.SyncEventManager.audit_callback")
+    def test_sync_catalogs_unchanged(self, audit_callback):
+        db_repository = force_repository()
+        manifest = force_manifest()
+        catalog = force_catalog(repository=db_repository, manifest=manifest)
+        catalog_content = [
+            {"catalogs": [catalog.name],
+             "name": get_random_string(12),
+             "category": get_random_string(12),
+             "requires": [get_random_string(12)],
+             "version": f"{i}.0",
+             "yolo": datetime(2024, 1, 2, 3, 4, 5)}
+            for i in range(10)
+        ]
+        repository = self._load_repository(db_repository, catalog_content)
+        repository.sync_catalogs(audit_callback)
+        self.assertEqual(len(audit_callback.call_args_list), 41)  # 3 creations x 10 pkginfos, 10 names + manifest
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+        audit_callback.reset_mock()
+        repository = self._load_repository(db_repository, catalog_content)
+        with self.assertNumQueries(9):
+            repository.sync_catalogs(audit_callback)
+        audit_callback.assert_not_called()
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+
+    @patch("zentral.contrib.monolith.repository_backends.base.SyncEventManager.audit_callback")
+    def test_sync_catalogs_duplicated_pkg_info(self, audit_callback):
+        db_repository = force_repository()
+        catalog = force_catalog(repository=db_repository)
+        name = get_random_string(12)
+        catalog_content = [
+            {"catalogs": [catalog.name],
+             "name": name,
+             "version": "1.0",
+             "yolo": "fomo"},
+            {"catalogs": [catalog.name],
+             "name": name,
+             "version": "1.0",
+             "yolo": "yolo"},
+        ]
+        repository = self._load_repository(db_repository, catalog_content)
+        with self.assertLogs("zentral.contrib.monolith.repository_backends.base", level="WARNING") as cm:
+            repository.sync_catalogs(audit_callback)
+        self.assertEqual(cm.output, [f"WARNING:zentral.contrib.monolith.repository_backends.base:"
+                                     f"PKGINFO {name} 1.0 duplicated"])
+        pkg_info = PkgInfo.objects.get(repository=db_repository, name__name=name, version="1.0")
+        # the last entry wins
+        self.assertEqual(pkg_info.data["yolo"], "yolo")
+        self.assertEqual(list(pkg_info.catalogs.all()), [catalog])
+        self.assertEqual(
+            [c.args[1] for c in audit_callback.call_args_list if c.args[0] == pkg_info],
+            [AuditEvent.Action.CREATED]
+        )
+
+    @patch("zentral.contrib.monolith.repository_backends.base.SyncEventManager.audit_callback")
+    def test_sync_catalogs_only_affected_manifests_bumped(self, audit_callback):
+        db_repository = force_repository()
+        manifest = force_manifest()
+        catalog = force_catalog(repository=db_repository, manifest=manifest)
+        pkg_info = force_pkg_info(catalog=catalog, local=False)
+        other_manifest = force_manifest()
+        other_catalog = force_catalog(repository=db_repository, manifest=other_manifest)
+        other_pkg_info = force_pkg_info(catalog=other_catalog, local=False)
+        catalog_content = [
+            {"catalogs": [catalog.name],
+             "name": pkg_info.name.name,
+             "version": pkg_info.version,
+             "yolo": "fomo"},
+            {"catalogs": [other_catalog.name],
+             "name": other_pkg_info.name.name,
+             "version": other_pkg_info.version},
+        ]
+        other_pkg_info.data = catalog_content[1]
+        other_pkg_info.save()
+        pi_prev_value = pkg_info.serialize_for_event()
+        m_prev_value = manifest.serialize_for_event()
+        repository = self._load_repository(db_repository, catalog_content)
+        repository.sync_catalogs(audit_callback)
+        self.assertEqual(
+            audit_callback.call_args_list,
+            [call(pkg_info, AuditEvent.Action.UPDATED, pi_prev_value),
+             call(manifest, AuditEvent.Action.UPDATED, m_prev_value)]
+        )
+        pkg_info.refresh_from_db()
+        self.assertEqual(pkg_info.data["yolo"], "fomo")
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+        other_manifest.refresh_from_db()
+        self.assertEqual(other_manifest.version, 1)
+
+    @patch("zentral.contrib.monolith.repository_backends.base.SyncEventManager.audit_callback")
+    def test_sync_catalogs_icon_hashes_update(self, audit_callback):
+        db_repository = force_repository()
+        manifest = force_manifest()
+        catalog = force_catalog(repository=db_repository, manifest=manifest)
+        pkg_info = force_pkg_info(catalog=catalog, local=False)
+        catalog_content = [{"catalogs": [catalog.name],
+                            "name": pkg_info.name.name,
+                            "version": pkg_info.version}]
+        pkg_info.data = catalog_content[0]
+        pkg_info.save()
+        m_prev_value = manifest.serialize_for_event()
+        repository = self._load_repository(db_repository, catalog_content)
+        repository.get_icon_hashes_content.return_value = self._build_plist({f"{pkg_info.name.name}.png": "0" * 64})
+        repository.sync_catalogs(audit_callback)
+        self.assertEqual(
+            audit_callback.call_args_list,
+            [call(manifest, AuditEvent.Action.UPDATED, m_prev_value)]
+        )
+        db_repository.refresh_from_db()
+        self.assertEqual(db_repository.icon_hashes, {pkg_info.get_monolith_icon_name(): "0" * 64})
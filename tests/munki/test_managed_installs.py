@@ -1708,3 +1708,78 @@ class MunkiSetupViewsTestCase(TestCase):
         self.assertIsNone(mi.failed_at)
         self.assertIsNone(mi.failed_version)
         self.assertFalse(mi.reinstall)
+
+    def test_a_m_i_bulk_create_update_delete(self):
+        configuration = force_configuration(
+            auto_failed_install_incidents=True,
+            auto_reinstall_incidents=True,
+        )
+        serial_number = get_random_string(12)
+        # existing mis
+        updated_mi = ManagedInstall.objects.create(
+            machine_serial_number=serial_number,
+            name="updated",
+            display_name="Updated",
+            installed_version="1.0",
+            installed_at=datetime(2019, 12, 1),
+            failed_version="2.0",
+            failed_at=datetime(2019, 12, 2),
+        )
+        stalled_mi = ManagedInstall.objects.create(
+            machine_serial_number=serial_number,
+            name="stalled",
+            display_name="Stalled",
+            installed_version="1.0",
+            installed_at=datetime(2019, 12, 4),
+        )
+        deleted_mi = ManagedInstall.objects.create(
+            machine_serial_number=serial_number,
+            name="deleted",
+            display_name="Deleted",
+            installed_version="1.0",
+            installed_at=datetime(2019, 12, 1),
+            reinstall=True,
+        )
+        other_mi = ManagedInstall.objects.create(
+            machine_serial_number=get_random_string(12),
+            name="deleted",
+            display_name="Deleted",
+            installed_version="1.0",
+            installed_at=datetime(2019, 12, 1),
+        )
+
+        # do apply, 1 select, 1 delete, 1 insert ... on conflict for the updates, 1 for the creations
+        with self.assertNumQueries(4):
+            incident_updates = list(apply_managed_installs(
+                serial_number,
+                [("updated", "2.0", "Updated 2", "2019-12-03T09:49:11+00:00"),
+                 ("stalled", "2.0", None, "2019-12-03T09:49:11+00:00"),
+                 ("created", "1.0", None, "2019-12-03T09:49:11+00:00")],
+                configuration
+            ))
+
+        # incident updates
+        self.assertEqual(
+            [(iu.incident_type, iu.key, iu.severity) for iu in incident_updates],
+            [(MunkiInstallFailedIncident.incident_type,
+              {"munki_pkginfo_name": "updated", "munki_pkginfo_version": "2.0"},
+              Severity.NONE),
+             (MunkiReinstallIncident.incident_type,
+              {"munki_pkginfo_name": "deleted", "munki_pkginfo_version": "1.0"},
+              Severity.NONE)]
+        )
+
+        # mis
+        mi_qs = ManagedInstall.objects.filter(machine_serial_number=serial_number).order_by("name")
+        self.assertEqual(
+            [(mi.pk, mi.name, mi.display_name, mi.installed_version, mi.installed_at, mi.failed_at, mi.reinstall)
+             for mi in mi_qs],
+            [(mi_qs.get(name="created").pk, "created", "created", "1.0", datetime(2019, 12, 3, 9, 49, 11), None,
+              False),
+             (stalled_mi.pk, "stalled", "Stalled", "1.0", datetime(2019, 12, 4), None, False),
+             (updated_mi.pk, "updated", "Updated 2", "2.0", datetime(2019, 12, 3, 9, 49, 11), None, False)]
+        )
+        updated_mi.refresh_from_db()
+        self.assertIsNone(updated_mi.failed_version)
+        self.assertFalse(ManagedInstall.objects.filter(pk=deleted_mi.pk).exists())
+        self.assertTrue(ManagedInstall.objects.filter(pk=other_mi.pk).exists())
@@ -9,12 +9,14 @@ from django.test import TestCase
 from django.utils.crypto import get_random_string
 from server.urls import build_urlpatterns_for_zentral_apps
 from zentral.conf import settings
+from zentral.contrib.inventory.events import AddMachine
 from zentral.contrib.inventory.models import EnrollmentSecret, MachineSnapshot, MetaBusinessUnit, Tag, MachineTag
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 from zentral.contrib.munki.events import (MunkiInstallEvent, MunkiInstallFailedEvent,
                                           MunkiRequestEvent, MunkiScriptCheckStatusUpdated)
 from zentral.contrib.munki.incidents import IncidentUpdate, MunkiInstallFailedIncident
 from zentral.contrib.munki.models import EnrolledMachine, ManagedInstall, MunkiState, ScriptCheck
+from zentral.contrib.munki.preprocessors import PostflightPreprocessor
 from zentral.core.compliance_checks.models import MachineStatus
 from zentral.core.incidents.models import Incident, MachineIncident, Severity, Status
 from .utils import force_configuration, force_enrollment, force_script_check, make_enrolled_machine
@@ -584,6 +586,83 @@ class MunkiAPIViewsTestCase(TestCase):
              "last_seen_sha1sum": report_sha1sum}
         )
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_raw_event")
+    @patch("zentral.contrib.munki.public_views.async_postflight", True)
+    def test_post_job_async_postflight(self, post_raw_event):
+        enrolled_machine = make_enrolled_machine(enrollment=self.enrollment)
+        computer_name = get_random_string(45)
+        response = self._post_as_json(reverse("munki_public:post_job"),
+                                      {"machine_snapshot": {"serial_number": enrolled_machine.serial_number,
+                                                            "system_info": {"computer_name": computer_name}},
+                                       "last_seen_report_found": True,
+                                       "managed_installs": [["YoloApp", "1.2.3", "Yolo App",
+                                                             "2021-11-15T14:47:37+00:00"]],
+                                       "reports": [{"start_time": "2018-01-01 00:00:00 +0000",
+                                                    "end_time": "2018-01-01 00:01:00 +0000",
+                                                    "basename": "report2018",
+                                                    "run_type": "auto",
+                                                    "sha1sum": 40 * "0",
+                                                    "events": [("2021-11-15T14:47:37Z",
+                                                                {"name": "YoloApp",
+                                                                 "display_name": "Yolo App",
+                                                                 "version": "1.2.3",
+                                                                 "status": 0,
+                                                                 "type": "install"})]}]},
+                                      HTTP_AUTHORIZATION="MunkiEnrolledMachine {}".format(enrolled_machine.token))
+        self.assertEqual(response.status_code, 200)
+
+        # nothing processed in the request
+        post_raw_event.assert_called_once()
+        routing_key, raw_event = post_raw_event.call_args.args
+        self.assertEqual(routing_key, "munki_postflight")
+        self.assertEqual(raw_event["machine_serial_number"], enrolled_machine.serial_number)
+        self.assertEqual(raw_event["enrollment"], {"pk": self.enrollment.pk})
+        self.assertFalse(MachineSnapshot.objects.filter(serial_number=enrolled_machine.serial_number).exists())
+        self.assertFalse(MunkiState.objects.filter(machine_serial_number=enrolled_machine.serial_number).exists())
+        mi_qs = ManagedInstall.objects.filter(machine_serial_number=enrolled_machine.serial_number)
+        self.assertEqual(mi_qs.count(), 0)
+
+        # process the raw event, after a round trip through the queue serializer
+        preprocessor = PostflightPreprocessor()
+        self.assertEqual(preprocessor.routing_key, routing_key)
+        events = list(preprocessor.process_raw_event(json.loads(json.dumps(raw_event))))
+
+        # machine snapshot
+        ms = MachineSnapshot.objects.current().get(serial_number=enrolled_machine.serial_number)
+        self.assertEqual(ms.system_info.computer_name, computer_name)
+        self.assertTrue(any(isinstance(e, AddMachine) for e in events))
+
+        # managed installs
+        self.assertEqual(mi_qs.count(), 1)
+        mi = mi_qs.first()
+        self.assertEqual(mi.name, "YoloApp")
+        self.assertEqual(mi.installed_version, "1.2.3")
+
+        # munki state
+        munki_state = MunkiState.objects.get(machine_serial_number=enrolled_machine.serial_number)
+        self.assertEqual(munki_state.sha1sum, 40 * "0")
+        self.assertIsNotNone(munki_state.last_managed_installs_sync)
+
+        # munki events
+        request_event = events[-2]
+        self.assertIsInstance(request_event, MunkiRequestEvent)
+        self.assertEqual(request_event.payload["request_type"], "postflight")
+        self.assertEqual(request_event.payload["managed_install_count"], 1)
+        self.assertEqual(request_event.metadata.request.ip, raw_event["request"]["ip"])
+        install_event = events[-1]
+        self.assertIsInstance(install_event, MunkiInstallEvent)
+        self.assertEqual(install_event.metadata.machine_serial_number, enrolled_machine.serial_number)
+
+    def test_postflight_preprocessor_unknown_enrollment(self):
+        raw_event = {"request": {"user_agent": "yolo", "ip": "127.0.0.1"},
+                     "machine_serial_number": get_random_string(12),
+                     "enrollment": {"pk": 0},
+                     "business_unit": None,
+                     "request_time": datetime.utcnow().isoformat(),
+                     "data": {"machine_snapshot": {}, "reports": []}}
+        with self.assertLogs("zentral.contrib.munki.preprocessors", level="ERROR"):
+            self.assertEqual(list(PostflightPreprocessor().process_raw_event(raw_event)), [])
+
     @patch("zentral.contrib.munki.public_views.post_machine_snapshot_raw_event")
     def test_post_job_duplicated_profile(self, post_machine_snapshot_raw_event):
         def store_mstree(ms_tree):
@@ -0,0 +1,219 @@
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from django.utils import timezone
+from zentral.contrib.osquery.cache import ConfigurationCache, DistributedQueryIndex, IndexedDistributedQuery
+
+
+class DistributedQueryIndexTestCase(SimpleTestCase):
+    enrolled_machine = SimpleNamespace(serial_number="12345678",
+                                       platforms=["darwin", "posix"],
+                                       osquery_version_tuple=(5, 10, 2))
+
+    def build_indexed_dq(self, pk, **kwargs):
+        now = timezone.now()
+        attrs = {
+            "pk": pk,
+            "valid_from": now - timedelta(hours=1),
+            "valid_until": now + timedelta(hours=1),
+            "platforms": frozenset(),
+            "serial_numbers": frozenset(),
+            "tag_ids": frozenset(),
+            "minimum_osquery_version_tuple": (0, 0, 0),
+            "shard": 100,
+        }
+        attrs.update(kwargs)
+        return IndexedDistributedQuery(**attrs)
+
+    def get_index(self, *dqs, **kwargs):
+        index = DistributedQueryIndex(with_sync=True, **kwargs)
+        index._load = Mock(return_value=list(dqs))
+        return index
+
+    def test_disabled(self):
+        index = DistributedQueryIndex()
+        index._load = Mock()
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), (None, None))
+        index._load.assert_not_called()
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_no_distributed_queries(self, notifier):
+        index = self.get_index()
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([], 0))
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([], 0))
+        index._load.assert_called_once()
+        notifier.add_callback.assert_called_once()
+        self.assertEqual(index.get_counters(), {"no_candidates": 2})
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_candidate_filters(self, notifier):
+        now = timezone.now()
+        index = self.get_index(
+            self.build_indexed_dq(1),
+            self.build_indexed_dq(2, valid_from=now + timedelta(minutes=1)),
+            self.build_indexed_dq(3, valid_until=now - timedelta(minutes=1)),
+            self.build_indexed_dq(4, platforms=frozenset(["windows"])),
+            self.build_indexed_dq(5, platforms=frozenset(["darwin"])),
+            self.build_indexed_dq(6, serial_numbers=frozenset(["87654321"])),
+            self.build_indexed_dq(7, serial_numbers=frozenset(["12345678"])),
+            self.build_indexed_dq(8, minimum_osquery_version_tuple=(5, 11, 0)),
+            self.build_indexed_dq(9, minimum_osquery_version_tuple=(5, 10, 2)),
+            self.build_indexed_dq(10, valid_until=None),
+        )
+        get_tag_ids = Mock()
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, get_tag_ids), ([1, 5, 7, 9, 10], 0))
+        get_tag_ids.assert_not_called()
+
+    @patch("zentral.contrib.osquery.cache.shard")
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_candidate_shard(self, notifier, shard):
+        shard.return_value = 50
+        index = self.get_index(
+            self.build_indexed_dq(1, shard=49),
+            self.build_indexed_dq(2, shard=50),
+        )
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([2], 0))
+        shard.assert_called_with("12345678", 2)
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_candidate_tags(self, notifier):
+        index = self.get_index(
+            self.build_indexed_dq(1, tag_ids=frozenset([1, 2])),
+            self.build_indexed_dq(2, tag_ids=frozenset([3])),
+            self.build_indexed_dq(3),
+        )
+        get_tag_ids = Mock(return_value=iter([2]))
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, get_tag_ids), ([1, 3], 0))
+        get_tag_ids.assert_called_once_with()
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_not_pending_pks(self, notifier):
+        index = self.get_index(self.build_indexed_dq(1), self.build_indexed_dq(2))
+        candidate_pks, generation = index.get_candidate_pks(self.enrolled_machine, Mock())
+        self.assertEqual(candidate_pks, [1, 2])
+        index.set_not_pending_pks("12345678", [1], generation)
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([2], 0))
+        index.set_not_pending_pks("12345678", [2], generation)
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([], 0))
+        other_machine = SimpleNamespace(serial_number="87654321", platforms=["darwin"],
+                                        osquery_version_tuple=(5, 10, 2))
+        self.assertEqual(index.get_candidate_pks(other_machine, Mock()), ([1, 2], 0))
+
+    @patch("zentral.contrib.osquery.cache.time.monotonic")
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_ttls(self, notifier, monotonic):
+        monotonic.return_value = 100
+        index = self.get_index(self.build_indexed_dq(1), ttl=10, machine_ttl=5)
+        candidate_pks, generation = index.get_candidate_pks(self.enrolled_machine, Mock())
+        index.set_not_pending_pks("12345678", candidate_pks, generation)
+        monotonic.return_value = 104
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([], 0))
+        monotonic.return_value = 105
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([1], 0))
+        index._load.assert_called_once()
+        monotonic.return_value = 110
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([1], 0))
+        self.assertEqual(index._load.call_count, 2)
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_max_machines(self, notifier):
+        index = self.get_index(self.build_indexed_dq(1), max_machines=2)
+        for serial_number in ("1", "2", "3"):
+            index.set_not_pending_pks(serial_number, [1], 0)
+        self.assertEqual(list(index._machines.keys()), ["2", "3"])
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_invalidated_during_fetch(self, notifier):
+        index = self.get_index(self.build_indexed_dq(1))
+        candidate_pks, generation = index.get_candidate_pks(self.enrolled_machine, Mock())
+        index.invalidate()
+        index.set_not_pending_pks("12345678", candidate_pks, generation)
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([1], 1))
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_invalidate(self, notifier):
+        index = self.get_index(self.build_indexed_dq(1))
+        candidate_pks, generation = index.get_candidate_pks(self.enrolled_machine, Mock())
+        index.set_not_pending_pks("12345678", candidate_pks, generation)
+        index.invalidate()
+        notifier.send_notification.assert_called_once_with("osquery.distributed_query")
+        self.assertEqual(index.get_candidate_pks(self.enrolled_machine, Mock()), ([1], 1))
+        self.assertEqual(index._load.call_count, 2)
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_notification(self, notifier):
+        index = self.get_index(self.build_indexed_dq(1))
+        index.get_candidate_pks(self.enrolled_machine, Mock())
+        index._notification_handler("")
+        index.get_candidate_pks(self.enrolled_machine, Mock())
+        self.assertEqual(index._load.call_count, 2)
+        notifier.send_notification.assert_not_called()
+
+
+class ConfigurationCacheTestCase(SimpleTestCase):
+    key = (("MACOS", False), frozenset([1]))
+
+    def test_disabled(self):
+        cache = ConfigurationCache()
+        self.assertFalse(cache.enabled)
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_set_get(self, notifier):
+        cache = ConfigurationCache(with_sync=True)
+        self.assertEqual(cache.get_relevant_tag_ids(1), (None, 0))
+        notifier.add_callback.assert_called_once()
+        # no configuration entry, response not cached
+        cache.set_response(1, self.key, (b"{}", "etag"), 0)
+        self.assertIsNone(cache.get_response(1, self.key))
+        cache.set_relevant_tag_ids(1, {1, 2}, 0)
+        self.assertEqual(cache.get_relevant_tag_ids(1), (frozenset([1, 2]), 0))
+        cache.set_response(1, self.key, (b"{}", "etag"), 0)
+        self.assertEqual(cache.get_response(1, self.key), (b"{}", "etag"))
+        self.assertIsNone(cache.get_response(1, (None, frozenset())))
+        self.assertIsNone(cache.get_response(2, self.key))
+        self.assertEqual(cache.get_counters(), {"hits": 1, "misses": 3})
+
+    @patch("zentral.contrib.osquery.cache.time.monotonic")
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_ttl(self, notifier, monotonic):
+        monotonic.return_value = 100
+        cache = ConfigurationCache(ttl=10, with_sync=True)
+        cache.set_relevant_tag_ids(1, set(), 0)
+        monotonic.return_value = 109
+        cache.set_response(1, self.key, (b"{}", "etag"), 0)
+        self.assertEqual(cache.get_response(1, self.key), (b"{}", "etag"))
+        monotonic.return_value = 110
+        # expiry not extended by the response update
+        self.assertIsNone(cache.get_response(1, self.key))
+        self.assertEqual(cache.get_relevant_tag_ids(1), (None, 0))
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_max_responses(self, notifier):
+        cache = ConfigurationCache(max_responses=2, with_sync=True)
+        cache.set_relevant_tag_ids(1, set(), 0)
+        for i in range(3):
+            cache.set_response(1, i, (b"{}", str(i)), 0)
+        self.assertIsNone(cache.get_response(1, 0))
+        self.assertEqual(cache.get_response(1, 1), (b"{}", "1"))
+        self.assertEqual(cache.get_response(1, 2), (b"{}", "2"))
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_invalidated_during_rendering(self, notifier):
+        cache = ConfigurationCache(with_sync=True)
+        _, generation = cache.get_relevant_tag_ids(1)
+        cache.set_relevant_tag_ids(1, set(), generation)
+        cache.invalidate()
+        notifier.send_notification.assert_called_once_with("osquery.configuration")
+        self.assertEqual(cache.get_relevant_tag_ids(1), (None, 1))
+        cache.set_relevant_tag_ids(1, set(), generation)
+        self.assertEqual(cache.get_relevant_tag_ids(1), (None, 1))
+
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_notification(self, notifier):
+        cache = ConfigurationCache(with_sync=True)
+        cache.set_relevant_tag_ids(1, set(), 0)
+        cache.set_response(1, self.key, (b"{}", "etag"), 0)
+        cache._notification_handler("")
+        self.assertIsNone(cache.get_response(1, self.key))
+        notifier.send_notification.assert_not_called()
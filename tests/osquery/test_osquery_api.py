@@ -11,6 +11,7 @@ from zentral.conf import settings
 from zentral.contrib.inventory.events import MachineTagEvent
 from zentral.contrib.inventory.models import EnrollmentSecret, MachineSnapshot, MachineTag, MetaBusinessUnit, Tag
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
+from zentral.contrib.osquery.cache import ConfigurationCache, DistributedQueryIndex
 from zentral.contrib.osquery.compliance_checks import sync_query_compliance_check
 from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
 from zentral.contrib.osquery.events import (OsqueryEnrollmentEvent, OsqueryRequestEvent, OsqueryResultEvent,
@@ -469,6 +470,43 @@ class OsqueryAPIViewsTestCase(TestCase):
                         'removed': False}}}}
         )
 
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_config_cached(self, notifier):
+        cache = ConfigurationCache(with_sync=True)
+        tag = Tag.objects.create(name=get_random_string(12))
+        query, pack, _ = self.force_query(force_pack=True)
+        cp = ConfigurationPack.objects.create(configuration=self.configuration, pack=pack)
+        cp.tags.add(tag)
+        tagged_em = self.force_enrolled_machine()
+        MachineTag.objects.create(serial_number=tagged_em.serial_number, tag=tag)
+        em = self.force_enrolled_machine()
+        tagged_em2 = self.force_enrolled_machine()
+        MachineTag.objects.create(serial_number=tagged_em2.serial_number, tag=tag)
+        with patch("zentral.contrib.osquery.conf.configuration_cache", cache), \
+             patch("zentral.contrib.osquery.models.configuration_cache", cache):
+            tagged_response = self.post_as_json("config", {"node_key": tagged_em.node_key})
+            self.assertEqual(tagged_response.status_code, 200)
+            self.assertEqual(tagged_response["Content-Type"], "application/json")
+            self.assertIn(f"{pack.slug}/{pack.pk}", tagged_response.json()["packs"])
+            response = self.post_as_json("config", {"node_key": em.node_key})
+            self.assertNotIn("packs", response.json())
+            self.assertNotEqual(response["ETag"], tagged_response["ETag"])
+            # same configuration, inventory options and relevant tags, cached response
+            response = self.post_as_json("config", {"node_key": tagged_em2.node_key})
+            self.assertEqual(response.content, tagged_response.content)
+            self.assertEqual(response["ETag"], tagged_response["ETag"])
+            self.assertEqual(cache.get_counters(), {"hits": 1, "misses": 2})
+            # pack updated, cache invalidated on commit
+            with self.captureOnCommitCallbacks(execute=True):
+                pack.discovery_queries = ["select 1 from users;"]
+                pack.save()
+            notifier.send_notification.assert_called_once_with("osquery.configuration")
+            response = self.post_as_json("config", {"node_key": tagged_em2.node_key})
+            self.assertEqual(response.json()["packs"][f"{pack.slug}/{pack.pk}"]["discovery"],
+                             ["select 1 from users;"])
+            self.assertNotEqual(response["ETag"], tagged_response["ETag"])
+            self.assertEqual(cache.get_counters(), {"hits": 1, "misses": 3})
+
     def test_config_disable_carver_true_str(self):
         self.configuration.options = {"disable_carver": "true"}
         self.configuration.save()
@@ -831,6 +869,45 @@ class OsqueryAPIViewsTestCase(TestCase):
         self.assertEqual(json_response, {"queries": {}})
         self.assertEqual(dqm_qs.count(), 2)
 
+    @patch("zentral.contrib.osquery.cache.notifier")
+    def test_distributed_read_index(self, notifier):
+        index = DistributedQueryIndex(with_sync=True)
+        em = self.force_enrolled_machine(osquery_version="17.0.0", platform_mask=21)
+        tag = Tag.objects.create(name=get_random_string(12))
+        with patch("zentral.contrib.osquery.public_views.distributed_query_index", index), \
+             patch("zentral.contrib.osquery.models.distributed_query_index", index), \
+             patch.object(DistributedQuery.objects, "iter_queries_for_enrolled_machine",
+                          wraps=DistributedQuery.objects.iter_queries_for_enrolled_machine) as iter_queries:
+            DistributedQuery.objects.create(sql="select * from users;",
+                                            platforms=["linux"],  # wrong platform
+                                            valid_from=datetime.utcnow(),
+                                            query_version=1)
+            tagged_dq = DistributedQuery.objects.create(sql="select * from osquery_info;",
+                                                        valid_from=datetime.utcnow(),
+                                                        query_version=1)
+            tagged_dq.tags.add(tag)  # machine not tagged
+            # no candidates, no distributed queries lookup
+            response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+            self.assertEqual(response.json(), {"queries": {}})
+            iter_queries.assert_not_called()
+            # new distributed query, index invalidated on commit
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                dq = DistributedQuery.objects.create(sql="select username from users;",
+                                                     valid_from=datetime.utcnow(),
+                                                     query_version=1)
+            self.assertEqual(len(callbacks), 1)
+            notifier.send_notification.assert_called_once_with("osquery.distributed_query")
+            response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+            dqm = DistributedQueryMachine.objects.get(serial_number=em.serial_number)
+            self.assertEqual(dqm.distributed_query, dq)
+            self.assertEqual(response.json(), {"queries": {str(dqm.pk): dq.sql}})
+            iter_queries.assert_called_once()
+            self.assertEqual(iter_queries.call_args.args[2], [dq.pk])
+            # query not pending anymore, no distributed queries lookup
+            response = self.post_as_json("distributed_read", {"node_key": em.node_key})
+            self.assertEqual(response.json(), {"queries": {}})
+            iter_queries.assert_called_once()
+
     def test_distributed_write_405(self):
         response = self.client.get(reverse("osquery_public:distributed_write"))
         self.assertEqual(response.status_code, 405)
@@ -428,6 +428,141 @@ class SantaRuleEngineTestCase(TestCase):
         self.assertIsNone(response_cursor)
         self.assertEqual(machine_rule_qs.filter(cursor__isnull=True).count(), 6)
 
+    def test_next_rule_batch_constant_query_count(self):
+        for _ in range(6):
+            self.create_rule()
+        # 1 rules digest, 1 cleanup delete, 1 configuration, 1 rules CTE, 1 machine rules upsert
+        with self.assertNumQueries(5):
+            rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(len(rule_batch), 5)
+        # 1 rules digest, 1 cleanup delete, 1 REMOVE delete, 1 ack update, 1 rules CTE, 1 machine rules upsert
+        with self.assertNumQueries(6):
+            rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(
+                self.enrolled_machine, [], response_cursor
+            )
+        self.assertEqual(len(rule_batch), 1)
+        self.assertEqual(MachineRule.objects.filter(enrolled_machine=self.enrolled_machine,
+                                                    cursor=response_cursor).count(), 1)
+        self.assertEqual(MachineRule.objects.filter(enrolled_machine=self.enrolled_machine,
+                                                    cursor__isnull=True).count(), 5)
+
+    # rules digest
+
+    def sync_all_rules(self, tags=None):
+        if tags is None:
+            tags = []
+        response_cursor = None
+        while True:
+            rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(
+                self.enrolled_machine, tags, response_cursor
+            )
+            if not response_cursor:
+                break
+
+    def test_rules_digest_in_sync(self):
+        self.create_rule()
+        self.sync_all_rules()
+        self.enrolled_machine.refresh_from_db()
+        self.assertIsNotNone(self.enrolled_machine.rules_digest)
+        # 1 rules digest
+        with self.assertNumQueries(1):
+            rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [])
+        self.assertIsNone(response_cursor)
+
+    def test_rules_digest_rule_created(self):
+        self.create_rule()
+        self.sync_all_rules()
+        self.assertEqual(self.configuration.rules_version + 1,
+                         Configuration.objects.get(pk=self.configuration.pk).rules_version)
+        _, _, serialized_rule = self.create_and_serialize_rule()
+        rule_batch, response_cursor = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [serialized_rule])
+        self.enrolled_machine.refresh_from_db()
+        self.assertIsNone(self.enrolled_machine.rules_digest)
+
+    def test_rules_digest_rule_updated(self):
+        target, rule = self.create_rule()
+        self.sync_all_rules()
+        rule.policy = Rule.Policy.BLOCKLIST
+        rule.version = F("version") + 1
+        rule.save()
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [{"rule_type": target.type,
+                                       "identifier": target.identifier,
+                                       "policy": "BLOCKLIST"}])
+
+    def test_rules_digest_rule_deleted(self):
+        target, rule = self.create_rule()
+        self.sync_all_rules()
+        rule.delete()
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [{"rule_type": target.type,
+                                       "identifier": target.identifier,
+                                       "policy": "REMOVE"}])
+
+    def test_rules_digest_rule_tags_changed(self):
+        target, rule = self.create_rule()
+        self.sync_all_rules()
+        tag = Tag.objects.create(name=get_random_string(12))
+        rule.excluded_tags.add(tag)
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [tag.pk])
+        self.assertEqual(rule_batch, [{"rule_type": target.type,
+                                       "identifier": target.identifier,
+                                       "policy": "REMOVE"}])
+
+    def test_rules_digest_tag_deleted(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        target, rule = self.create_rule()
+        rule.tags.add(tag)
+        self.sync_all_rules()
+        self.assertEqual(self.enrolled_machine.machinerule_set.count(), 0)
+        tag.delete()
+        # the rule is not scoped anymore
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(len(rule_batch), 1)
+
+    def test_rules_digest_machine_tags_changed(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        target, rule = self.create_rule()
+        rule.tags.add(tag)
+        self.sync_all_rules()
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [tag.pk])
+        self.assertEqual(len(rule_batch), 1)
+
+    def test_rules_digest_configuration_save(self):
+        self.create_rule()
+        self.sync_all_rules()
+        configuration = Configuration.objects.get(pk=self.configuration.pk)
+        rules_version = configuration.rules_version
+        self.create_rule()
+        # stale configuration instance
+        configuration.save()
+        self.assertEqual(Configuration.objects.get(pk=self.configuration.pk).rules_version, rules_version + 1)
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(len(rule_batch), 1)
+
+    def test_rules_digest_santa_version_upgraded(self):
+        target = Target.objects.create(type=Target.Type.BINARY, identifier=new_sha256())
+        Rule.objects.create(
+            configuration=self.configuration,
+            target=target,
+            policy=Rule.Policy.CEL,
+            cel_expr="target.signing_time >= timestamp('2025-05-31T00:00:00Z')",
+        )
+        self.sync_all_rules()
+        self.enrolled_machine.refresh_from_db()
+        self.assertIsNotNone(self.enrolled_machine.rules_digest)
+        self.assertEqual(self.enrolled_machine.machinerule_set.count(), 0)
+        # santa upgraded, the CEL rule must be delivered
+        self.enrolled_machine.santa_version = "2025.6"
+        self.enrolled_machine.save()
+        rule_batch, _ = MachineRule.objects.get_next_rule_batch(self.enrolled_machine, [])
+        self.assertEqual(rule_batch, [{"rule_type": target.type,
+                                       "identifier": target.identifier,
+                                       "policy": "CEL",
+                                       "cel_expr": "target.signing_time >= timestamp('2025-05-31T00:00:00Z')"}])
+
     def test_lost_response_batch_pagination(self):
         serialized_rules = []
         for _ in range(11):
@@ -1,8 +1,10 @@
 from io import StringIO
 import json
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
+from base.management.commands.runworkers import Command
 from zentral.core.stores.conf import stores
 from zentral.utils.provisioning import provision
 
@@ -49,3 +51,77 @@ class RunWorkersBaseManagementCommandsTest(TestCase):
         # TODO: better tests
         start.assert_called_once()
         watch_workers.assert_called_once()
+
+    @patch("base.management.commands.runworkers.Command.watch_workers")
+    @patch("base.management.commands.runworkers.Process.start")
+    @patch("zentral.utils.prometheus.PrometheusMetricsExporter")
+    def test_start_worker_replicas_prometheus_ports(self, pme, start, watch_workers):
+        call_command('runworkers', 'enrich worker', 'process worker',
+                     '--replicas', 'enrich worker=3',
+                     '--prometheus', '--prometheus-base-port', '9910', '--prometheus-replica-port-offset', '50')
+        self.assertEqual(start.call_count, 4)
+        # enrich worker idx = 1, process worker idx = 2
+        self.assertEqual(
+            sorted(c.args[0] for c in pme.call_args_list),
+            [9911, 9912, 9961, 10011]
+        )
+        watch_workers.assert_called_once()
+
+    def test_invalid_replicas(self):
+        for replicas in ("enrich worker", "enrich worker=0", "=2", "enrich worker=yolo"):
+            with self.assertRaises(CommandError) as cm:
+                call_command('runworkers', 'enrich worker', '--replicas', replicas)
+            self.assertEqual(cm.exception.args[0], f"Invalid replicas specification: '{replicas}'")
+
+    def test_invalid_autoscaling_max_replicas(self):
+        with self.assertRaises(CommandError) as cm:
+            call_command('runworkers', 'enrich worker', '--autoscaling', '--autoscaling-max-replicas', '0')
+        self.assertEqual(cm.exception.args[0], "Invalid autoscaling max replicas")
+
+    def get_autoscaling_command(self, current_replicas, min_replicas=1):
+        command = Command()
+        command.replicas = {"enrich worker": min_replicas}
+        command.autoscaling = True
+        command.autoscaling_max_replicas = 4
+        command.autoscaling_messages_per_replica = 1000
+        command.autoscaling_interval = 30
+        command.prometheus = False
+        command.statsd = False
+        worker = Mock()
+        worker.name = "enrich worker"
+        command.workers = {1: worker}
+        command.processes = {(1, replica): (worker, Mock()) for replica in range(current_replicas)}
+        return command, worker
+
+    @patch("base.management.commands.runworkers.queues")
+    def test_autoscaling_desired_replica_count(self, queues):
+        for queue_depth, current_replicas, min_replicas, desired_replicas in (
+            (None, 2, 1, 2),  # queue depth not available
+            (0, 1, 1, 1),
+            (1, 1, 1, 1),
+            (2500, 1, 1, 3),  # scale up at once
+            (100000, 1, 1, 4),  # max replicas
+            (0, 3, 1, 2),  # scale down progressively
+            (0, 2, 2, 2),  # min replicas
+        ):
+            queues.get_worker_queue_depth.return_value = queue_depth
+            command, worker = self.get_autoscaling_command(current_replicas, min_replicas)
+            self.assertEqual(command.get_desired_replica_count(1, worker), desired_replicas)
+
+    @patch("base.management.commands.runworkers.queues")
+    @patch("base.management.commands.runworkers.Process")
+    def test_autoscale_workers(self, process, queues):
+        queues.get_worker_queue_depth.return_value = 2500
+        command, worker = self.get_autoscaling_command(1)
+        command.autoscale_workers()
+        self.assertEqual(sorted(command.processes.keys()), [(1, 0), (1, 1), (1, 2)])
+        self.assertEqual(process.return_value.start.call_count, 2)
+        # interval not reached
+        queues.get_worker_queue_depth.return_value = 0
+        command.autoscale_workers()
+        self.assertEqual(len(command.processes), 3)
+        # interval reached
+        command.last_autoscaling -= 31
+        command.autoscale_workers()
+        self.assertEqual(sorted(command.processes.keys()), [(1, 0), (1, 1)])
+        process.return_value.terminate.assert_called_once_with()
@@ -1,6 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest.mock import patch
+import uuid
 from django.test import SimpleTestCase
-from zentral.utils.json import prepare_loaded_plist, remove_null_character
+from kombu.utils import json as kombu_json
+from zentral.utils.json import dumps, dumps_bytes, prepare_loaded_plist, remove_null_character
 
 
 class JsonUtilsTestCase(SimpleTestCase):
@@ -32,3 +36,53 @@ class JsonUtilsTestCase(SimpleTestCase):
              4: [1, "deux", 3],
              "cinq": [{5: True}]}
         )
+
+    def assert_dumps_bytes_kombu_compatible(self):
+        data = dumps_bytes({"un": 1,
+                            "deux": datetime(2000, 1, 1, tzinfo=timezone.utc),
+                            "trois": Decimal("3.3"),
+                            4: [None, True, "quatre"]})
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(
+            kombu_json.loads(data),
+            {"un": 1,
+             "deux": datetime(2000, 1, 1, tzinfo=timezone.utc),
+             "trois": Decimal("3.3"),
+             "4": [None, True, "quatre"]}
+        )
+
+    def test_dumps_bytes(self):
+        self.assert_dumps_bytes_kombu_compatible()
+
+    @patch("zentral.utils.json.orjson", None)
+    def test_dumps_bytes_stdlib_fallback(self):
+        self.assert_dumps_bytes_kombu_compatible()
+
+    def test_dumps_compact_utf8(self):
+        self.assertEqual(dumps({"un": ["é", 1]}), '{"un":["é",1]}')
+
+    @patch("zentral.utils.json.orjson", None)
+    def test_dumps_compact_utf8_stdlib_fallback(self):
+        self.assertEqual(dumps({"un": ["é", 1]}), '{"un":["é",1]}')
+
+    def test_dumps_big_int(self):
+        self.assertEqual(kombu_json.loads(dumps({"un": 2**70})), {"un": 2**70})
+
+    def test_dumps_uuid_big_int(self):
+        obj_uuid = uuid.UUID("5d4dcb2a-bc5b-4bb4-a1a1-1d3f5a7a9e9c")
+        self.assertEqual(
+            dumps({"un": obj_uuid}),
+            '{"un":"5d4dcb2a-bc5b-4bb4-a1a1-1d3f5a7a9e9c"}'
+        )
+        # big int, orjson error, stdlib fallback with the same UUID format
+        self.assertEqual(
+            dumps({"un": obj_uuid, "deux": 2**70}),
+            '{"un":"5d4dcb2a-bc5b-4bb4-a1a1-1d3f5a7a9e9c","deux":1180591620717411303424}'
+        )
+
+    @patch("zentral.utils.json.orjson", None)
+    def test_dumps_uuid_stdlib_fallback(self):
+        self.assertEqual(
+            dumps({"un": uuid.UUID("5d4dcb2a-bc5b-4bb4-a1a1-1d3f5a7a9e9c")}),
+            '{"un":"5d4dcb2a-bc5b-4bb4-a1a1-1d3f5a7a9e9c"}'
+        )
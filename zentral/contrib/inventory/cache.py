@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from base.notifier import notifier
+
+
+logger = logging.getLogger("zentral.contrib.inventory.cache")
+
+
+class MachineFilteringValuesCache:
+    """
+    Process-wide LRU / TTL cache of the machine probe filtering values, keyed by serial number.
+
+    The entries are invalidated across the processes with notifications on the
+    'inventory.machine' channel. Without sync, the cache is disabled.
+    """
+    channel = "inventory.machine"
+
+    def __init__(self, max_size=10000, ttl=300, with_sync=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.with_sync = with_sync
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._sync_started = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.with_sync
+
+    def _start_sync(self):
+        if not self._sync_started:
+            notifier.add_callback(self.channel, weakref.WeakMethod(self._notification_handler))
+            self._sync_started = True
+
+    def _notification_handler(self, data):
+        self.clear(data or None)
+
+    def get(self, serial_number):
+        """Returns the cached values, and the generation to use to set them"""
+        if not self.enabled:
+            return None, None
+        with self._lock:
+            self._start_sync()
+            generation = self._generation
+            entry = self._entries.get(serial_number)
+            if entry is not None:
+                expiry, values = entry
+                if expiry > time.monotonic():
+                    self._entries.move_to_end(serial_number)
+                    self.hits += 1
+                    return values, generation
+                del self._entries[serial_number]
+            self.misses += 1
+            return None, generation
+
+    def set(self, serial_number, values, generation):
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation != self._generation:
+                # invalidated while the values were fetched
+                return
+            self._entries[serial_number] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(serial_number)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self, serial_number=None):
+        with self._lock:
+            self._generation += 1
+            if serial_number is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(serial_number, None)
+
+    def invalidate(self, serial_number=None):
+        """Clear the local entries, and notify the other processes"""
+        self.clear(serial_number)
+        if self.enabled:
+            notifier.send_notification(self.channel, serial_number or "")
+
+    def get_counters(self):
+        return {"hit": self.hits, "miss": self.misses}
+
+    def get_stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+zentral_inventory_sync = os.environ.get("ZENTRAL_INVENTORY_SYNC", "1") == "1"
+
+
+machine_filtering_values_cache = MachineFilteringValuesCache(with_sync=zentral_inventory_sync)
@@ -1,9 +1,10 @@
 import base64
-from collections import Counter
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 import json
 import logging
 import re
+import threading
 import urllib.parse
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -14,6 +15,7 @@ from django.urls import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import connection, IntegrityError, models, transaction
 from django.db.models import Count, F, Q, Max
+from django.db.models.signals import post_delete, post_save
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
@@ -27,6 +29,7 @@ from zentral.core.incidents.models import MachineIncident, Status
 from zentral.utils.model_extras import find_all_related_objects
 from zentral.utils.mt_models import (prepare_commit_tree,
                                      AbstractMTObject, MTObjectManager, MTOError)
+from .cache import machine_filtering_values_cache
 from .conf import (has_deb_packages,
                    os_version_display, os_version_version_display,
                    update_ms_tree_platform, update_ms_tree_type,
@@ -681,7 +684,94 @@ class MachineSnapshot(AbstractMTObject):
         return list(self.ec2_instance_tags.all().order_by("key", "value"))
 
 
+class MachineSnapshotCommitCache:
+    """
+    In-process cache of the last machine snapshot commit for each serial number and source.
+
+    Entries are only set once the commit transaction is committed, and are
+    verified on use by the CurrentMachineSnapshot update.
+    """
+    max_size = 10000
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter({"hits": 0, "misses": 0, "fallbacks": 0})
+
+    @staticmethod
+    def get_key(tree):
+        try:
+            return tree['serial_number'], tree['source']['mt_hash']
+        except (KeyError, TypeError):
+            return None
+
+    def get(self, key, mt_hash):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["mt_hash"] != mt_hash:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry
+
+    def set(self, key, machine_snapshot_commit):
+        entry = {"mt_hash": machine_snapshot_commit.machine_snapshot.mt_hash,
+                 "machine_snapshot": machine_snapshot_commit.machine_snapshot,
+                 "msc_pk": machine_snapshot_commit.pk,
+                 "version": machine_snapshot_commit.version,
+                 "last_seen": machine_snapshot_commit.last_seen,
+                 "system_uptime": machine_snapshot_commit.system_uptime}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+machine_snapshot_commit_cache = MachineSnapshotCommitCache()
+
+
 class MachineSnapshotCommitManager(models.Manager):
+    def _commit_cached_machine_snapshot_tree(self, entry, last_seen, system_uptime):
+        # identical tree → no MachineSnapshot commit and no MachineSnapshotCommit lookup
+        machine_snapshot = entry["machine_snapshot"]
+        new_msc = None
+        with transaction.atomic():
+            updated = CurrentMachineSnapshot.objects.filter(
+                serial_number=machine_snapshot.serial_number,
+                source_id=machine_snapshot.source_id,
+                machine_snapshot=machine_snapshot,
+            ).update(last_seen=last_seen)
+            if not updated:
+                # stale cache entry
+                return None
+            if entry["last_seen"] != last_seen or entry["system_uptime"] != system_uptime:
+                # the last_seen is versioned, for the inventory heartbeats
+                # a conflict with a concurrent commit raises an IntegrityError
+                new_msc = MachineSnapshotCommit.objects.create(serial_number=machine_snapshot.serial_number,
+                                                               source_id=machine_snapshot.source_id,
+                                                               version=entry["version"] + 1,
+                                                               machine_snapshot=machine_snapshot,
+                                                               parent_id=entry["msc_pk"],
+                                                               last_seen=last_seen,
+                                                               system_uptime=system_uptime)
+        return new_msc, machine_snapshot, last_seen
+
     def commit_machine_snapshot_tree(self, tree):
         last_seen = tree.pop('last_seen', None)
         if not last_seen:
@@ -691,7 +781,32 @@ class MachineSnapshotCommitManager(models.Manager):
         system_uptime = tree.pop('system_uptime', None)
         update_ms_tree_platform(tree)
         update_ms_tree_type(tree)
-        machine_snapshot, _ = MachineSnapshot.objects.commit(tree)
+        prepare_commit_tree(tree)
+        cache_key = machine_snapshot_commit_cache.get_key(tree)
+        if cache_key:
+            entry = machine_snapshot_commit_cache.get(cache_key, tree['mt_hash'])
+            if entry:
+                try:
+                    result = self._commit_cached_machine_snapshot_tree(entry, last_seen, system_uptime)
+                except IntegrityError:
+                    result = None
+                if result:
+                    if result[0]:
+                        self._cache_on_commit(cache_key, result[0])
+                    return result
+                machine_snapshot_commit_cache.delete(cache_key)
+                machine_snapshot_commit_cache.counters["fallbacks"] += 1
+        result = self._commit_machine_snapshot_tree(tree, last_seen, system_uptime)
+        if cache_key and result[0]:
+            self._cache_on_commit(cache_key, result[0])
+        return result
+
+    @staticmethod
+    def _cache_on_commit(cache_key, machine_snapshot_commit):
+        transaction.on_commit(lambda: machine_snapshot_commit_cache.set(cache_key, machine_snapshot_commit))
+
+    def _commit_machine_snapshot_tree(self, tree, last_seen, system_uptime):
+        machine_snapshot, _ = MachineSnapshot.objects.bulk_commit(tree)
         serial_number = machine_snapshot.serial_number
         source = machine_snapshot.source
         new_version = new_parent = None
@@ -717,10 +832,14 @@ class MachineSnapshotCommitManager(models.Manager):
                                                                    parent=new_parent,
                                                                    last_seen=last_seen,
                                                                    system_uptime=system_uptime)
-                CurrentMachineSnapshot.objects.update_or_create(serial_number=serial_number,
-                                                                source=source,
-                                                                defaults={'machine_snapshot': machine_snapshot,
-                                                                          'last_seen': last_seen})
+                _, cms_created = CurrentMachineSnapshot.objects.update_or_create(
+                    serial_number=serial_number,
+                    source=source,
+                    defaults={'machine_snapshot': machine_snapshot,
+                              'last_seen': last_seen}
+                )
+                if cms_created or (new_msc and (not new_parent or new_parent.machine_snapshot != machine_snapshot)):
+                    transaction.on_commit(lambda: MetaMachine.invalidate_probe_filtering_values(serial_number))
                 return new_msc, machine_snapshot, last_seen
         except IntegrityError:
             msc = MachineSnapshotCommit.objects.get(serial_number=serial_number,
@@ -1134,6 +1253,7 @@ class MetaMachine:
 
     def archive(self):
         CurrentMachineSnapshot.objects.filter(serial_number=self.serial_number).delete()
+        transaction.on_commit(lambda: self.invalidate_probe_filtering_values(self.serial_number))
 
     def has_recent_source_snapshot(self, source_module, max_age=3600):
         query = (
@@ -1274,16 +1394,30 @@ class MetaMachine:
                 tag_ids.add(agg["id"])
         return (platform_fv, type_fv, mbu_ids, tag_ids)
 
+    @staticmethod
+    def _get_probe_filtering_values_cache_key(serial_number):
+        return "mm-probe-fvs_{}".format(MetaMachine.make_urlsafe_serial_number(serial_number))
+
     @cached_property
     def cached_probe_filtering_values(self):
         """Cached version of get_probe_filtering_values"""
-        cache_key = "mm-probe-fvs_{}".format(self.get_urlsafe_serial_number())
-        filtering_values = cache.get(cache_key)
+        filtering_values, generation = machine_filtering_values_cache.get(self.serial_number)
         if filtering_values is None:
-            filtering_values = self.get_probe_filtering_values()
-            cache.set(cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
+            cache_key = self._get_probe_filtering_values_cache_key(self.serial_number)
+            filtering_values = cache.get(cache_key)
+            if filtering_values is None:
+                filtering_values = self.get_probe_filtering_values()
+                cache.set(cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
+            machine_filtering_values_cache.set(self.serial_number, filtering_values, generation)
         return filtering_values
 
+    @staticmethod
+    def invalidate_probe_filtering_values(serial_number=None):
+        """Invalidate the cached probe filtering values of one or all the machines"""
+        if serial_number is not None:
+            cache.delete(MetaMachine._get_probe_filtering_values_cache_key(serial_number))
+        machine_filtering_values_cache.invalidate(serial_number)
+
     def get_legacy_serialized_info_for_event(self):
         """Serialize the machine information to be included in the events.
 
@@ -1668,3 +1802,23 @@ class JMESPathCheck(models.Model):
             "tags": sorted(str(tag) for tag in self.tags.select_related("taxonomy", "meta_business_unit").all()),
             "jmespath_expression": self.jmespath_expression,
         }
+
+
+# signals
+
+
+def invalidate_all_probe_filtering_values_signal_handler(sender, instance, **kwargs):
+    # the tags and the meta business unit tags are shared by many machines
+    transaction.on_commit(MetaMachine.invalidate_probe_filtering_values)
+
+
+def invalidate_all_probe_filtering_values_tag_post_save_handler(sender, instance, created, **kwargs):
+    # a new tag is not set on any machine yet
+    if not created:
+        invalidate_all_probe_filtering_values_signal_handler(sender, instance, **kwargs)
+
+
+post_save.connect(invalidate_all_probe_filtering_values_tag_post_save_handler, sender=Tag)
+post_delete.connect(invalidate_all_probe_filtering_values_signal_handler, sender=Tag)
+post_save.connect(invalidate_all_probe_filtering_values_signal_handler, sender=MetaBusinessUnitTag)
+post_delete.connect(invalidate_all_probe_filtering_values_signal_handler, sender=MetaBusinessUnitTag)
@@ -4,6 +4,7 @@ from django.db.models.query import QuerySet
 from django.utils.text import slugify
 import psycopg2.extras
 from zentral.contrib.inventory.events import MachineTagEvent
+from zentral.contrib.inventory.models import MetaMachine
 from zentral.core.events.base import EventMetadata, EventRequest
 from django.http import HttpRequest
 
@@ -35,6 +36,9 @@ def send_machine_tag_events(results, request: HttpRequest = None) -> None:
 def send_machine_tag_events_with_event_request(results, event_request: EventRequest = None) -> None:
     if not results:
         return
+    # called from the on_commit callbacks, after the machine tags updates
+    for serial_number in set(r[0] for r in results):
+        MetaMachine.invalidate_probe_filtering_values(serial_number)
     event_uuid = uuid.uuid4()
     event_index = 0
     for serial_number, action, pk, name, taxonomy_pk, taxonomy_name in results:
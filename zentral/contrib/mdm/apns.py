@@ -1,3 +1,4 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging
 import random
 import time
@@ -143,3 +144,81 @@ def send_enrolled_device_notification(enrolled_device, post_event=True):
     if post_event and event:
         event.post()
     return success, event
+
+
+# bulk utils
+
+
+def _send_target_notifications(targets, priority, expiration_seconds, max_workers, post_events):
+    in_flight = {}
+
+    def iter_results(futures):
+        for future in futures:
+            target, enrolled_device, user_id = in_flight.pop(future)
+            try:
+                success = future.result()
+            except Exception:
+                logger.exception("Could not notify enrolled %s %s", "device" if user_id is None else "user",
+                                 enrolled_device.pk if user_id is None else user_id)
+                success = False
+            event = build_mdm_device_notification_event(
+                enrolled_device.serial_number, enrolled_device.udid,
+                priority, expiration_seconds,
+                success, user_id
+            )
+            if post_events:
+                # the events are posted from the calling thread
+                event.post()
+            yield target, success, event
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="APNS notifications") as executor:
+        for target, enrolled_device, token, user_id in targets:
+            if not enrolled_device.can_be_poked() or not token:
+                yield target, None, None
+                continue
+            if len(in_flight) >= max_workers:
+                # bounded number of notifications in flight
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                yield from iter_results(done)
+            # one client per topic, the concurrent notifications are multiplexed over its HTTP/2 connection
+            client = apns_client_cache.get_or_create_with_push_cert(enrolled_device.push_certificate)
+            future = executor.submit(client.send_notification,
+                                     token, enrolled_device.push_magic, priority, expiration_seconds)
+            in_flight[future] = (target, enrolled_device, user_id)
+        yield from iter_results(wait(in_flight).done)
+
+
+def send_enrolled_device_notifications(
+    enrolled_devices,
+    priority=10, expiration_seconds=3600,
+    max_workers=20, post_events=True
+):
+    """Sends the notifications to the enrolled devices concurrently
+
+    Yields (enrolled device, success, event) tuples, in completion order.
+    success and event are None if the enrolled device cannot be poked.
+    The events are posted as the notifications complete, if post_events is True.
+    """
+    yield from _send_target_notifications(
+        ((enrolled_device, enrolled_device, enrolled_device.token, None)
+         for enrolled_device in enrolled_devices),
+        priority, expiration_seconds, max_workers, post_events
+    )
+
+
+def send_enrolled_user_notifications(
+    enrolled_users,
+    priority=10, expiration_seconds=3600,
+    max_workers=20, post_events=True
+):
+    """Sends the notifications to the enrolled users concurrently
+
+    Yields (enrolled user, success, event) tuples, in completion order.
+    success and event are None if the enrolled user cannot be poked.
+    The events are posted as the notifications complete, if post_events is True.
+    """
+    yield from _send_target_notifications(
+        ((enrolled_user, enrolled_user.enrolled_device, enrolled_user.token, enrolled_user.user_id)
+         for enrolled_user in enrolled_users),
+        priority, expiration_seconds, max_workers, post_events
+    )
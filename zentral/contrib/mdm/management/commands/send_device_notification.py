@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 from zentral.contrib.mdm.models import EnrolledDevice
-from zentral.contrib.mdm.apns import send_enrolled_device_notification
+from zentral.contrib.mdm.apns import send_enrolled_device_notifications
 from zentral.core.queues import queues
 
 
@@ -10,18 +10,19 @@ class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def add_arguments(self, parser):
+        parser.add_argument("--max-workers", type=int, default=20,
+                            help="maximum number of concurrent notifications")
+
     def handle(self, *args, **kwargs):
-        for d in EnrolledDevice.objects.select_related("push_certificate").all():
+        for d, success, _ in send_enrolled_device_notifications(
+            EnrolledDevice.objects.select_related("push_certificate").all(),
+            max_workers=max(1, kwargs["max_workers"]),
+        ):
             self.stdout.write(f"Device {d.serial_number} {d.udid}", ending=" ")
-            if not d.can_be_poked():
+            if success is None:
                 self.stdout.write("Skipped")
-                continue
-            success = False
-            try:
-                success, _ = send_enrolled_device_notification(d)
-            except Exception:
-                pass
-            if success:
+            elif success:
                 self.stdout.write("OK")
             else:
                 self.stdout.write("Failure")
@@ -1,10 +1,13 @@
+import hashlib
 import logging
 import plistlib
 import random
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.http import FileResponse, HttpResponse, HttpResponseForbidden, HttpResponseNotFound, HttpResponseRedirect
+from django.utils.cache import get_conditional_response
 from django.utils.functional import cached_property
+from django.utils.http import quote_etag
 from django.views.generic import View
 from zentral.contrib.inventory.exceptions import EnrollmentSecretVerificationFailed
 from zentral.contrib.inventory.models import MetaMachine
@@ -14,7 +17,8 @@ from zentral.utils.storage import file_storage_has_signed_urls, select_dist_stor
 from .conf import monolith_conf
 from .events import post_monolith_enrollment_event, post_monolith_munki_request
 from .models import MunkiNameError, parse_munki_name, CacheServer, EnrolledMachine, ManifestEnrollmentPackage
-from .utils import filter_catalog_data, filter_sub_manifest_data
+from .utils import (MAX_CACHED_CATALOG_SHARDED_PKGINFOS, filter_sub_manifest_data,
+                    get_catalog_data_bucket, prepare_catalog_data, render_catalog_data)
 
 
 logger = logging.getLogger('zentral.contrib.monolith.public_views')
@@ -161,24 +165,38 @@ class MRNameView(MRBaseView):
 class MRCatalogView(MRNameView):
     event_payload_type = "catalog"
 
+    def get_catalog_response(self, cache_key, prepared_catalog_data):
+        bucket = get_catalog_data_bucket(prepared_catalog_data, self.machine_serial_number)
+        if len(bucket) > MAX_CACHED_CATALOG_SHARDED_PKGINFOS:
+            # too many possible buckets, render the catalog for the machine
+            return render_catalog_data(prepared_catalog_data, bucket)
+        # the sharded pkginfo inclusions are resolved to a bucket shared by the machines
+        rendered_cache_key = f"{cache_key}.{bucket or '-'}"
+        response = cache.get(rendered_cache_key)
+        if not isinstance(response, tuple):
+            response = render_catalog_data(prepared_catalog_data, bucket)
+            cache.set(rendered_cache_key, response, timeout=604800)  # 7 days
+        return response
+
     def do_get(self, model, key, cache_key, event_payload):
         if model == "manifest_catalog" and key == self.manifest.pk:
-            catalog_data = cache.get(cache_key)
-            if not isinstance(catalog_data, list):
-                catalog_data = self.manifest.build_catalog(self.tags)
-                cache.set(cache_key, catalog_data, timeout=604800)  # 7 days
+            # the tag names are used to resolve the shards, and can be updated without a manifest version bump
+            tag_names = sorted(t.name for t in self.tags)
+            cache_key = "{}.{}".format(cache_key, hashlib.sha1("\x00".join(tag_names).encode("utf-8")).hexdigest())
+            prepared_catalog_data = cache.get(cache_key)
+            if not isinstance(prepared_catalog_data, tuple):
+                prepared_catalog_data = prepare_catalog_data(
+                    self.manifest.build_catalog(self.tags),
+                    tag_names
+                )
+                cache.set(cache_key, prepared_catalog_data, timeout=604800)  # 7 days
             else:
                 event_payload["cache"]["hit"] = True
-            return HttpResponse(
-                plistlib.dumps(
-                    filter_catalog_data(
-                        catalog_data,
-                        self.machine_serial_number,
-                        [t.name for t in self.tags]
-                    )
-                ),
-                content_type="application/xml"
-            )
+            content, etag = self.get_catalog_response(cache_key, prepared_catalog_data)
+            etag = quote_etag(etag)
+            response = HttpResponse(content, content_type="application/xml")
+            response["ETag"] = etag
+            return get_conditional_response(self.request, etag=etag, response=response)
 
 
 class MRManifestView(MRNameView):
@@ -36,6 +36,235 @@ class SyncEventManager:
             event.post()
 
 
+class PkgInfoSync:
+    """
+    Imports the pkginfos of a repository catalog with a fixed number of queries.
+
+    The existing catalogs, categories, names and pkginfos are loaded upfront, and the unchanged pkginfos are skipped.
+    The changes are applied with bulk upserts, and the audit callbacks are called in the import order,
+    once the changes are applied. The catalogs of the changed objects are collected, to only bump the versions
+    of the affected manifests.
+    """
+    batch_size = 1000
+    m2m_attrs = ("catalogs", "requires", "update_for")
+
+    def __init__(self, repository, all_pkg_info_data):
+        self.repository = repository
+        self.catalogs = {
+            c.name: c
+            for c in Catalog.objects.select_related("repository").filter(repository=repository)
+        }
+        self.categories = {
+            c.name: c
+            for c in PkgInfoCategory.objects.select_related("repository").filter(repository=repository)
+        }
+        self.pkg_infos = {
+            (pkg_info.name.name, pkg_info.version): pkg_info
+            for pkg_info in (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
+                                            .select_related("repository", "name", "category")
+                                            .filter(repository=repository))
+        }
+        all_names = set()
+        for pkg_info_data in all_pkg_info_data:
+            all_names.add(pkg_info_data["name"])
+            all_names.update(pkg_info_data.get("requires", []))
+            all_names.update(pkg_info_data.get("update_for", []))
+        self.names = {pin.name: pin for pin in PkgInfoName.objects.filter(name__in=all_names)}
+        self.new_names = []
+        self.new_categories = []
+        self.pkg_infos_to_save = []
+        self.m2m_updates = []
+        self.found_pkg_infos = []
+        self.found_catalog_pks = set()
+        self.affected_catalog_pks = set()
+        self.audit_calls = []
+        # one upsert per name and version, the last duplicated entry wins
+        deduplicated_pkg_info_data = {}
+        for pkg_info_data in all_pkg_info_data:
+            key = (pkg_info_data["name"], pkg_info_data["version"])
+            if key in deduplicated_pkg_info_data:
+                logger.warning("PKGINFO %s %s duplicated", *key)
+            deduplicated_pkg_info_data[key] = pkg_info_data
+        for pkg_info_data in deduplicated_pkg_info_data.values():
+            self._import_pkg_info(pkg_info_data)
+
+    def _audit(self, *args):
+        self.audit_calls.append(args)
+
+    def _get_catalogs(self, pkg_info_data):
+        # catalogs are rarely created or unarchived, they are saved immediately
+        catalogs = []
+        for catalog_name in pkg_info_data.get("catalogs", []):
+            catalog_name = catalog_name.strip()
+            catalog = self.catalogs.get(catalog_name)
+            if catalog is None:
+                catalog = Catalog.objects.create(repository=self.repository, name=catalog_name)
+                self.catalogs[catalog_name] = catalog
+                self._audit(catalog, AuditEvent.Action.CREATED)
+                self.affected_catalog_pks.add(catalog.pk)
+            elif catalog.archived_at:
+                prev_value = catalog.serialize_for_event()
+                catalog.archived_at = None
+                catalog.save()
+                self._audit(catalog, AuditEvent.Action.UPDATED, prev_value)
+                self.affected_catalog_pks.add(catalog.pk)
+            if catalog not in catalogs:
+                catalogs.append(catalog)
+        return catalogs
+
+    def _get_name(self, name):
+        pkg_info_name = self.names.get(name)
+        if pkg_info_name is None:
+            pkg_info_name = self.names[name] = PkgInfoName(name=name)
+            self.new_names.append(pkg_info_name)
+            self._audit(pkg_info_name, AuditEvent.Action.CREATED)
+        return pkg_info_name
+
+    def _get_category(self, name):
+        pkg_info_category = self.categories.get(name)
+        if pkg_info_category is None:
+            pkg_info_category = self.categories[name] = PkgInfoCategory(repository=self.repository, name=name)
+            self.new_categories.append(pkg_info_category)
+            self._audit(pkg_info_category, AuditEvent.Action.CREATED)
+        return pkg_info_category
+
+    def _import_pkg_info(self, pkg_info_data):
+        name = pkg_info_data['name']
+        version = pkg_info_data['version']
+        # catalogs
+        catalogs = self._get_catalogs(pkg_info_data)
+        if not catalogs:
+            logger.warning('PKGINFO %s %s w/o catalogs', name, version)
+            return
+        self.found_catalog_pks.update(c.pk for c in catalogs)
+        # name
+        pkg_info_name = self._get_name(name)
+        # category
+        pkg_info_category = None
+        category_name = pkg_info_data.get('category', None)
+        if category_name:
+            pkg_info_category = self._get_category(category_name)
+        # requires
+        requires = [self._get_name(n) for n in sorted(set(pkg_info_data.get('requires', [])))]
+        # update_for
+        update_for = [self._get_name(n) for n in sorted(set(pkg_info_data.get('update_for', [])))]
+        # serialize pkg_info_data
+        for key, val in pkg_info_data.items():
+            if isinstance(val, datetime):
+                pkg_info_data[key] = val.isoformat()
+        m2m_values = {"catalogs": catalogs, "requires": requires, "update_for": update_for}
+        pkg_info = self.pkg_infos.get((name, version))
+        if pkg_info is None:
+            pkg_info = PkgInfo(repository=self.repository,
+                               name=pkg_info_name,
+                               version=version,
+                               category=pkg_info_category,
+                               data=pkg_info_data)
+            self.pkg_infos_to_save.append(pkg_info)
+            self.m2m_updates.append((pkg_info, m2m_values))
+            self._audit(pkg_info, AuditEvent.Action.CREATED)
+            self.affected_catalog_pks.update(c.pk for c in catalogs)
+        else:
+            changed_m2m_values = {}
+            for pkg_info_attr, pkg_info_values in m2m_values.items():
+                # names compared instead of the objects, because the new names do not have a pk yet
+                key_attr = "name" if pkg_info_attr != "catalogs" else "pk"
+                if (
+                    set(getattr(o, key_attr) for o in getattr(pkg_info, pkg_info_attr).all())
+                    != set(getattr(o, key_attr) for o in pkg_info_values)
+                ):
+                    changed_m2m_values[pkg_info_attr] = pkg_info_values
+            if (
+                pkg_info.archived_at
+                or pkg_info.local
+                or pkg_info.category != pkg_info_category
+                or pkg_info.data != pkg_info_data
+                or changed_m2m_values
+            ):
+                prev_value = pkg_info.serialize_for_event()
+                self.affected_catalog_pks.update(c.pk for c in pkg_info.catalogs.all())
+                self.affected_catalog_pks.update(c.pk for c in catalogs)
+                pkg_info.archived_at = None
+                pkg_info.local = False
+                pkg_info.category = pkg_info_category
+                pkg_info.data = pkg_info_data
+                # saved even if only the m2m attributes were updated, for updated_at
+                self.pkg_infos_to_save.append(pkg_info)
+                if changed_m2m_values:
+                    self.m2m_updates.append((pkg_info, changed_m2m_values))
+                self._audit(pkg_info, AuditEvent.Action.UPDATED, prev_value)
+        self.found_pkg_infos.append(pkg_info)
+
+    def _bulk_create_with_pks(self, model, objs, lookup_field, **filters):
+        # ignore the conflicts with concurrent imports, and fetch the pks
+        model.objects.bulk_create(objs, batch_size=self.batch_size, ignore_conflicts=True)
+        pks = dict(model.objects.filter(**{f"{lookup_field}__in": [getattr(o, lookup_field) for o in objs]}, **filters)
+                                .values_list(lookup_field, "pk"))
+        for obj in objs:
+            obj.pk = pks[getattr(obj, lookup_field)]
+
+    def _update_m2m(self):
+        for pkg_info_attr in self.m2m_attrs:
+            field = PkgInfo._meta.get_field(pkg_info_attr)
+            through = field.remote_field.through
+            source_attname = f"{field.m2m_field_name()}_id"
+            target_attname = f"{field.m2m_reverse_field_name()}_id"
+            pkg_info_pks = []
+            rows = []
+            for pkg_info, m2m_values in self.m2m_updates:
+                if pkg_info_attr not in m2m_values:
+                    continue
+                pkg_info_pks.append(pkg_info.pk)
+                rows.extend(through(**{source_attname: pkg_info.pk, target_attname: o.pk})
+                            for o in m2m_values[pkg_info_attr])
+            if pkg_info_pks:
+                through.objects.filter(**{f"{source_attname}__in": pkg_info_pks}).delete()
+            if rows:
+                through.objects.bulk_create(rows, batch_size=self.batch_size)
+        for pkg_info, _ in self.m2m_updates:
+            # refresh the m2m attributes for the audit events
+            getattr(pkg_info, "_prefetched_objects_cache", {}).clear()
+
+    def apply(self, audit_callback):
+        if self.new_names:
+            self._bulk_create_with_pks(PkgInfoName, self.new_names, "name")
+        if self.new_categories:
+            self._bulk_create_with_pks(PkgInfoCategory, self.new_categories, "name", repository=self.repository)
+        if self.pkg_infos_to_save:
+            # single INSERT ... ON CONFLICT DO UPDATE for the new and the updated pkginfos
+            PkgInfo.objects.bulk_create(
+                self.pkg_infos_to_save,
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=("repository", "name", "version"),
+                update_fields=("category", "data", "local", "archived_at", "updated_at"),
+            )
+        if self.m2m_updates:
+            self._update_m2m()
+        for args in self.audit_calls:
+            audit_callback(*args)
+        self.audit_calls = []
+
+    def archive_missing_pkg_infos(self, audit_callback):
+        found_pkg_info_pks = set(pkg_info.pk for pkg_info in self.found_pkg_infos)
+        pkg_infos_to_archive = [
+            pkg_info
+            for pkg_info in self.pkg_infos.values()
+            if pkg_info.pk not in found_pkg_info_pks and not pkg_info.local and not pkg_info.archived_at
+        ]
+        if not pkg_infos_to_archive:
+            return
+        prev_values = [pkg_info.serialize_for_event() for pkg_info in pkg_infos_to_archive]
+        archived_at = datetime.utcnow()
+        PkgInfo.objects.filter(pk__in=[pkg_info.pk for pkg_info in pkg_infos_to_archive]).update(
+            archived_at=archived_at, updated_at=archived_at
+        )
+        for pkg_info, prev_value in zip(pkg_infos_to_archive, prev_values):
+            pkg_info.archived_at = pkg_info.updated_at = archived_at
+            self.affected_catalog_pks.update(c.pk for c in pkg_info.catalogs.all())
+            audit_callback(pkg_info, AuditEvent.Action.UPDATED, prev_value)
+
+
 class BaseRepository:
     kwargs_keys = ()
     encrypted_kwargs_keys = ()
@@ -95,130 +324,12 @@ class BaseRepository:
 
     # sync
 
-    def _import_category(self, name, audit_callback):
-        pic, created = PkgInfoCategory.objects.get_or_create(repository=self.repository, name=name)
-        if created and audit_callback:
-            audit_callback(pic, AuditEvent.Action.CREATED)
-        return pic
-
-    def _import_name(self, name, audit_callback):
-        pin, created = PkgInfoName.objects.get_or_create(name=name)
-        if created and audit_callback:
-            audit_callback(pin, AuditEvent.Action.CREATED)
-        return pin
-
-    def _import_catalogs(self, pkg_info_data, audit_callback):
-        catalogs = []
-        pkg_info_catalogs = pkg_info_data.get("catalogs", [])
-        for catalog_name in pkg_info_catalogs:
-            catalog_name = catalog_name.strip()
-            try:
-                catalog = Catalog.objects.get(repository=self.repository, name=catalog_name)
-            except Catalog.DoesNotExist:
-                catalog = Catalog.objects.create(repository=self.repository, name=catalog_name)
-                audit_callback(catalog, AuditEvent.Action.CREATED)
-            else:
-                if catalog.archived_at:
-                    prev_value = catalog.serialize_for_event()
-                    catalog.archived_at = None
-                    catalog.save()
-                    audit_callback(catalog, AuditEvent.Action.UPDATED, prev_value)
-            catalogs.append(catalog)
-        return catalogs
-
-    def _import_pkg_info(self, pkg_info_data, audit_callback):
-        name = pkg_info_data['name']
-        version = pkg_info_data['version']
-        # catalogs
-        catalogs = self._import_catalogs(pkg_info_data, audit_callback)
-        if not catalogs:
-            logger.warning('PKGINFO %s %s w/o catalogs', name, version)
-            return catalogs, None
-        # name
-        pkg_info_name = self._import_name(name, audit_callback)
-        # category
-        pkg_info_category = None
-        category_name = pkg_info_data.get('category', None)
-        if category_name:
-            pkg_info_category = self._import_category(category_name, audit_callback)
-        # requires
-        requires = [self._import_name(n, audit_callback)
-                    for n in set(pkg_info_data.get('requires', []))]
-        # update_for
-        update_for = [self._import_name(n, audit_callback)
-                      for n in set(pkg_info_data.get('update_for', []))]
-        # serialize pkg_info_data
-        for key, val in pkg_info_data.items():
-            if isinstance(val, datetime):
-                pkg_info_data[key] = val.isoformat()
-        # save PkgInfo in db
-        try:
-            pkg_info = (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
-                                       .select_related("repository", "name", "category")
-                                       .get(repository=self.repository,
-                                            name=pkg_info_name,
-                                            version=version))
-        except PkgInfo.DoesNotExist:
-            pkg_info = PkgInfo.objects.create(repository=self.repository,
-                                              name=pkg_info_name,
-                                              version=version,
-                                              category=pkg_info_category,
-                                              data=pkg_info_data)
-            pkg_info.catalogs.set(catalogs)
-            pkg_info.requires.set(requires)
-            pkg_info.update_for.set(update_for)
-            audit_callback(pkg_info, AuditEvent.Action.CREATED)
-        else:
-            updated = False
-            prev_value = pkg_info.serialize_for_event()
-            # unarchive if necessary
-            if pkg_info.archived_at:
-                pkg_info.archived_at = None
-                updated = True
-            # update the local attribute
-            if pkg_info.local:
-                pkg_info.local = False
-                updated = True
-            # update category if necessary
-            pkg_info_old_category = pkg_info.category
-            if pkg_info_old_category != pkg_info_category:
-                pkg_info.category = pkg_info_category
-                updated = True
-            # update data if necessary
-            pkg_info_old_data = pkg_info.data
-            if pkg_info_old_data != pkg_info_data:
-                pkg_info.data = pkg_info_data
-                updated = True
-            # update m2m attributes
-            for pkg_info_attr, pkg_info_values in (
-                ("requires", requires),
-                ("update_for", update_for),
-                ("catalogs", catalogs)
-            ):
-                pkg_info_old_values = set(getattr(pkg_info, pkg_info_attr).all())
-                pkg_info_values = set(pkg_info_values)
-                if pkg_info_old_values != pkg_info_values:
-                    getattr(pkg_info, pkg_info_attr).set(pkg_info_values)
-                    updated = True
-            # save updates
-            if updated:
-                pkg_info.save()  # even if only the m2m attributes were updated, for updated_at
-                audit_callback(pkg_info, AuditEvent.Action.UPDATED, prev_value)
-
-        return catalogs, pkg_info
-
     def _archive_catalog(self, catalog, audit_callback):
         prev_value = catalog.serialize_for_event()
         catalog.archived_at = datetime.utcnow()
         catalog.save()
         audit_callback(catalog, AuditEvent.Action.UPDATED, prev_value)
 
-    def _archive_pkg_info(self, pkg_info, audit_callback):
-        prev_value = pkg_info.serialize_for_event()
-        pkg_info.archived_at = datetime.utcnow()
-        pkg_info.save()
-        audit_callback(pkg_info, AuditEvent.Action.UPDATED, prev_value)
-
     def _bump_manifest(self, manifest, audit_callback):
         prev_value = manifest.serialize_for_event()
         manifest.bump_version()
@@ -229,45 +340,46 @@ class BaseRepository:
         sync_event_manager = SyncEventManager(self.repository, event_request)
         audit_callback = sync_event_manager.audit_callback
 
-        found_pkg_info_pks = set([])
-        found_catalog_pks = set([])
-
-        # initialize repository icon hashes
-        repo_icon_hashes = {}
-        icon_hashes_content = self.get_icon_hashes_content()
-        if icon_hashes_content:
-            icon_hashes = plistlib.loads(icon_hashes_content)
-        else:
-            icon_hashes = {}
         # update or create current pkg_infos
-        for pkg_info_data in plistlib.loads(self.get_all_catalog_content()):
-            catalogs, pkg_info = self._import_pkg_info(pkg_info_data, audit_callback)
-            found_catalog_pks.update(c.pk for c in catalogs)
-            if pkg_info:
-                found_pkg_info_pks.add(pkg_info.pk)
-                icon_hash = icon_hashes.get(pkg_info.get_original_icon_name())
-                if icon_hash:
-                    repo_icon_hashes[pkg_info.get_monolith_icon_name()] = icon_hash
+        pkg_info_sync = PkgInfoSync(self.repository, plistlib.loads(self.get_all_catalog_content()))
+        pkg_info_sync.apply(audit_callback)
         # archive unknown non-local pkg_infos
-        for pkg_info in (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
-                                        .select_related("category", "name")
-                                        .filter(repository=self.repository, archived_at__isnull=True)
-                                        .exclude(Q(local=True) | Q(pk__in=found_pkg_info_pks))):
-            self._archive_pkg_info(pkg_info, audit_callback)
+        pkg_info_sync.archive_missing_pkg_infos(audit_callback)
+        affected_catalog_pks = pkg_info_sync.affected_catalog_pks
         # archive old catalogs
         for c in (Catalog.objects.annotate(pkginfo_count=Count("pkginfo",
                                                                filter=Q(pkginfo__archived_at__isnull=True)))
                                  .filter(repository=self.repository, archived_at__isnull=True, pkginfo_count=0)
-                                 .exclude(pk__in=found_catalog_pks)):
+                                 .exclude(pk__in=pkg_info_sync.found_catalog_pks)):
             self._archive_catalog(c, audit_callback)
+            affected_catalog_pks.add(c.pk)
+        # repository icon hashes
+        repo_icon_hashes = {}
+        icon_hashes_content = self.get_icon_hashes_content()
+        if icon_hashes_content:
+            icon_hashes = plistlib.loads(icon_hashes_content)
+        else:
+            icon_hashes = {}
+        for pkg_info in pkg_info_sync.found_pkg_infos:
+            icon_hash = icon_hashes.get(pkg_info.get_original_icon_name())
+            if icon_hash:
+                repo_icon_hashes[pkg_info.get_monolith_icon_name()] = icon_hash
+        client_resources = list(self.iter_client_resources())
+        if (
+            repo_icon_hashes != self.repository.icon_hashes
+            or client_resources != self.repository.client_resources
+        ):
+            # the icon hashes and the client resources are served with all the found catalogs
+            affected_catalog_pks.update(pkg_info_sync.found_catalog_pks)
         # update repository
         self.repository.icon_hashes = repo_icon_hashes
-        self.repository.client_resources = list(self.iter_client_resources())
+        self.repository.client_resources = client_resources
         self.repository.last_synced_at = datetime.utcnow()
         self.repository.save()
-        # bump versions of manifests connected to found catalogs
-        for manifest in Manifest.objects.distinct().filter(manifestcatalog__catalog__pk__in=found_catalog_pks):
-            self._bump_manifest(manifest, audit_callback)
+        # bump versions of manifests connected to the affected catalogs
+        if affected_catalog_pks:
+            for manifest in Manifest.objects.distinct().filter(manifestcatalog__catalog__pk__in=affected_catalog_pks):
+                self._bump_manifest(manifest, audit_callback)
 
         # post events
         transaction.on_commit(lambda: sync_event_manager.post_events())
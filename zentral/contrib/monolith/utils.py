@@ -117,14 +117,15 @@ def build_configuration_profile(enrollment):
     return f"zentral_monolith_configuration.enrollment_{enrollment.pk}.mobileconfig", content
 
 
-def test_monolith_object_inclusion(key, options, serial_number, tag_names):
+def get_monolith_object_shard(options, tag_names):
+    """Returns the shard and the modulo of the object, or None if it is excluded by a tag"""
     shard = 100
     modulo = 100
     if options:
         excluded_tag_names = options.get("excluded_tags")
         if excluded_tag_names and any(etn in tag_names for etn in excluded_tag_names):
             # one excluded tag match, skip
-            return False
+            return None
         # not excluded, evaluate the shard
         shards = options.get("shards")
         if shards:
@@ -137,6 +138,14 @@ def test_monolith_object_inclusion(key, options, serial_number, tag_names):
                 except ValueError:
                     # no tag match
                     shard = default
+    return shard, modulo
+
+
+def test_monolith_object_inclusion(key, options, serial_number, tag_names):
+    shard_and_modulo = get_monolith_object_shard(options, tag_names)
+    if shard_and_modulo is None:
+        return False
+    shard, modulo = shard_and_modulo
     return (
         shard >= modulo or
         compute_shard(key + serial_number, modulo=modulo) < shard
@@ -152,15 +161,56 @@ def test_pkginfo_catalog_inclusion(pkginfo, serial_number, tag_names):
     )
 
 
-def filter_catalog_data(catalog_data, serial_number, tag_names):
-    filtered_catalog_data = []
+# catalog rendering
+
+
+# above this number of sharded pkginfos, the rendered catalogs are not cached
+MAX_CACHED_CATALOG_SHARDED_PKGINFOS = 8
+
+
+def prepare_catalog_data(catalog_data, tag_names):
+    """Resolves the catalog pkginfo inclusions that only depend on the machine tags
+
+    Returns a tuple of (pkginfo, shard test) tuples. The shard test is None if the pkginfo is always included,
+    or a (key, shard, modulo) tuple if the inclusion depends on the machine serial number.
+    """
+    prepared_catalog_data = []
     for pkginfo in catalog_data:
-        if test_pkginfo_catalog_inclusion(pkginfo, serial_number, tag_names):
-            force_install_after_date = pkginfo.get("force_install_after_date")
-            if isinstance(force_install_after_date, str):
-                pkginfo["force_install_after_date"] = datetime.fromisoformat(force_install_after_date)
-            filtered_catalog_data.append(pkginfo)
-    return filtered_catalog_data
+        shard_and_modulo = get_monolith_object_shard(pkginfo.get("zentral_monolith"), tag_names)
+        if shard_and_modulo is None:
+            continue
+        shard, modulo = shard_and_modulo
+        if shard >= modulo:
+            shard_test = None
+        elif shard > 0:
+            shard_test = (pkginfo["name"] + pkginfo["version"], shard, modulo)
+        else:
+            # never included
+            continue
+        force_install_after_date = pkginfo.get("force_install_after_date")
+        if isinstance(force_install_after_date, str):
+            pkginfo["force_install_after_date"] = datetime.fromisoformat(force_install_after_date)
+        prepared_catalog_data.append((pkginfo, shard_test))
+    return tuple(prepared_catalog_data)
+
+
+def get_catalog_data_bucket(prepared_catalog_data, serial_number):
+    """Returns the machine bucket, one digit per sharded pkginfo, 1 if included, 0 if not"""
+    return "".join(
+        "1" if compute_shard(key + serial_number, modulo=modulo) < shard else "0"
+        for key, shard, modulo in (shard_test for _, shard_test in prepared_catalog_data if shard_test)
+    )
+
+
+def render_catalog_data(prepared_catalog_data, bucket):
+    """Returns the serialized catalog for the bucket, and its ETag"""
+    inclusions = iter(bucket)
+    content = plistlib.dumps([
+        pkginfo
+        for pkginfo, shard_test in prepared_catalog_data
+        if shard_test is None or next(inclusions) == "1"
+    ])
+    return content, hashlib.sha1(content).hexdigest()
 
 
 def filter_sub_manifest_data_dict(smd, serial_number, tag_names):
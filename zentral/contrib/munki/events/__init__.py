@@ -2,6 +2,7 @@ import logging
 import uuid
 from dateutil import parser
 from zentral.core.events.base import BaseEvent, EventMetadata, EventRequest, register_event_type
+from zentral.core.queues import queues
 
 logger = logging.getLogger('zentral.contrib.munki.events')
 
@@ -138,17 +139,21 @@ register_event_type(MunkiScriptCheckStatusUpdated)
 # utils
 
 
-def post_munki_request_event(msn, user_agent, ip, **kwargs):
+def build_munki_request_event(msn, user_agent, ip, created_at=None, **kwargs):
     metadata = EventMetadata(
         machine_serial_number=msn,
         request=EventRequest(user_agent, ip),
+        created_at=created_at,
         incident_updates=kwargs.pop("incident_updates", [])
     )
-    event = MunkiRequestEvent(metadata, kwargs)
-    event.post()
+    return MunkiRequestEvent(metadata, kwargs)
 
 
-def post_munki_events(msn, user_agent, ip, data):
+def post_munki_request_event(msn, user_agent, ip, **kwargs):
+    build_munki_request_event(msn, user_agent, ip, **kwargs).post()
+
+
+def iter_munki_events(msn, user_agent, ip, data):
     for report in data:
         events = report.pop('events')
         event_uuid = uuid.uuid4()
@@ -189,8 +194,25 @@ def post_munki_events(msn, user_agent, ip, data):
                 incident_updates=payload.pop("incident_updates", []),
             )
             payload.update(report)
-            event = event_cls(metadata, payload)
-            event.post()
+            yield event_cls(metadata, payload)
+
+
+def post_munki_events(msn, user_agent, ip, data):
+    for event in iter_munki_events(msn, user_agent, ip, data):
+        event.post()
+
+
+def post_munki_postflight_raw_event(msn, user_agent, ip, enrollment, business_unit, request_time, data):
+    raw_event = {
+        "request": {"user_agent": user_agent,
+                    "ip": ip},
+        "machine_serial_number": msn,
+        "enrollment": {"pk": enrollment.pk},
+        "business_unit": business_unit.serialize() if business_unit else None,
+        "request_time": request_time.isoformat(),
+        "data": data,
+    }
+    queues.post_raw_event("munki_postflight", raw_event)
 
 
 def post_munki_enrollment_event(msn, user_agent, ip, data):
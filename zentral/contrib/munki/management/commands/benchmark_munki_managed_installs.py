@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+import time
+from types import SimpleNamespace
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from zentral.contrib.munki.utils import apply_managed_installs
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the munki managed installs reconciliation on a synthetic postflight report. "
+            "All the changes are rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--packages", type=int, default=500, help="number of packages in the report")
+        parser.add_argument("--runs", type=int, default=5, help="number of runs per scenario")
+
+    @staticmethod
+    def build_report(packages, installed_at, version, start=0):
+        return [(f"package{i}", version, f"Package {i}", installed_at.isoformat())
+                for i in range(start, start + packages)]
+
+    def scenarios(self, packages):
+        now = datetime.utcnow()
+        yesterday = now - timedelta(days=1)
+        quarter = packages // 4
+        # first munki run, all managed installs created
+        yield "create", [], self.build_report(packages, now, "1.0")
+        # new versions of all the packages
+        yield "update", self.build_report(packages, yesterday, "1.0"), self.build_report(packages, now, "2.0")
+        # same versions re-installed, reinstall flags set
+        yield "reinstall", self.build_report(packages, yesterday, "1.0"), self.build_report(packages, now, "1.0")
+        # unchanged report, stalled updates
+        yield "unchanged", self.build_report(packages, now, "1.0"), self.build_report(packages, now, "1.0")
+        # a quarter of the packages removed, a quarter added, the rest updated
+        yield ("mixed",
+               self.build_report(packages, yesterday, "1.0"),
+               self.build_report(packages - quarter, now, "2.0", start=quarter))
+
+    def run_scenario(self, existing, report, configuration):
+        serial_number = get_random_string(12)
+        list(apply_managed_installs(serial_number, existing, configuration))
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            incident_updates = list(apply_managed_installs(serial_number, report, configuration))
+            duration = time.perf_counter() - start
+        return duration, len(ctx.captured_queries), len(incident_updates)
+
+    def handle(self, *args, **options):
+        packages = options["packages"]
+        runs = options["runs"]
+        configuration = SimpleNamespace(auto_failed_install_incidents=True, auto_reinstall_incidents=True)
+        self.stdout.write(f"{packages} packages, {runs} run(s) per scenario")
+        with transaction.atomic():
+            for label, existing, report in self.scenarios(packages):
+                results = [self.run_scenario(existing, report, configuration) for _ in range(runs)]
+                durations = sorted(duration for duration, _, _ in results)
+                _, query_count, incident_update_count = results[0]
+                self.stdout.write(f"{label:>10}: {durations[len(durations) // 2] * 1000:8.1f}ms (median) "
+                                  f"{query_count:5} queries {incident_update_count:5} incident updates")
+            transaction.set_rollback(True)
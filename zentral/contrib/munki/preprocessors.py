@@ -0,0 +1,45 @@
+from datetime import datetime
+import logging
+from django.db import transaction
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_yield_events
+from .models import Enrollment
+from .utils import prepare_postflight_ms_tree, process_postflight_data
+
+
+logger = logging.getLogger("zentral.contrib.munki.preprocessors")
+
+
+class PostflightPreprocessor:
+    routing_key = "munki_postflight"
+
+    def process_raw_event(self, raw_event):
+        try:
+            serial_number = raw_event["machine_serial_number"]
+            user_agent = raw_event["request"]["user_agent"]
+            ip = raw_event["request"]["ip"]
+            enrollment_pk = raw_event["enrollment"]["pk"]
+            request_time = datetime.fromisoformat(raw_event["request_time"])
+            data = raw_event["data"]
+        except (KeyError, TypeError, ValueError):
+            logger.exception("Invalid munki postflight raw event")
+            return
+        try:
+            enrollment = Enrollment.objects.select_related("configuration").get(pk=enrollment_pk)
+        except Enrollment.DoesNotExist:
+            logger.error("Machine %s: unknown munki enrollment %s", serial_number, enrollment_pk)
+            return
+
+        # machine snapshot
+        ms_tree = prepare_postflight_ms_tree(serial_number, ip, raw_event.get("business_unit"),
+                                             request_time, data['machine_snapshot'])
+        with transaction.atomic():
+            yield from commit_machine_snapshot_and_yield_events(ms_tree)
+
+        # managed installs, script checks, munki state
+        with transaction.atomic():
+            events = list(process_postflight_data(serial_number, user_agent, ip, enrollment, request_time, data))
+        yield from events
+
+
+def get_preprocessors():
+    yield PostflightPreprocessor()
@@ -1,9 +1,17 @@
+from datetime import timezone
+import logging
 from dateutil import parser
 from cryptography import x509
 from django.utils.timezone import is_aware, make_naive
 from zentral.utils.certificates import is_ca, build_cert_tree
+from zentral.utils.json import remove_null_character
+from .compliance_checks import update_machine_munki_script_check_statuses
+from .events import build_munki_request_event, iter_munki_events
 from .incidents import MunkiInstallFailedIncident, MunkiReinstallIncident, Severity
-from .models import ManagedInstall
+from .models import EnrolledMachine, ManagedInstall, MunkiState
+
+
+logger = logging.getLogger("zentral.contrib.munki.utils")
 
 
 # machine snapshots
@@ -29,10 +37,44 @@ def prepare_ms_tree_certificates(ms_tree):
         ms_tree["certificates"] = certificates
 
 
+def prepare_postflight_ms_tree(serial_number, ip, business_unit_d, request_time, ms_tree):
+    ms_tree['source'] = {'module': 'zentral.contrib.munki',
+                         'name': 'Munki'}
+    ms_tree['reference'] = ms_tree['serial_number']
+    ms_tree['public_ip_address'] = ip
+    if "last_seen" not in ms_tree:
+        ms_tree["last_seen"] = request_time
+    if business_unit_d:
+        ms_tree['business_unit'] = business_unit_d
+    prepare_ms_tree_certificates(ms_tree)
+    extra_facts = ms_tree.pop("extra_facts", None)
+    if isinstance(extra_facts, dict):
+        ms_tree["extra_facts"] = remove_null_character(extra_facts)
+    # cleanup profiles
+    reported_profiles = ms_tree.pop("profiles", None)
+    if reported_profiles:
+        profiles = []
+        for profile in reported_profiles:
+            if profile not in profiles:
+                profiles.append(profile)
+            else:
+                logger.error("Duplicated profile %s for machine %s.",
+                             profile.get("uuid", "UNKNOWN UUID"), serial_number)
+        ms_tree["profiles"] = profiles
+    # cleanup OS version
+    if "os_version" in ms_tree:
+        if ms_tree["os_version"].get("patch") is None:
+            ms_tree["os_version"]["patch"] = 0
+    return ms_tree
+
+
 # managed install updates
 # WARNING all this functions must be protected with a lock at the enrolled machine level
 
 
+MANAGED_INSTALLS_BATCH_SIZE = 1000
+
+
 def create_managed_install_with_failed_install(
     serial_number,
     name, display_name, version,
@@ -239,6 +281,8 @@ def apply_managed_installs(serial_number, managed_installs, configuration):
         for mi in ManagedInstall.objects.select_for_update()
                                         .filter(machine_serial_number=serial_number)
     }
+    managed_installs_to_create = []
+    managed_installs_to_update = []
 
     # create or update existing managed installs
     for name, version, display_name, installed_at in managed_installs:
@@ -252,12 +296,14 @@ def apply_managed_installs(serial_number, managed_installs, configuration):
             mi = existing_managed_installs.pop(name)
         except KeyError:
             # create new managed install for this pkg
-            ManagedInstall.objects.create(
-                machine_serial_number=serial_number,
-                name=name,
-                display_name=display_name or name,
-                installed_version=version,
-                installed_at=installed_at
+            managed_installs_to_create.append(
+                ManagedInstall(
+                    machine_serial_number=serial_number,
+                    name=name,
+                    display_name=display_name or name,
+                    installed_version=version,
+                    installed_at=installed_at
+                )
             )
         else:
             if installed_at is None:
@@ -302,7 +348,7 @@ def apply_managed_installs(serial_number, managed_installs, configuration):
             # mi installed at is None or < installed at, we can update
             mi.installed_at = installed_at
 
-            mi.save()
+            managed_installs_to_update.append(mi)
 
     # delete not found stored managed installs
     for mi in existing_managed_installs.values():
@@ -314,4 +360,136 @@ def apply_managed_installs(serial_number, managed_installs, configuration):
             yield MunkiReinstallIncident.build_incident_update(
                 mi.name, mi.installed_version, Severity.NONE
             )
-        mi.delete()
+
+    # apply the changes
+    if existing_managed_installs:
+        ManagedInstall.objects.filter(pk__in=[mi.pk for mi in existing_managed_installs.values()]).delete()
+    if managed_installs_to_update or managed_installs_to_create:
+        # single INSERT ... ON CONFLICT DO UPDATE, faster than bulk_update
+        ManagedInstall.objects.bulk_create(
+            managed_installs_to_update + managed_installs_to_create,
+            batch_size=MANAGED_INSTALLS_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=("machine_serial_number", "name"),
+            update_fields=("display_name", "installed_version", "installed_at", "reinstall",
+                           "failed_version", "failed_at", "updated_at"),
+        )
+
+
+# postflight
+
+
+def process_postflight_data(serial_number, user_agent, ip, enrollment, request_time, data):
+    """
+    Update the managed installs, script check statuses and munki state with the postflight data.
+
+    Yields the munki request and munki events. The machine snapshot is not processed.
+    """
+
+    # lock enrolled machine
+    EnrolledMachine.objects.select_for_update().filter(serial_number=serial_number)
+
+    # delete all managed installs if last seen report not found
+    # which is a good indicator that the machine has been wiped
+    last_seen_report_found = data.get("last_seen_report_found")
+    if last_seen_report_found is not None and not last_seen_report_found:
+        ManagedInstall.objects.filter(machine_serial_number=serial_number).delete()
+
+    # prepare reports
+    reports = []
+    report_count = event_count = 0
+    for r in data.pop('reports'):
+        report_count += 1
+        event_count += len(r.get("events", []))
+        reports.append((
+            parser.parse(r.pop('start_time')),
+            parser.parse(r.pop('end_time')),
+            r
+        ))
+    reports.sort()
+
+    munki_request_event_kwargs = {
+        "request_type": "postflight",
+        "enrollment": {"pk": enrollment.pk},
+        "report_count": report_count,
+        "event_count": event_count,
+    }
+    if last_seen_report_found is not None:
+        munki_request_event_kwargs["last_seen_report_found"] = last_seen_report_found
+
+    # update machine managed installs
+    managed_installs = data.get("managed_installs")
+    if managed_installs is not None:
+        munki_request_event_kwargs["managed_installs"] = True
+        munki_request_event_kwargs["managed_install_count"] = len(managed_installs)
+        # update managed installs using the complete list
+        incident_updates = list(apply_managed_installs(
+            serial_number, managed_installs,
+            enrollment.configuration
+        ))
+        # incident updates are attached to the munki request event
+        if incident_updates:
+            munki_request_event_kwargs["incident_updates"] = incident_updates
+    else:
+        munki_request_event_kwargs["managed_installs"] = False
+        # update managed installs using the install and removal events in the reports
+        for _, _, report in reports:
+            for created_at, event in report.get("events", []):
+                # time
+                event_time = parser.parse(created_at)
+                if is_aware(event_time):
+                    event_time = make_naive(event_time)
+                for incident_update in update_managed_install_with_event(
+                    serial_number, event, event_time,
+                    enrollment.configuration
+                ):
+                    # incident updates are attached to each munki event
+                    event.setdefault("incident_updates", []).append(incident_update)
+
+    # script checks
+    script_check_results = data.get("script_check_results")
+    if script_check_results:
+        munki_request_event_kwargs["script_check_results"] = True
+        munki_request_event_kwargs["script_check_result_count"] = len(script_check_results)
+        update_machine_munki_script_check_statuses(
+            serial_number,
+            script_check_results,
+            request_time
+        )
+    else:
+        munki_request_event_kwargs["script_check_results"] = False
+
+    # update machine munki state
+    update_dict = {'user_agent': user_agent,
+                   'ip': ip}
+    if managed_installs is not None:
+        update_dict["last_managed_installs_sync"] = request_time
+    if script_check_results is not None:
+        update_dict["last_script_checks_run"] = request_time
+    if reports:
+        start_time, end_time, report = reports[-1]
+        update_dict.update({'munki_version': report.get('munki_version', None),
+                            'sha1sum': report['sha1sum'],
+                            'run_type': report['run_type'],
+                            'start_time': start_time,
+                            'end_time': end_time})
+    if script_check_results is not None and managed_installs is not None:
+        update_dict["force_full_sync_at"] = None
+    MunkiState.objects.update_or_create(
+        machine_serial_number=serial_number,
+        defaults=update_dict
+    )
+
+    # events
+    yield build_munki_request_event(
+        serial_number,
+        user_agent, ip,
+        created_at=request_time.replace(tzinfo=timezone.utc),
+        **munki_request_event_kwargs
+    )
+
+    yield from iter_munki_events(
+        serial_number,
+        user_agent, ip,
+        (r for _, _, r in reports)
+    )
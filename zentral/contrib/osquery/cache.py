@@ -0,0 +1,281 @@
+from collections import Counter, OrderedDict, namedtuple
+import logging
+import os
+import threading
+import time
+import weakref
+from django.db.models import Q
+from django.utils import timezone
+from base.notifier import notifier
+from zentral.utils.text import shard
+
+
+logger = logging.getLogger("zentral.contrib.osquery.cache")
+
+
+IndexedDistributedQuery = namedtuple(
+    "IndexedDistributedQuery",
+    ("pk", "valid_from", "valid_until", "platforms", "serial_numbers", "tag_ids",
+     "minimum_osquery_version_tuple", "shard")
+)
+
+
+class DistributedQueryIndex:
+    """
+    Process-wide index of the distributed queries that are active, or will be.
+
+    Used to answer the osquery distributed reads without DB queries when the machine has nothing to run.
+    The candidates are selected in memory, with the same criteria as the
+    DistributedQueryManager.iter_queries_for_enrolled_machine method. For each machine, the candidates
+    that were not pending during the last DB lookup are also kept, with a TTL.
+
+    The index is reloaded after the TTL, and after the notifications on the
+    'osquery.distributed_query' channel. Without sync, the index is disabled.
+    """
+    channel = "osquery.distributed_query"
+
+    def __init__(self, ttl=60, machine_ttl=300, max_machines=10000, with_sync=False):
+        self.ttl = ttl
+        self.machine_ttl = machine_ttl
+        self.max_machines = max_machines
+        self.with_sync = with_sync
+        self._distributed_queries = None
+        self._expiry = None
+        self._machines = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._sync_started = False
+        self.counters = Counter()
+
+    @property
+    def enabled(self):
+        return self.with_sync
+
+    def _start_sync(self):
+        if not self._sync_started:
+            notifier.add_callback(self.channel, weakref.WeakMethod(self._notification_handler))
+            self._sync_started = True
+
+    def _notification_handler(self, data):
+        self.clear()
+
+    @staticmethod
+    def _load():
+        from .models import DistributedQuery
+        return [
+            IndexedDistributedQuery(
+                dq.pk,
+                dq.valid_from,
+                dq.valid_until,
+                frozenset(dq.platforms),
+                frozenset(dq.serial_numbers),
+                frozenset(t.pk for t in dq.tags.all()),
+                dq.minimum_osquery_version_tuple,
+                dq.shard,
+            )
+            for dq in (DistributedQuery.objects.filter(Q(valid_until__isnull=True)
+                                                       | Q(valid_until__gte=timezone.now()))
+                                               .prefetch_related("tags")
+                                               .order_by("pk"))
+        ]
+
+    def _get_distributed_queries(self):
+        """Returns the indexed distributed queries, and the generation to use to set the machine entries"""
+        with self._lock:
+            self._start_sync()
+            generation = self._generation
+            if self._distributed_queries is not None and self._expiry > time.monotonic():
+                return self._distributed_queries, generation
+        distributed_queries = self._load()
+        with self._lock:
+            if generation == self._generation:
+                self._distributed_queries = distributed_queries
+                self._expiry = time.monotonic() + self.ttl
+        return distributed_queries, generation
+
+    def _get_not_pending_pks(self, serial_number):
+        with self._lock:
+            entry = self._machines.get(serial_number)
+            if entry is not None:
+                expiry, not_pending_pks = entry
+                if expiry > time.monotonic():
+                    self._machines.move_to_end(serial_number)
+                    return not_pending_pks
+                del self._machines[serial_number]
+        return frozenset()
+
+    def get_candidate_pks(self, enrolled_machine, get_tag_ids):
+        """Returns the pks of the distributed queries that could be pending for the machine, and the generation
+
+        get_tag_ids is only called if a candidate distributed query is scoped with tags.
+        Returns None, None if the index is disabled.
+        """
+        if not self.enabled:
+            return None, None
+        distributed_queries, generation = self._get_distributed_queries()
+        serial_number = enrolled_machine.serial_number
+        not_pending_pks = self._get_not_pending_pks(serial_number)
+        now = timezone.now()
+        tag_ids = None
+        candidate_pks = []
+        for dq in distributed_queries:
+            if (
+                dq.pk in not_pending_pks
+                or dq.valid_from > now
+                or (dq.valid_until and dq.valid_until < now)
+                or (dq.platforms and dq.platforms.isdisjoint(enrolled_machine.platforms))
+                or (dq.serial_numbers and serial_number not in dq.serial_numbers)
+                or dq.minimum_osquery_version_tuple > enrolled_machine.osquery_version_tuple
+                or (dq.shard < 100 and shard(serial_number, dq.pk) > dq.shard)
+            ):
+                continue
+            if dq.tag_ids:
+                if tag_ids is None:
+                    tag_ids = set(get_tag_ids())
+                if dq.tag_ids.isdisjoint(tag_ids):
+                    continue
+            candidate_pks.append(dq.pk)
+        self.counters["candidates" if candidate_pks else "no_candidates"] += 1
+        return candidate_pks, generation
+
+    def set_not_pending_pks(self, serial_number, pks, generation):
+        """Store the pks of the distributed queries that are not pending anymore for the machine"""
+        if not self.enabled or not pks:
+            return
+        with self._lock:
+            if generation != self._generation:
+                # invalidated during the DB lookup
+                return
+            entry = self._machines.get(serial_number)
+            if entry is not None and entry[0] > time.monotonic():
+                pks = entry[1].union(pks)
+            self._machines[serial_number] = (time.monotonic() + self.machine_ttl, frozenset(pks))
+            self._machines.move_to_end(serial_number)
+            while len(self._machines) > self.max_machines:
+                self._machines.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._distributed_queries = None
+            self._expiry = None
+            self._machines.clear()
+
+    def invalidate(self):
+        """Clear the local index, and notify the other processes"""
+        self.clear()
+        if self.enabled:
+            notifier.send_notification(self.channel)
+
+    def get_counters(self):
+        return dict(self.counters)
+
+
+ConfigurationEntry = namedtuple("ConfigurationEntry", ("expiry", "relevant_tag_ids", "responses"))
+
+
+class ConfigurationCache:
+    """
+    Process-wide cache of the rendered osquery configurations.
+
+    For each configuration, the ids of the tags used to scope the configuration packs are kept, with the rendered
+    configurations, keyed by the machine inventory options and the relevant machine tag ids.
+
+    The entries are cleared after the TTL, and after the notifications on the
+    'osquery.configuration' channel, sent when a related object is updated. Without sync, the cache is disabled.
+    """
+    channel = "osquery.configuration"
+
+    def __init__(self, ttl=300, max_responses=100, with_sync=False):
+        self.ttl = ttl
+        self.max_responses = max_responses
+        self.with_sync = with_sync
+        self._configurations = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._sync_started = False
+        self.counters = Counter()
+
+    @property
+    def enabled(self):
+        return self.with_sync
+
+    def _start_sync(self):
+        if not self._sync_started:
+            notifier.add_callback(self.channel, weakref.WeakMethod(self._notification_handler))
+            self._sync_started = True
+
+    def _notification_handler(self, data):
+        self.clear()
+
+    def _get_entry(self, configuration_pk):
+        entry = self._configurations.get(configuration_pk)
+        if entry is not None:
+            if entry.expiry > time.monotonic():
+                return entry
+            del self._configurations[configuration_pk]
+
+    def get_relevant_tag_ids(self, configuration_pk):
+        """Returns the relevant tag ids of the configuration, and the generation to use to set the entries
+
+        The relevant tag ids are None if the configuration is not cached.
+        """
+        with self._lock:
+            self._start_sync()
+            entry = self._get_entry(configuration_pk)
+            return (None if entry is None else entry.relevant_tag_ids), self._generation
+
+    def set_relevant_tag_ids(self, configuration_pk, relevant_tag_ids, generation):
+        with self._lock:
+            if generation != self._generation:
+                # invalidated during the DB lookup
+                return
+            self._configurations[configuration_pk] = ConfigurationEntry(
+                time.monotonic() + self.ttl, frozenset(relevant_tag_ids), OrderedDict()
+            )
+
+    def get_response(self, configuration_pk, key):
+        """Returns the cached response content and ETag, or None"""
+        with self._lock:
+            entry = self._get_entry(configuration_pk)
+            if entry is not None:
+                response = entry.responses.get(key)
+                if response is not None:
+                    entry.responses.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return response
+        self.counters["misses"] += 1
+
+    def set_response(self, configuration_pk, key, response, generation):
+        with self._lock:
+            if generation != self._generation:
+                # invalidated during the rendering
+                return
+            entry = self._get_entry(configuration_pk)
+            if entry is None:
+                return
+            entry.responses[key] = response
+            entry.responses.move_to_end(key)
+            while len(entry.responses) > self.max_responses:
+                entry.responses.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._configurations.clear()
+
+    def invalidate(self):
+        """Clear the local entries, and notify the other processes"""
+        self.clear()
+        if self.enabled:
+            notifier.send_notification(self.channel)
+
+    def get_counters(self):
+        return dict(self.counters)
+
+
+zentral_osquery_sync = os.environ.get("ZENTRAL_OSQUERY_SYNC", "1") == "1"
+
+
+configuration_cache = ConfigurationCache(with_sync=zentral_osquery_sync)
+distributed_query_index = DistributedQueryIndex(with_sync=zentral_osquery_sync)
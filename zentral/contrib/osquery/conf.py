@@ -1,6 +1,11 @@
+import hashlib
+import json
 import logging
 from zentral.contrib.inventory.conf import LINUX, MACOS, WINDOWS
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q
+from .cache import configuration_cache
+from .models import ConfigurationPack
 
 
 logger = logging.getLogger('zentral.contrib.osquery.conf')
@@ -153,8 +158,36 @@ def get_inventory_query_for_machine(machine, include_apps, include_ec2):
     return "".join(q for _, q in _get_inventory_queries_for_machine(machine, include_apps, include_ec2))
 
 
-def build_osquery_conf(machine, enrollment):
+def get_machine_tag_ids(machine):
+    return set(pk for pk, _ in machine.tag_pks_and_names)
+
+
+def get_machine_inventory_options(machine, configuration):
+    """Returns the machine attributes used to build the inventory query"""
+    if not configuration.inventory:
+        return None
+    platform = machine.platform
+    has_deb_packages = (
+        configuration.inventory_apps
+        and platform not in (MACOS, WINDOWS)
+        and machine.has_deb_packages
+    )
+    return platform, has_deb_packages
+
+
+def get_configuration_relevant_tag_ids(configuration):
+    """Returns the ids of the tags used to scope the configuration packs"""
+    tag_ids = set()
+    for through in (ConfigurationPack.tags.through, ConfigurationPack.excluded_tags.through):
+        tag_ids.update(through.objects.filter(configurationpack__configuration=configuration)
+                                      .values_list("tag_id", flat=True))
+    return tag_ids
+
+
+def build_osquery_conf(machine, enrollment, tag_ids=None):
     configuration = enrollment.configuration
+    if tag_ids is None:
+        tag_ids = get_machine_tag_ids(machine)
 
     conf = {
         'decorators': DECORATORS,
@@ -195,8 +228,8 @@ def build_osquery_conf(machine, enrollment):
     # Packs
     for configuration_pack in (configuration.configurationpack_set
                                             .distinct()
-                                            .exclude(excluded_tags__in=machine.tags)
-                                            .filter(Q(tags__isnull=True) | Q(tags__in=machine.tags))
+                                            .exclude(excluded_tags__in=tag_ids)
+                                            .filter(Q(tags__isnull=True) | Q(tags__in=tag_ids))
                                             .select_related("pack")
                                             .prefetch_related("pack__packquery_set__query__compliance_check",
                                                               "pack__packquery_set__query__tag")):
@@ -204,3 +237,30 @@ def build_osquery_conf(machine, enrollment):
         conf.setdefault("packs", {})[pack.configuration_key()] = pack.serialize()
 
     return conf
+
+
+def _serialize_osquery_conf(conf):
+    content = json.dumps(conf, cls=DjangoJSONEncoder).encode("utf-8")
+    return content, hashlib.sha1(content).hexdigest()
+
+
+def get_osquery_conf_response(machine, enrollment):
+    """Returns the serialized osquery configuration and its ETag
+
+    The rendered configurations are cached per configuration, machine inventory options and relevant machine tags.
+    """
+    if not configuration_cache.enabled:
+        return _serialize_osquery_conf(build_osquery_conf(machine, enrollment))
+    configuration = enrollment.configuration
+    relevant_tag_ids, generation = configuration_cache.get_relevant_tag_ids(configuration.pk)
+    if relevant_tag_ids is None:
+        relevant_tag_ids = get_configuration_relevant_tag_ids(configuration)
+        configuration_cache.set_relevant_tag_ids(configuration.pk, relevant_tag_ids, generation)
+    # the machine tags are only fetched if some configuration packs are scoped with tags
+    tag_ids = get_machine_tag_ids(machine) if relevant_tag_ids else set()
+    key = (get_machine_inventory_options(machine, configuration), frozenset(tag_ids.intersection(relevant_tag_ids)))
+    response = configuration_cache.get_response(configuration.pk, key)
+    if response is None:
+        response = _serialize_osquery_conf(build_osquery_conf(machine, enrollment, tag_ids))
+        configuration_cache.set_response(configuration.pk, key, response, generation)
+    return response
@@ -3,15 +3,18 @@ import logging
 import os.path
 from django.contrib.postgres.fields import ArrayField
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.functional import cached_property
 from zentral.conf import settings
 from zentral.contrib.inventory.models import BaseEnrollment, Tag
+from zentral.core.compliance_checks.models import ComplianceCheck
 from zentral.utils.sql import tables_in_query, format_sql
 from zentral.utils.text import shard
+from .cache import configuration_cache, distributed_query_index
 from .specs import cli_only_flags
 
 
@@ -568,7 +571,7 @@ class DistributedQueryManager(models.Manager):
                 .filter(valid_from__lte=now)
         )
 
-    def iter_queries_for_enrolled_machine(self, enrolled_machine, tags):
+    def iter_queries_for_enrolled_machine(self, enrolled_machine, tags, pks=None):
         serial_number = enrolled_machine.serial_number
         qs = (
             self.active()
@@ -579,6 +582,8 @@ class DistributedQueryManager(models.Manager):
                 .exclude(distributedquerymachine__serial_number=serial_number)
                 .order_by("pk")
         )
+        if pks is not None:
+            qs = qs.filter(pk__in=pks)
         for dq in qs:
             # min osquery version verification
             if dq.minimum_osquery_version_tuple > enrolled_machine.osquery_version_tuple:
@@ -747,3 +752,58 @@ class FileCarvingBlock(models.Model):
 
     class Meta:
         unique_together = (("file_carving_session", "block_id"),)
+
+
+# signals
+
+
+def invalidate_distributed_query_index(sender, **kwargs):
+    if distributed_query_index.enabled:
+        transaction.on_commit(distributed_query_index.invalidate)
+
+
+post_save.connect(invalidate_distributed_query_index, sender=DistributedQuery)
+post_delete.connect(invalidate_distributed_query_index, sender=DistributedQuery)
+# the distributed query tags are removed without m2m_changed signals
+post_delete.connect(invalidate_distributed_query_index, sender=Tag)
+
+
+def invalidate_distributed_query_tags_index(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        invalidate_distributed_query_index(sender)
+
+
+m2m_changed.connect(invalidate_distributed_query_tags_index, sender=DistributedQuery.tags.through)
+
+
+def invalidate_configuration_cache(sender, **kwargs):
+    if configuration_cache.enabled:
+        transaction.on_commit(configuration_cache.invalidate)
+
+
+for sender in (AutomaticTableConstruction, Configuration, ConfigurationPack, FileCategory, Pack, PackQuery, Query):
+    post_save.connect(invalidate_configuration_cache, sender=sender)
+    post_delete.connect(invalidate_configuration_cache, sender=sender)
+# the configuration pack tags are removed, and the query tags are unset, without signals
+post_delete.connect(invalidate_configuration_cache, sender=Tag)
+
+
+def invalidate_configuration_compliance_check_cache(sender, instance, **kwargs):
+    # the query compliance checks are unset without signals
+    if instance.model == "OsqueryCheck":
+        invalidate_configuration_cache(sender)
+
+
+post_delete.connect(invalidate_configuration_compliance_check_cache, sender=ComplianceCheck)
+
+
+def invalidate_configuration_m2m_cache(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        invalidate_configuration_cache(sender)
+
+
+for sender in (Configuration.automatic_table_constructions.through,
+               Configuration.file_categories.through,
+               ConfigurationPack.excluded_tags.through,
+               ConfigurationPack.tags.through):
+    m2m_changed.connect(invalidate_configuration_m2m_cache, sender=sender)
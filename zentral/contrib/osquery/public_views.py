@@ -8,8 +8,9 @@ import pytz
 from django.core.exceptions import SuspiciousOperation, PermissionDenied
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
-from django.http import Http404, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.utils.crypto import get_random_string
+from django.utils.http import quote_etag
 from django.utils.timezone import make_naive
 from django.views.generic import View
 from zentral.contrib.inventory.events import post_machine_snapshot_raw_event
@@ -18,8 +19,9 @@ from zentral.contrib.inventory.models import MachineSnapshot, MetaMachine
 from zentral.contrib.inventory.utils import (add_machine_tags,
                                              commit_machine_snapshot_and_trigger_events,
                                              verify_enrollment_secret)
+from zentral.contrib.osquery.cache import distributed_query_index
 from zentral.contrib.osquery.compliance_checks import ComplianceCheckStatusAggregator
-from zentral.contrib.osquery.conf import build_osquery_conf, INVENTORY_QUERY_NAME
+from zentral.contrib.osquery.conf import get_osquery_conf_response, INVENTORY_QUERY_NAME
 from zentral.contrib.osquery.events import (post_enrollment_event,
                                             post_file_carve_events,
                                             post_request_event, post_results, post_status_logs)
@@ -58,7 +60,10 @@ class BaseJsonPostView(View):
         self.user_agent, self.ip = user_agent_and_ip_address_from_request(request)
         try:
             self.authenticate()
-            return JsonResponse(self.do_post())
+            response = self.do_post()
+            if not isinstance(response, HttpResponse):
+                response = JsonResponse(response)
+            return response
         except NodeInvalidError:
             return JsonResponse({"node_invalid": True})
 
@@ -190,7 +195,10 @@ class ConfigView(BaseNodeView):
     request_type = "config"
 
     def do_node_post(self):
-        return build_osquery_conf(self.machine, self.enrollment)
+        content, etag = get_osquery_conf_response(self.machine, self.enrollment)
+        response = HttpResponse(content, content_type="application/json")
+        response["ETag"] = quote_etag(etag)
+        return response
 
 
 class StartFileCarvingView(BaseNodeView):
@@ -286,10 +294,19 @@ class DistributedReadView(BaseNodeView):
     request_type = "distributed_read"
     batch_size = 10  # TODO: hard coded
 
+    def get_machine_tag_ids(self):
+        return (pk for pk, _ in self.machine.tag_pks_and_names)
+
     def do_node_post(self):
+        candidate_pks, generation = distributed_query_index.get_candidate_pks(self.enrolled_machine,
+                                                                              self.get_machine_tag_ids)
+        if candidate_pks is not None and not candidate_pks:
+            # nothing to run, no DB queries
+            return {'queries': {}}
         dqm_list = []
         for distributed_query in islice(
-            DistributedQuery.objects.iter_queries_for_enrolled_machine(self.enrolled_machine, self.machine.tags),
+            DistributedQuery.objects.iter_queries_for_enrolled_machine(self.enrolled_machine, self.machine.tags,
+                                                                       candidate_pks),
             self.batch_size
         ):
             dqm_list.append(
@@ -303,6 +320,13 @@ class DistributedReadView(BaseNodeView):
             DistributedQueryMachine.objects.bulk_create(dqm_list)
             for dqm in dqm_list:
                 queries[str(dqm.pk)] = dqm.distributed_query.sql
+        if candidate_pks:
+            if len(dqm_list) < self.batch_size:
+                # the candidates that were not returned were already run by the machine
+                not_pending_pks = candidate_pks
+            else:
+                not_pending_pks = [dqm.distributed_query.pk for dqm in dqm_list]
+            distributed_query_index.set_not_pending_pks(self.machine.serial_number, not_pending_pks, generation)
         return {'queries': queries}
 
 
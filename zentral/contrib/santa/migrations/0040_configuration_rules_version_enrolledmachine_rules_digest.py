@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-17 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('santa', '0039_rule_cel_expr_rule_notification_app_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='rules_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='enrolledmachine',
+            name='rules_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
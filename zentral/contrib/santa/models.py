@@ -1,10 +1,12 @@
 from collections import namedtuple
+import hashlib
 import logging
 import uuid
 from django.core.validators import MaxValueValidator, MinLengthValidator, MinValueValidator
 from django.contrib.postgres.fields import ArrayField
 from django.db import connection, models
-from django.db.models import Count, Q
+from django.db.models import Count, F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
@@ -492,6 +494,9 @@ class ConfigurationManager(models.Manager):
             enrollment_count=0
         )
 
+    def bump_rules_version(self, configuration_pks):
+        return self.filter(pk__in=configuration_pks).update(rules_version=F("rules_version") + 1)
+
 
 class Configuration(models.Model):
     MONITOR_MODE = 1
@@ -638,6 +643,9 @@ class Configuration(models.Model):
                   "rules are out of sync."
     )
 
+    # incremented each time the rules of the configuration change
+    rules_version = models.PositiveIntegerField(default=1, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -699,6 +707,10 @@ class Configuration(models.Model):
         return config
 
     def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # never overwrite the rules version with a stale value
+            kwargs["update_fields"] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != "rules_version"]
         super().save(*args, **kwargs)
         for enrollment in self.enrollment_set.all():
             # per default, will bump the enrollment version
@@ -847,6 +859,7 @@ class EnrolledMachine(models.Model):
     transitive_rule_count = models.IntegerField(null=True)
     teamid_rule_count = models.IntegerField(null=True)
     last_sync_ok = models.BooleanField(null=True)
+    rules_digest = models.CharField(max_length=64, null=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -1133,7 +1146,36 @@ class MachineRuleManager(models.Manager):
                     rule_info_d[key] = val
             yield rule_info_d
 
+    @staticmethod
+    def get_rules_digest(enrolled_machine, configuration_pk, rules_version, tags):
+        h = hashlib.sha256()
+        # the santa version gates change the rules delivered to the machine
+        cmp_santa_version = enrolled_machine.get_comparable_santa_version()
+        for val in (configuration_pk,
+                    rules_version,
+                    enrolled_machine.serial_number,
+                    enrolled_machine.primary_user or "",
+                    ",".join(str(tag_id) for tag_id in sorted(tags)),
+                    int(cmp_santa_version < (2025, 6)),  # CEL rules skipped
+                    int(cmp_santa_version < (2022, 1))):  # sha256 rule attribute
+            h.update(f"{val}\x00".encode("utf-8"))
+        return h.hexdigest()
+
     def get_next_rule_batch(self, enrolled_machine, tags, cursor=None):
+        # rules digest stored after the last complete sync
+        # not read from the enrolled machine, because it can come from the sync cache
+        stored_rules_digest, configuration_pk, rules_version = (
+            EnrolledMachine.objects.filter(pk=enrolled_machine.pk)
+                                   .values_list("rules_digest",
+                                                "enrollment__configuration__pk",
+                                                "enrollment__configuration__rules_version")
+                                   .get()
+        )
+        rules_digest = self.get_rules_digest(enrolled_machine, configuration_pk, rules_version, tags)
+        if cursor is None and stored_rules_digest == rules_digest:
+            # nothing changed for the machine since the last complete sync
+            return [], None
+
         qs = self.filter(enrolled_machine=enrolled_machine).select_for_update()
 
         # fresh start from last known OK state
@@ -1158,6 +1200,7 @@ class MachineRuleManager(models.Manager):
 
         # return next batch
         rules = []
+        machine_rules = []
         new_cursor = None
         cmp_santa_version = enrolled_machine.get_comparable_santa_version()
         use_sha256_attr = cmp_santa_version < (2022, 1)
@@ -1174,17 +1217,24 @@ class MachineRuleManager(models.Manager):
                 rule.pop("custom_msg", None)
             if use_sha256_attr and Target.Type(rule["rule_type"]).has_sha256_identifier:
                 rule["sha256"] = rule.pop("identifier")
-            self.update_or_create(enrolled_machine=enrolled_machine,
-                                  target=Target(pk=target_id),
-                                  defaults={
-                                      "policy": policy,
-                                      "version": version,
-                                      "cursor": new_cursor,
-                                  })
+            machine_rules.append(MachineRule(enrolled_machine=enrolled_machine,
+                                             target_id=target_id,
+                                             policy=policy,
+                                             version=version,
+                                             cursor=new_cursor))
             rules.append(rule)
         response_cursor = None
         if len(rules):
             response_cursor = new_cursor
+            # single INSERT … ON CONFLICT (enrolled_machine_id, target_id) DO UPDATE
+            self.bulk_create(machine_rules,
+                             update_conflicts=True,
+                             unique_fields=["enrolled_machine", "target"],
+                             update_fields=["policy", "version", "cursor"])
+            # the machine is only in sync once all the rules have been acknowledged
+            rules_digest = None
+        if rules_digest != stored_rules_digest:
+            EnrolledMachine.objects.filter(pk=enrolled_machine.pk).update(rules_digest=rules_digest)
         return rules, response_cursor
 
 
@@ -1199,3 +1249,35 @@ class MachineRule(models.Model):
 
     class Meta:
         unique_together = (("enrolled_machine", "target"),)
+
+
+# signals
+
+
+def bump_rule_configuration_rules_version(sender, instance, **kwargs):
+    Configuration.objects.bump_rules_version([instance.configuration_id])
+
+
+post_save.connect(bump_rule_configuration_rules_version, sender=Rule)
+post_delete.connect(bump_rule_configuration_rules_version, sender=Rule)
+
+
+def bump_rule_tags_configuration_rules_version(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear") and isinstance(instance, Rule):
+        Configuration.objects.bump_rules_version([instance.configuration_id])
+
+
+m2m_changed.connect(bump_rule_tags_configuration_rules_version, sender=Rule.tags.through)
+m2m_changed.connect(bump_rule_tags_configuration_rules_version, sender=Rule.excluded_tags.through)
+
+
+def bump_tag_configurations_rules_version(sender, instance, **kwargs):
+    # the rule tags are removed without m2m_changed signals
+    configuration_pks = set(
+        Rule.objects.filter(Q(tags=instance) | Q(excluded_tags=instance)).values_list("configuration_id", flat=True)
+    )
+    if configuration_pks:
+        Configuration.objects.bump_rules_version(configuration_pks)
+
+
+pre_delete.connect(bump_tag_configurations_rules_version, sender=Tag)
@@ -309,6 +309,7 @@ class PreflightView(BaseSyncView):
         )
         if clean_sync:
             MachineRule.objects.filter(enrolled_machine=self.enrolled_machine).delete()
+            EnrolledMachine.objects.filter(pk=self.enrolled_machine.pk).update(rules_digest=None)
             if comparable_santa_version < (2024, 1):
                 response_dict["clean_sync"] = True
             else:
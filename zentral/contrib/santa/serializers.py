@@ -21,7 +21,7 @@ logger = logging.getLogger("zentral.contrib.santa.serializers")
 class ConfigurationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Configuration
-        fields = '__all__'
+        exclude = ("rules_version",)
 
 
 class EnrollmentSerializer(serializers.ModelSerializer):
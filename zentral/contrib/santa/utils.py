@@ -7,7 +7,7 @@ from django.urls import reverse
 import psycopg2.extras
 from zentral.conf import settings
 from zentral.utils.payloads import generate_payload_uuid, get_payload_identifier, sign_payload
-from .models import Rule, Target
+from .models import Configuration, Rule, Target
 
 
 def build_santa_enrollment_configuration(enrollment):
@@ -562,6 +562,8 @@ def update_voting_rules(configurations):
                     replaced_rules[result["id"]] = result
                 else:
                     changed_rules.append((op, result))
+        if changed_rules:
+            Configuration.objects.bump_rules_version({result["configuration_pk"] for _, result in changed_rules})
 
     def result_to_serialized_rule(result):
         configuration = {"pk": result.pop("configuration_pk"),
@@ -15,6 +15,7 @@ from zentral.core.incidents.models import IncidentUpdate
 from zentral.core.probes.conf import all_probes_dict
 from zentral.core.queues import queues
 from zentral.utils.http import user_agent_and_ip_address_from_request
+from zentral.utils.json import dumps_bytes
 from zentral.utils.text import decode_args, encode_args
 from .template_loader import TemplateLoader
 from . import register_event_type
@@ -364,7 +365,16 @@ class EventMetadata(object):
                 d['machine'] = machine_d
         return d
 
+    def _clear_event_serialized_bytes(self):
+        event = getattr(self, "event", None)
+        if event is not None:
+            try:
+                event.clear_serialized_bytes()
+            except ReferenceError:
+                pass
+
     def add_probe(self, probe, with_incident_updates=True):
+        self._clear_event_serialized_bytes()
         self.probes.append(probe.serialize_for_event_metadata())
         if not with_incident_updates:
             return
@@ -378,6 +388,7 @@ class EventMetadata(object):
                 self.incident_updates.append(incident_update)
 
     def add_objects(self, extra_objects):
+        self._clear_event_serialized_bytes()
         for extra_obj_key, extra_obj_args_list in extra_objects.items():
             if not extra_obj_args_list:
                 # should never happen
@@ -463,6 +474,23 @@ class BaseEvent(object):
         event_d['_zentral'] = self.metadata.serialize(machine_metadata)
         return event_d
 
+    def serialize_bytes(self, machine_metadata=True):
+        """JSON encoded serialized event
+
+        The encoded bytes are cached on the event, to be reused by the queues and the stores.
+        The cache is cleared when probes or linked objects are added to the metadata.
+        Clear it with clear_serialized_bytes if the payload or the metadata are updated otherwise.
+        """
+        serialized_bytes = self.__dict__.setdefault("_serialized_bytes", {})
+        try:
+            return serialized_bytes[machine_metadata]
+        except KeyError:
+            data = serialized_bytes[machine_metadata] = dumps_bytes(self.serialize(machine_metadata))
+            return data
+
+    def clear_serialized_bytes(self):
+        self.__dict__.pop("_serialized_bytes", None)
+
     def post(self):
         queues.post_event(self)
 
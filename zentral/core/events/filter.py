@@ -1,3 +1,4 @@
+from collections import Counter
 from collections.abc import Mapping, Sequence
 
 
@@ -38,10 +39,57 @@ class EventFilter:
                 yield attr, val
 
 
+class CompiledEventFilters:
+    """
+    Lookup tables for a list of event filters.
+
+    Each filter is indexed by its event types, or its routing keys, or its tags,
+    so that only the filters that can match an event are evaluated.
+    """
+
+    def __init__(self, event_filters):
+        self.event_filters = event_filters
+        self.event_types = {}
+        self.routing_keys = {}
+        self.tags = {}
+        self.wildcard = []
+        for position, event_filter in enumerate(event_filters):
+            for attr, table in (("event_type", self.event_types),
+                                ("routing_key", self.routing_keys),
+                                ("tags", self.tags)):
+                values = getattr(event_filter, attr)
+                if values:
+                    for value in values:
+                        table.setdefault(value, []).append(position)
+                    break
+            else:
+                self.wildcard.append(position)
+
+    def iter_candidates(self, tags, event_type, routing_key):
+        positions = set(self.wildcard)
+        positions.update(self.event_types.get(event_type, ()))
+        if routing_key is not None:
+            positions.update(self.routing_keys.get(routing_key, ()))
+        for tag in tags:
+            positions.update(self.tags.get(tag, ()))
+        for position in sorted(positions):
+            yield position, self.event_filters[position]
+
+    def first_match(self, tags, event_type, routing_key):
+        for position, event_filter in self.iter_candidates(tags, event_type, routing_key):
+            if event_filter.match(tags, event_type, routing_key):
+                return position
+
+
 class EventFilterSet:
+    max_compiled_decisions = 4096
+
     def __init__(self, excluded_event_filters=None, included_event_filters=None):
         self.excluded_event_filters = excluded_event_filters
         self.included_event_filters = included_event_filters
+        self._compiled_excluded_event_filters = self._compiled_included_event_filters = None
+        self._compiled_decisions = None
+        self.drop_counters = Counter()
 
     @classmethod
     def from_mapping(cls, filter_set_m):
@@ -72,15 +120,81 @@ class EventFilterSet:
              or any(f.match(tags, event_type, routing_key) for f in self.included_event_filters))
         )
 
-    def match_serialized_event(self, serialized_event):
+    # compiled filters
+
+    def compile(self):
+        if self.excluded_event_filters:
+            self._compiled_excluded_event_filters = CompiledEventFilters(self.excluded_event_filters)
+        if self.included_event_filters:
+            self._compiled_included_event_filters = CompiledEventFilters(self.included_event_filters)
+        self._compiled_decisions = {}
+
+    @property
+    def compiled(self):
+        return self._compiled_decisions is not None
+
+    def _get_compiled_decision(self, tags, event_type, routing_key):
+        # the decisions only depend on the event type, routing key and tags
+        key = (event_type, routing_key, frozenset(tags))
+        try:
+            return self._compiled_decisions[key]
+        except KeyError:
+            pass
+        drop_key = None
+        if self._compiled_excluded_event_filters:
+            position = self._compiled_excluded_event_filters.first_match(tags, event_type, routing_key)
+            if position is not None:
+                drop_key = f"excluded_event_filters.{position}"
+        if (
+            drop_key is None
+            and self._compiled_included_event_filters
+            and self._compiled_included_event_filters.first_match(tags, event_type, routing_key) is None
+        ):
+            drop_key = "included_event_filters"
+        if len(self._compiled_decisions) >= self.max_compiled_decisions:
+            self._compiled_decisions.clear()
+        self._compiled_decisions[key] = drop_key
+        return drop_key
+
+    @staticmethod
+    def _get_serialized_event_attributes(serialized_event):
         try:
             metadata = serialized_event["_zentral"]
-            event_tags = metadata.get("tags", [])
-            event_type = metadata["type"]
-            event_routing_key = metadata.get("routing_key")
+            return metadata.get("tags", []), metadata["type"], metadata.get("routing_key")
         except (KeyError, TypeError):
             raise ValueError("Invalid serialized event")
-        return self._match(event_tags, event_type, event_routing_key)
+
+    def match_serialized_event(self, serialized_event):
+        event_tags, event_type, event_routing_key = self._get_serialized_event_attributes(serialized_event)
+        if not self.compiled:
+            return self._match(event_tags, event_type, event_routing_key)
+        drop_key = self._get_compiled_decision(event_tags, event_type, event_routing_key)
+        if drop_key is None:
+            return True
+        self.drop_counters[drop_key] += 1
+        return False
+
+    def filter_batch(self, serialized_events):
+        """Return the list of the included serialized events
+
+        The filter set is compiled on first use if necessary.
+        """
+        if not self:
+            return list(serialized_events)
+        if not self.compiled:
+            self.compile()
+        included_events = []
+        get_decision = self._get_compiled_decision
+        for serialized_event in serialized_events:
+            drop_key = get_decision(*self._get_serialized_event_attributes(serialized_event))
+            if drop_key is None:
+                included_events.append(serialized_event)
+            else:
+                self.drop_counters[drop_key] += 1
+        return included_events
+
+    def get_drop_counters(self):
+        return dict(self.drop_counters)
 
     def __bool__(self):
         return bool(self.excluded_event_filters) or bool(self.included_event_filters)
@@ -2,7 +2,9 @@ import logging
 import geoip2.database
 from . import event_from_event_d
 from zentral.conf import settings
+from zentral.contrib.inventory.cache import machine_filtering_values_cache
 from zentral.core.probes.conf import all_probes
+from zentral.core.incidents.cache import incident_state_cache
 from zentral.core.incidents.utils import apply_incident_updates
 
 
@@ -51,6 +53,12 @@ def enrich_event(event):
     yield event
 
 
+def iter_enrich_cache_counters():
+    # cumulative counters of the caches used during the enrichment
+    yield "machine_cache_lookups", machine_filtering_values_cache.get_counters()
+    yield "incident_updates", incident_state_cache.get_counters()
+
+
 def process_event(event):
     if isinstance(event, dict):
         event = event_from_event_d(event)
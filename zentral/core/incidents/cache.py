@@ -0,0 +1,161 @@
+from collections import Counter, OrderedDict
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from base.notifier import notifier
+
+
+logger = logging.getLogger("zentral.core.incidents.cache")
+
+
+_MISSING = object()
+
+
+class IncidentStateCache:
+    """
+    Process-wide TTL cache of the open incident and machine incident states, per incident type and key.
+
+    Used to answer the incident updates that would not change anything, without locking the incident rows.
+    The entries are invalidated across the processes with notifications on the 'incidents.incident'
+    channel. Without sync, the cache is disabled.
+
+    Incident state: (pk, severity, status) of the open incident, or None if there is no open incident.
+    Machine incident status: status of the open machine incident, or None if there is no OPEN machine incident.
+    """
+    channel = "incidents.incident"
+
+    def __init__(self, max_size=10000, ttl=30, with_sync=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.with_sync = with_sync
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._origin = uuid.uuid4().hex
+        self._sync_started = False
+        self.counters = Counter()
+
+    @property
+    def enabled(self):
+        return self.with_sync
+
+    def _start_sync(self):
+        if not self._sync_started:
+            notifier.add_callback(self.channel, weakref.WeakMethod(self._notification_handler))
+            self._sync_started = True
+
+    def _notification_handler(self, data):
+        try:
+            data = json.loads(data)
+            origin = data["origin"]
+            cache_key = data["key"]
+        except (KeyError, TypeError, ValueError):
+            logger.error("Invalid incident state cache notification")
+            cache_key = None
+        else:
+            if origin == self._origin:
+                return
+        self.clear(cache_key)
+
+    @staticmethod
+    def get_cache_key(incident_type, key):
+        return json.dumps([incident_type, key], sort_keys=True)
+
+    def _get_entry(self, incident_type, key):
+        cache_key = self.get_cache_key(incident_type, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            if entry["expiry"] > time.monotonic():
+                self._entries.move_to_end(cache_key)
+                return entry
+            del self._entries[cache_key]
+
+    def get_generation(self):
+        """Returns the generation to use to set the states"""
+        with self._lock:
+            return self._generation
+
+    def get_incident_state(self, incident_type, key):
+        """Returns a found flag, and the incident state"""
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            self._start_sync()
+            entry = self._get_entry(incident_type, key)
+            if entry is not None and "incident" in entry:
+                return True, entry["incident"]
+        return False, None
+
+    def get_machine_incident_status(self, incident_type, key, serial_number):
+        """Returns a found flag, and the machine incident status"""
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            self._start_sync()
+            entry = self._get_entry(incident_type, key)
+            if entry is not None and serial_number in entry["machines"]:
+                return True, entry["machines"][serial_number]
+        return False, None
+
+    def _update_entry(self, incident_type, key, generation, incident=_MISSING, machines=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation != self._generation:
+                # invalidated while the states were fetched
+                return
+            entry = self._get_entry(incident_type, key)
+            if entry is None:
+                entry = {"expiry": time.monotonic() + self.ttl, "machines": {}}
+                self._entries[self.get_cache_key(incident_type, key)] = entry
+            if incident is not _MISSING:
+                previous_incident = entry.get("incident")
+                if incident is None or previous_incident is None or previous_incident[0] != incident[0]:
+                    # the machine incident statuses of another incident are stale
+                    entry["machines"] = {}
+                entry["incident"] = incident
+            if machines:
+                entry["machines"].update(machines)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set_incident_state(self, incident_type, key, state, generation):
+        self._update_entry(incident_type, key, generation, incident=state)
+
+    def set_machine_incident_status(self, incident_type, key, serial_number, status, generation):
+        self._update_entry(incident_type, key, generation, machines={serial_number: status})
+
+    def clear(self, cache_key=None):
+        with self._lock:
+            self._generation += 1
+            if cache_key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(cache_key, None)
+
+    def notify(self, incident_type, key):
+        """Notify the other processes that the states have changed"""
+        if self.enabled:
+            cache_key = self.get_cache_key(incident_type, key)
+            notifier.send_notification(self.channel, json.dumps({"origin": self._origin, "key": cache_key}))
+
+    def invalidate(self, incident_type, key):
+        """Clear the local entry, and notify the other processes"""
+        self.clear(self.get_cache_key(incident_type, key))
+        self.notify(incident_type, key)
+
+    def inc(self, result):
+        self.counters[result] += 1
+
+    def get_counters(self):
+        return dict(self.counters)
+
+
+zentral_incidents_sync = os.environ.get("ZENTRAL_INCIDENTS_SYNC", "1") == "1"
+
+
+incident_state_cache = IncidentStateCache(with_sync=zentral_incidents_sync)
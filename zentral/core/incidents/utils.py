@@ -1,8 +1,9 @@
 from datetime import datetime
 import logging
 import uuid
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, OperationalError, transaction
 from zentral.core.events.base import EventMetadata, EventRequest
+from .cache import incident_state_cache
 from .models import Incident, MachineIncident, Severity, Status
 from .events import (IncidentCreatedEvent, IncidentSeverityUpdatedEvent, IncidentStatusUpdatedEvent,
                      MachineIncidentCreatedEvent, MachineIncidentStatusUpdatedEvent)
@@ -11,7 +12,50 @@ from .events import (IncidentCreatedEvent, IncidentSeverityUpdatedEvent, Inciden
 logger = logging.getLogger("zentral.core.incidents.utils")
 
 
-def open_incident(incident_update):
+_NOT_SET = object()
+
+
+def _select_for_update(queryset, **lookup):
+    # try first without waiting, to count the lock contentions
+    try:
+        with transaction.atomic():
+            return queryset.select_for_update(nowait=True).get(**lookup)
+    except OperationalError:
+        incident_state_cache.inc("lock_contention")
+    return queryset.select_for_update().get(**lookup)
+
+
+def _get_incident_state(incident):
+    if incident is None or incident.status not in Status.open_values():
+        return None
+    return (incident.pk, incident.severity, incident.status)
+
+
+def _cache_states_on_commit(incident_update, generation, incident=_NOT_SET, serial_number=None,
+                            machine_incident_status=_NOT_SET, transition=False):
+    def update_cache():
+        incident_type = incident_update.incident_type
+        key = incident_update.key
+        if incident is not _NOT_SET:
+            incident_state_cache.set_incident_state(incident_type, key, _get_incident_state(incident), generation)
+        if machine_incident_status is not _NOT_SET:
+            incident_state_cache.set_machine_incident_status(incident_type, key, serial_number,
+                                                             machine_incident_status, generation)
+        if transition:
+            incident_state_cache.notify(incident_type, key)
+    transaction.on_commit(update_cache)
+
+
+def _get_cached_open_incident_pk(incident_update):
+    # pk of the cached open incident, if its severity does not need to be updated
+    found, state = incident_state_cache.get_incident_state(incident_update.incident_type, incident_update.key)
+    if found and state is not None:
+        pk, severity, _ = state
+        if severity >= incident_update.severity.value:
+            return pk
+
+
+def open_incident(incident_update, generation=None):
     # get or update (severity) open incident
     event_cls = event_payload = None
     extra_event_payload = {}
@@ -19,7 +63,7 @@ def open_incident(incident_update):
               "key": incident_update.key,
               "status__in": Status.open_values()}
     try:
-        incident = Incident.objects.select_for_update().get(**lookup)
+        incident = _select_for_update(Incident.objects.all(), **lookup)
     except Incident.DoesNotExist:
         # create
         try:
@@ -53,21 +97,34 @@ def open_incident(incident_update):
         event_args = (event_cls, event_payload)
     else:
         event_args = None
+    if generation is not None:
+        _cache_states_on_commit(incident_update, generation, incident=incident, transition=bool(event_args))
     return incident, event_args
 
 
-def close_open_incident(incident_update):
+def close_open_incident(incident_update, generation=None):
     assert(incident_update.severity == Severity.NONE)
+    found, state = incident_state_cache.get_incident_state(incident_update.incident_type, incident_update.key)
+    if found and (state is None or state[2] != Status.OPEN.value):
+        # no open incident, or open but not Status.OPEN
+        incident_state_cache.inc("cached")
+        return
+    incident_state_cache.inc("applied")
     # close the incident if status == Status.OPEN
     # do not automatically close it if open but not Status.OPEN
     try:
-        incident = Incident.objects.select_for_update().get(
+        incident = _select_for_update(
+            Incident.objects.all(),
             incident_type=incident_update.incident_type,
             key=incident_update.key,
-            status=Status.OPEN.value
+            status__in=Status.open_values()
         )
     except Incident.DoesNotExist:
+        incident = None
+    if incident is None or incident.status != Status.OPEN.value:
         # nothing to do
+        if generation is not None:
+            _cache_states_on_commit(incident_update, generation, incident=incident)
         return
 
     if incident.machineincident_set.filter(status__in=Status.open_values()).count():
@@ -82,16 +139,26 @@ def close_open_incident(incident_update):
     incident.status = Status.CLOSED.value
     incident.status_time = datetime.utcnow()
     incident.save()
+    if generation is not None:
+        _cache_states_on_commit(incident_update, generation, incident=incident, transition=True)
     event_payload = incident.serialize_for_event()
     event_payload["previous_status"] = previous_status
     yield IncidentStatusUpdatedEvent, event_payload
 
 
-def close_open_machine_incident(incident_update, serial_number):
+def close_open_machine_incident(incident_update, serial_number, generation=None):
+    found, status = incident_state_cache.get_machine_incident_status(
+        incident_update.incident_type, incident_update.key, serial_number
+    )
+    if found and status != Status.OPEN.value:
+        incident_state_cache.inc("cached")
+        return
+    incident_state_cache.inc("applied")
     # close a machine incident if status == Status.OPEN
     # do not automatically close it if open but not status == status.OPEN (manual intervention)
     try:
-        machine_incident = MachineIncident.objects.select_for_update().select_related("incident").get(
+        machine_incident = _select_for_update(
+            MachineIncident.objects.select_related("incident"),
             incident__incident_type=incident_update.incident_type,
             incident__key=incident_update.key,
             serial_number=serial_number,
@@ -99,6 +166,9 @@ def close_open_machine_incident(incident_update, serial_number):
         )
     except MachineIncident.DoesNotExist:
         # nothing to do
+        if generation is not None:
+            _cache_states_on_commit(incident_update, generation,
+                                    serial_number=serial_number, machine_incident_status=None)
         return
 
     # close found machine incident
@@ -115,52 +185,87 @@ def close_open_machine_incident(incident_update, serial_number):
     # close the incident if status == Status.OPEN
     # do not automatically close it if open but not status == Status.OPEN (manual intervention)
     incident = machine_incident.incident
+    incident_closed = False
     if incident.status not in Status.open_values():
         logger.error("Closed an open machine incident:%s on a closed incident:%s !!!",
                      machine_incident.pk, incident.pk)
     elif incident.status == Status.OPEN.value:
-        if incident.machineincident_set.filter(status__in=Status.open_values()).count():
-            # other open machine incident in the incident, we cannot close it
-            return
-        previous_status = {
-            "status": incident.status,
-            "status_time": incident.status_time
-        }
-        incident.status = Status.CLOSED.value
-        incident.status_time = datetime.utcnow()
-        incident.save()
-        event_payload = incident.serialize_for_event()
-        event_payload["previous_status"] = previous_status
-        yield (IncidentStatusUpdatedEvent, event_payload)
+        if not incident.machineincident_set.filter(status__in=Status.open_values()).count():
+            # no other open machine incident in the incident, we can close it
+            previous_status = {
+                "status": incident.status,
+                "status_time": incident.status_time
+            }
+            incident.status = Status.CLOSED.value
+            incident.status_time = datetime.utcnow()
+            incident.save()
+            incident_closed = True
+            event_payload = incident.serialize_for_event()
+            event_payload["previous_status"] = previous_status
+            yield (IncidentStatusUpdatedEvent, event_payload)
+    if generation is not None:
+        _cache_states_on_commit(incident_update, generation,
+                                incident=incident if incident_closed else _NOT_SET,
+                                serial_number=serial_number, machine_incident_status=None,
+                                transition=True)
 
 
-def open_machine_incident(incident_update, serial_number):
-    incident, event_args = open_incident(incident_update)
-    if event_args:
-        yield event_args
+def open_machine_incident(incident_update, serial_number, generation=None):
+    incident_pk = _get_cached_open_incident_pk(incident_update)
+    if incident_pk is not None:
+        found, status = incident_state_cache.get_machine_incident_status(
+            incident_update.incident_type, incident_update.key, serial_number
+        )
+        if found and status is not None:
+            # open machine incident in an open incident with the same or a greater severity
+            incident_state_cache.inc("cached")
+            return
+    incident_state_cache.inc("applied")
+    if incident_pk is not None:
+        # lock the cached incident, it could have been closed or updated in the meantime
+        try:
+            incident = _select_for_update(Incident.objects.all(), pk=incident_pk, status__in=Status.open_values())
+        except Incident.DoesNotExist:
+            incident_pk = None
+        else:
+            if incident.severity < incident_update.severity.value:
+                incident_pk = None
+    if incident_pk is None:
+        incident, event_args = open_incident(incident_update, generation)
+        if event_args:
+            yield event_args
+        incident_pk = incident.pk
     machine_incident, created = MachineIncident.objects.get_or_create(
-        incident=incident,
+        incident_id=incident_pk,
         serial_number=serial_number,
         status__in=Status.open_values(),
         defaults={"status": Status.OPEN.value,
                   "status_time": datetime.utcnow()}
     )
+    if generation is not None:
+        _cache_states_on_commit(incident_update, generation,
+                                serial_number=serial_number, machine_incident_status=machine_incident.status,
+                                transition=created)
     if created:
         event_payload = machine_incident.serialize_for_event()
         yield (MachineIncidentCreatedEvent, event_payload)
 
 
-def apply_incident_update(incident_update, serial_number):
+def apply_incident_update(incident_update, serial_number, generation=None):
     if incident_update.severity == Severity.NONE:
         if serial_number:
-            yield from close_open_machine_incident(incident_update, serial_number)
+            yield from close_open_machine_incident(incident_update, serial_number, generation)
         else:
-            yield from close_open_incident(incident_update)
+            yield from close_open_incident(incident_update, generation)
     else:
         if serial_number:
-            yield from open_machine_incident(incident_update, serial_number)
+            yield from open_machine_incident(incident_update, serial_number, generation)
+        elif _get_cached_open_incident_pk(incident_update) is not None:
+            # open incident with the same or a greater severity
+            incident_state_cache.inc("cached")
         else:
-            _, event_args = open_incident(incident_update)
+            incident_state_cache.inc("applied")
+            _, event_args = open_incident(incident_update, generation)
             if event_args:
                 yield event_args
 
@@ -173,9 +278,10 @@ def apply_incident_updates(original_event):
     serial_number = original_event.metadata.machine_serial_number
     event_uuid = uuid.uuid4()
     event_index = 0
+    generation = incident_state_cache.get_generation()
     with transaction.atomic():
         for incident_update in incident_updates:
-            for event_cls, event_payload in apply_incident_update(incident_update, serial_number):
+            for event_cls, event_payload in apply_incident_update(incident_update, serial_number, generation):
                 event_metadata = EventMetadata(
                     uuid=event_uuid,
                     index=event_index,
@@ -200,6 +306,7 @@ def update_incident_status(incident, new_status, request):
     incident.status = new_status.value
     incident.status_time = datetime.utcnow()
     incident.save()
+    transaction.on_commit(lambda: incident_state_cache.invalidate(incident.incident_type, incident.key))
 
     # build event
     event_payload = incident.serialize_for_event()
@@ -222,6 +329,8 @@ def update_machine_incident_status(machine_incident, new_status, request):
     machine_incident.status = new_status.value
     machine_incident.status_time = datetime.utcnow()
     machine_incident.save()
+    transaction.on_commit(lambda: incident_state_cache.invalidate(machine_incident.incident.incident_type,
+                                                                  machine_incident.incident.key))
 
     # build event
     event_payload = machine_incident.serialize_for_event()
@@ -10,6 +10,57 @@ from .probe import Probe
 logger = logging.getLogger("zentral.core.probes.conf")
 
 
+class ProbeIndex:
+    """
+    Index of the probes, bucketed by the metadata filter clauses.
+
+    For each metadata filter, a single clause is used to bucket the probe,
+    in order of selectivity: event types, routing keys, event tags.
+    Probes without metadata filters are always candidates.
+    The candidates are then fully tested with Probe.test_event.
+    """
+
+    def __init__(self, probes):
+        self.probe_count = 0
+        self.wildcard = []
+        self.event_types = {}
+        self.routing_keys = {}
+        self.event_tags = {}
+        for position, probe in enumerate(probes):
+            if not probe.loaded:
+                # never a match
+                continue
+            self.probe_count += 1
+            item = (position, probe)
+            if not probe.metadata_filters:
+                self.wildcard.append(item)
+                continue
+            for metadata_filter in probe.metadata_filters:
+                if metadata_filter.event_types:
+                    bucket, keys = self.event_types, metadata_filter.event_types
+                elif metadata_filter.event_routing_keys:
+                    bucket, keys = self.routing_keys, metadata_filter.event_routing_keys
+                elif metadata_filter.event_tags:
+                    bucket, keys = self.event_tags, metadata_filter.event_tags
+                else:
+                    self.wildcard.append(item)
+                    break
+                for key in keys:
+                    bucket.setdefault(key, []).append(item)
+
+    def iter_candidates(self, event):
+        metadata = event.metadata
+        candidates = dict(self.wildcard)
+        candidates.update(self.event_types.get(metadata.event_type, []))
+        if metadata.routing_key:
+            candidates.update(self.routing_keys.get(metadata.routing_key, []))
+        if self.event_tags:
+            for tag in metadata.all_tags:
+                candidates.update(self.event_tags.get(tag, []))
+        for position in sorted(candidates):
+            yield candidates[position]
+
+
 class ProbeView(object):
     def __init__(self, parent=None, with_sync=False):
         self.parent = parent
@@ -87,10 +138,13 @@ class ProbeList(ProbeView):
         super(ProbeList, self).__init__(parent, with_sync=with_sync)
         self.filter_func = filter_func
         self._children = weakref.WeakSet()
+        self._index = None
+        self.index_counters = {"events": 0, "candidates": 0, "hits": 0}
 
     def clear(self, *args, **kwargs):
         with self._lock:
             self._probes = None
+            self._index = None
             for child in self._children:
                 child.clear()
 
@@ -101,6 +155,7 @@ class ProbeList(ProbeView):
             for probe in self.iter_parent_probes():
                 if self.filter_func is None or self.filter_func(probe):
                     self._probes.append(probe)
+            self._index = ProbeIndex(self._probes)
 
     def filter(self, filter_func):
         child = self.__class__(self, filter_func)
@@ -113,9 +168,28 @@ class ProbeList(ProbeView):
         return child
 
     def event_filtered(self, event):
-        def _filter(probe):
-            return probe.test_event(event)
-        return self.filter(_filter)
+        with self._lock:
+            self._load()
+            index = self._index
+        candidate_count = hit_count = 0
+        probes = []
+        for probe in index.iter_candidates(event):
+            candidate_count += 1
+            if probe.test_event(event):
+                hit_count += 1
+                probes.append(probe)
+        with self._lock:
+            self.index_counters["events"] += 1
+            self.index_counters["candidates"] += candidate_count
+            self.index_counters["hits"] += hit_count
+        return probes
+
+    def get_index_stats(self):
+        with self._lock:
+            self._load()
+            stats = self.index_counters.copy()
+            stats["probes"] = self._index.probe_count
+        return stats
 
 
 # used for the tests
@@ -253,7 +253,7 @@ class BulkStoreWorker(StoreWorkerMixin, BatchConsumer):
     def __init__(self, event_queues, event_store):
         super().__init__(
             event_queues.setup_store_worker_queue(event_store),
-            event_store.batch_size,
+            event_store.worker_batch_size,
             event_store.max_batch_age_seconds,
             event_queues.client_kwargs
         )
@@ -389,6 +389,21 @@ class EventQueues(BaseEventQueues):
         )
         return response["Attributes"]["QueueArn"]
 
+    def get_worker_queue_depth(self, worker):
+        queue_url = getattr(worker, "queue_url", None)
+        if not queue_url:
+            return
+        # dedicated client, the workers are forked from the supervisor
+        sqs_client = boto3.client("sqs", **self.client_kwargs)
+        try:
+            response = sqs_client.get_queue_attributes(
+                QueueUrl=queue_url,
+                AttributeNames=["ApproximateNumberOfMessages"]
+            )
+        finally:
+            sqs_client.close()
+        return int(response["Attributes"]["ApproximateNumberOfMessages"])
+
     def setup_queue_subscription(self, queue_url, topic_basename):
         # ARNs
         topic_arn = self.setup_topic(topic_basename)
@@ -467,14 +482,14 @@ class EventQueues(BaseEventQueues):
     def get_preprocess_worker(self):
         return PreprocessWorker(self)
 
-    def get_enrich_worker(self, enrich_event):
+    def get_enrich_worker(self, enrich_event, iter_cache_counters=None):
         return EnrichWorker(self, enrich_event)
 
     def get_process_worker(self, process_event):
         return ProcessWorker(self, process_event)
 
     def get_store_worker(self, event_store):
-        if event_store.batch_size > 1:
+        if event_store.worker_batch_size > 1:
             return BulkStoreWorker(self, event_store)
         elif event_store.concurrency > 1:
             return ConcurrentStoreWorker(self, event_store)
@@ -7,7 +7,7 @@ class BaseEventQueues:
     def get_preprocess_worker(self):
         raise NotImplementedError
 
-    def get_enrich_worker(self, enrich_event):
+    def get_enrich_worker(self, enrich_event, iter_cache_counters=None):
         raise NotImplementedError
 
     def get_process_worker(self, process_event):
@@ -16,12 +16,20 @@ class BaseEventQueues:
     def get_store_worker(self, event_store):
         raise NotImplementedError
 
+    def get_store_workers(self, event_stores):
+        for event_store in event_stores:
+            yield self.get_store_worker(event_store)
+
     def setup_store_worker_queue(self, event_store):
         return
 
     def mark_store_worker_queue_for_deletion(self, event_store):
         return
 
+    def get_worker_queue_depth(self, worker):
+        """Number of messages waiting for the worker, or None if not available"""
+        return
+
     # post events
 
     def post_raw_event(self, routing_key, raw_event):
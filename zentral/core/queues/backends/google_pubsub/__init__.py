@@ -254,8 +254,8 @@ class BulkStoreWorker(BaseWorker):
         super().__init__(enriched_events_topic, credentials)
         self.event_store = event_store
         # threading
-        self.process_message_queue = queue.Queue(maxsize=self.event_store.batch_size)
-        self.ack_message_queue = queue.Queue(maxsize=self.event_store.batch_size)
+        self.process_message_queue = queue.Queue(maxsize=self.event_store.worker_batch_size)
+        self.ack_message_queue = queue.Queue(maxsize=self.event_store.worker_batch_size)
         self.stop_receiving_event = threading.Event()
         self.stop_event = threading.Event()
         # batch
@@ -328,7 +328,7 @@ class BulkStoreWorker(BaseWorker):
                     self.batch.append((ack_id, event_d))
                     if self.batch_start_ts is None:
                         self.batch_start_ts = time.monotonic()
-                    if len(self.batch) >= self.event_store.batch_size:
+                    if len(self.batch) >= self.event_store.worker_batch_size:
                         self.log_debug("process events because max batch size reached")
                         self._process_batch()
 
@@ -344,7 +344,7 @@ class BulkStoreWorker(BaseWorker):
                 self.subscriber_client, self.subscription_path,
                 self.stop_event,
                 self.ack_message_queue,
-                self.event_store.batch_size
+                self.event_store.worker_batch_size
             )
         ]
         for thread_id in range(self.receive_thread_count):
@@ -354,7 +354,7 @@ class BulkStoreWorker(BaseWorker):
                     self.subscriber_client, self.subscription_path,
                     self.stop_receiving_event,
                     self.process_message_queue,
-                    self.event_store.batch_size
+                    self.event_store.worker_batch_size
                 )
             )
         for thread in threads:
@@ -407,14 +407,14 @@ class EventQueues(BaseEventQueues):
     def get_preprocess_worker(self):
         return PreprocessWorker(self.raw_events_topic, self.events_topic, self.credentials)
 
-    def get_enrich_worker(self, enrich_event):
+    def get_enrich_worker(self, enrich_event, iter_cache_counters=None):
         return EnrichWorker(self.events_topic, self.enriched_events_topic, self.credentials, enrich_event)
 
     def get_process_worker(self, process_event):
         return ProcessWorker(self.enriched_events_topic, self.credentials, process_event)
 
     def get_store_worker(self, event_store):
-        if event_store.batch_size > 1:
+        if event_store.worker_batch_size > 1:
             worker_class = BulkStoreWorker
         else:
             worker_class = StoreWorker
@@ -1,6 +1,5 @@
 import logging
 import signal
-from kombu.utils import json
 from django.utils.functional import cached_property
 from google.api_core.exceptions import AlreadyExists
 from google.cloud import pubsub_v1
@@ -177,7 +176,7 @@ class ConsumerProducer(Consumer):
         return pubsub_v1.PublisherClient(credentials=self.credentials)
 
     def publish_event(self, event, machine_metadata):
-        message = json.dumps(event.serialize(machine_metadata=machine_metadata)).encode("utf-8")
+        message = event.serialize_bytes(machine_metadata=machine_metadata)
         kwargs = {"event_type": event.event_type}
         if event.metadata.routing_key:
             kwargs["routing_key"] = event.metadata.routing_key
@@ -1,5 +1,9 @@
+from collections import deque
 from importlib import import_module
+import itertools
 import logging
+import queue
+import threading
 import time
 from zentral.conf import settings
 from kombu import Connection, Consumer, Exchange, Queue
@@ -53,6 +57,95 @@ class BaseWorker:
         self.log(msg, logging.ERROR, *args)
 
 
+class BatchConsumerMixin:
+    """Consume the messages in batches.
+
+    The messages are accumulated until the batch is full or too old,
+    and processed with process_batch. The successful messages are acked
+    at once, the failed ones are requeued after a delay, without blocking
+    the consumer.
+    """
+    batch_size = 1
+    max_batch_age_seconds = 1
+    requeue_delay_seconds = 1
+
+    def setup_batch(self, batch_size, max_batch_age_seconds, requeue_delay_seconds):
+        self.batch_size = batch_size
+        self.max_batch_age_seconds = max_batch_age_seconds
+        self.requeue_delay_seconds = requeue_delay_seconds
+        self.batch = []
+        self.batch_start_ts = None
+        self.delayed_requeues = deque()
+
+    def get_batch_consumer(self, default_channel, queues):
+        return Consumer(default_channel,
+                        queues=queues,
+                        accept=['json'],
+                        prefetch_count=2 * self.batch_size,
+                        callbacks=[self.add_message_to_batch])
+
+    def on_connection_revived(self):
+        # the unacked messages of the previous channel will be redelivered
+        self.batch = []
+        self.batch_start_ts = None
+        self.delayed_requeues.clear()
+        super().on_connection_revived()
+
+    def on_iteration(self):
+        now = time.monotonic()
+        if self.batch and now > self.batch_start_ts + self.max_batch_age_seconds:
+            self.log_debug("process batch because max batch age reached")
+            self.flush_batch()
+        while self.delayed_requeues and self.delayed_requeues[0][0] <= now:
+            _, message = self.delayed_requeues.popleft()
+            message.requeue()
+        super().on_iteration()
+
+    def add_message_to_batch(self, body, message):
+        self.batch.append((body, message))
+        if self.batch_start_ts is None:
+            self.batch_start_ts = time.monotonic()
+        if len(self.batch) >= self.batch_size:
+            self.log_debug("process batch because max batch size reached")
+            self.flush_batch()
+
+    def flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        self.batch_start_ts = None
+        acked_messages = []
+        handled_messages = set()
+        requeue_ts = time.monotonic() + self.requeue_delay_seconds
+        try:
+            for message, success in self.process_batch(batch):
+                handled_messages.add(id(message))
+                if success:
+                    acked_messages.append(message)
+                else:
+                    self.delayed_requeues.append((requeue_ts, message))
+        except Exception:
+            # only the messages without result are requeued
+            logger.exception("Could not process the batch")
+            for _, message in batch:
+                if id(message) not in handled_messages:
+                    self.delayed_requeues.append((requeue_ts, message))
+        if not acked_messages:
+            return
+        if self.delayed_requeues:
+            # a multiple ack would also ack the messages waiting to be requeued
+            for message in acked_messages:
+                message.ack()
+        else:
+            max(acked_messages, key=lambda m: m.delivery_tag).ack(multiple=True)
+        if len(acked_messages) < len(batch):
+            self.log_error("%s/%s message(s) requeued with %ss delay",
+                           len(batch) - len(acked_messages), len(batch), self.requeue_delay_seconds)
+
+    def process_batch(self, batch):
+        """Must yield a (message, success) tuple for each message of the batch"""
+        raise NotImplementedError
+
+
 class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
     name = "preprocess worker"
     counters = (
@@ -104,8 +197,9 @@ class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
             else:
                 try:
                     for event in preprocessor.process_raw_event(body):
-                        self.producer.publish(event.serialize(machine_metadata=False),
-                                              serializer='json',
+                        self.producer.publish(event.serialize_bytes(machine_metadata=False),
+                                              content_type='application/json',
+                                              content_encoding='utf-8',
                                               exchange=events_exchange,
                                               declare=[events_exchange])
                         self.inc_counter("produced_events", event.event_type)
@@ -122,12 +216,27 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("machine_cache_lookups", "result"),
+        ("incident_updates", "result"),
     )
 
-    def __init__(self, connection, enrich_event):
+    def __init__(self, connection, enrich_event, iter_cache_counters=None):
         self.connection = connection
         self.enrich_event = enrich_event
+        self.iter_cache_counters = iter_cache_counters
         self.name = "enrich worker"
+        self.cache_counters = {}
+
+    def inc_cache_counters(self):
+        # report the cache counters increments since the last call
+        if self.iter_cache_counters is None:
+            return
+        for name, counters in self.iter_cache_counters():
+            for label, count in counters.items():
+                key = (name, label)
+                for _ in range(count - self.cache_counters.get(key, 0)):
+                    self.inc_counter(name, label)
+                self.cache_counters[key] = count
 
     def run(self, *args, **kwargs):
         self.log_info("run")
@@ -144,8 +253,9 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
         self.log_debug("enrich event")
         try:
             for event in self.enrich_event(body):
-                self.producer.publish(event.serialize(machine_metadata=True),
-                                      serializer='json',
+                self.producer.publish(event.serialize_bytes(machine_metadata=True),
+                                      content_type='application/json',
+                                      content_encoding='utf-8',
                                       exchange=enriched_events_exchange,
                                       declare=[enriched_events_exchange])
                 self.inc_counter("produced_events", event.event_type)
@@ -156,6 +266,38 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
         else:
             message.ack()
             self.inc_counter("enriched_events", event.event_type)
+        self.inc_cache_counters()
+
+
+class BatchEnrichWorker(BatchConsumerMixin, EnrichWorker):
+    def __init__(self, connection, enrich_event, batch_size, max_batch_age_seconds, requeue_delay_seconds,
+                 iter_cache_counters=None):
+        super().__init__(connection, enrich_event, iter_cache_counters)
+        self.setup_batch(batch_size, max_batch_age_seconds, requeue_delay_seconds)
+
+    def get_consumers(self, _, default_channel):
+        return [self.get_batch_consumer(default_channel, [enrich_events_queue])]
+
+    def process_batch(self, batch):
+        self.log_debug("enrich %d events", len(batch))
+        producer = self.producer
+        for body, message in batch:
+            try:
+                event_type = body['_zentral']['type']
+                for event in self.enrich_event(body):
+                    producer.publish(event.serialize_bytes(machine_metadata=True),
+                                     content_type='application/json',
+                                     content_encoding='utf-8',
+                                     exchange=enriched_events_exchange,
+                                     declare=[enriched_events_exchange])
+                    self.inc_counter("produced_events", event.event_type)
+            except Exception as exception:
+                logger.exception("Could not enrich event: %s", exception)
+                yield message, False
+            else:
+                yield message, True
+                self.inc_counter("enriched_events", event_type)
+        self.inc_cache_counters()
 
 
 class ProcessWorker(ConsumerMixin, BaseWorker):
@@ -187,6 +329,34 @@ class ProcessWorker(ConsumerMixin, BaseWorker):
         self.inc_counter("processed_events", event_type)
 
 
+class BatchProcessWorker(BatchConsumerMixin, ProcessWorker):
+    def __init__(self, connection, process_event, batch_size, max_batch_age_seconds, requeue_delay_seconds):
+        super().__init__(connection, process_event)
+        self.setup_batch(batch_size, max_batch_age_seconds, requeue_delay_seconds)
+
+    def get_consumers(self, _, default_channel):
+        return [self.get_batch_consumer(default_channel, [process_events_queue])]
+
+    def process_batch(self, batch):
+        self.log_debug("process %d events", len(batch))
+        for body, message in batch:
+            try:
+                event_type = body['_zentral']['type']
+                self.process_event(body)
+            except Exception as exception:
+                logger.exception("Could not process event: %s", exception)
+                yield message, False
+            else:
+                yield message, True
+                self.inc_counter("processed_events", event_type)
+
+
+def get_store_events_queue(event_store):
+    return Queue(('store_events_{}'.format(event_store.name)).replace(" ", "_"),
+                 exchange=enriched_events_exchange,
+                 durable=True)
+
+
 class StoreWorker(ConsumerMixin, BaseWorker):
     counters = (
         ("skipped_events", "event_type"),
@@ -197,14 +367,15 @@ class StoreWorker(ConsumerMixin, BaseWorker):
         self.connection = connection
         self.event_store = event_store
         self.name = "store worker {}".format(self.event_store.name)
-        self.input_queue = Queue(('store_events_{}'.format(self.event_store.name)).replace(" ", "_"),
-                                 exchange=enriched_events_exchange,
-                                 durable=True)
+        self.input_queue = get_store_events_queue(self.event_store)
 
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
-        super().run(*args, **kwargs)
+        try:
+            super().run(*args, **kwargs)
+        finally:
+            self.event_store.close()
 
     def get_consumers(self, _, default_channel):
         return [Consumer(default_channel,
@@ -230,11 +401,305 @@ class StoreWorker(ConsumerMixin, BaseWorker):
             self.inc_counter("stored_events", event_type)
 
 
+class BulkStoreWorker(BatchConsumerMixin, StoreWorker):
+    def __init__(self, connection, event_store, requeue_delay_seconds):
+        super().__init__(connection, event_store)
+        self.setup_batch(event_store.worker_batch_size, event_store.max_batch_age_seconds, requeue_delay_seconds)
+
+    def get_consumers(self, _, default_channel):
+        return [self.get_batch_consumer(default_channel, [self.input_queue])]
+
+    def process_batch(self, batch):
+        batch_size = len(batch)
+        self.log_debug("store %d events", batch_size)
+        event_info = {}
+        skipped_messages = []
+        included_bodies = set(id(body) for body in self.event_store.filter_batch(body for body, _ in batch))
+
+        def iter_events():
+            for body, message in batch:
+                event_metadata = body['_zentral']
+                event_type = event_metadata['type']
+                if id(body) not in included_bodies:
+                    self.inc_counter("skipped_events", event_type)
+                    skipped_messages.append(message)
+                    continue
+                event_key = (event_metadata["id"], event_metadata["index"])
+                event_info[event_key] = (message, event_type)
+                yield body
+
+        stored_event_count = 0
+        try:
+            for stored_event_key in self.event_store.bulk_store(iter_events()):
+                try:
+                    message, event_type = event_info.pop(stored_event_key)
+                except KeyError:
+                    self.log_error("unknown stored event %s", stored_event_key)
+                else:
+                    yield message, True
+                    self.inc_counter("stored_events", event_type)
+                    stored_event_count += 1
+        except Exception:
+            logger.exception("Could not add events to store %s", self.event_store.name)
+        for message in skipped_messages:
+            yield message, True
+        # not stored
+        for message, _ in event_info.values():
+            yield message, False
+
+        if stored_event_count + len(skipped_messages) < batch_size:
+            self.log_error("only %s/%s event(s) stored", stored_event_count, batch_size - len(skipped_messages))
+        else:
+            self.log_debug("%s/%s events stored", stored_event_count, batch_size - len(skipped_messages))
+
+
+def copy_event_envelope(event_d):
+    # the stores pop the metadata from the event dict, and the keys from the metadata.
+    # A copy of the top level dict and of the metadata is enough to share the decoded event.
+    event_d = event_d.copy()
+    event_d["_zentral"] = event_d["_zentral"].copy()
+    return event_d
+
+
+class StoreDispatcherThread(threading.Thread):
+    """Store the events dispatched to one store.
+
+    The events are buffered until the store batch is full or too old.
+    The failed events are retried after a delay, and saved as dead letters
+    after max_retries attempts, without blocking the other stores.
+    """
+    max_retries = 3
+
+    def __init__(self, worker, event_store, requeue_delay_seconds):
+        super().__init__(name=f"store dispatcher {event_store.name}", daemon=True)
+        self.worker = worker
+        self.event_store = event_store
+        self.batch_size = max(1, event_store.worker_batch_size)
+        self.max_batch_age_seconds = event_store.max_batch_age_seconds
+        self.requeue_delay_seconds = requeue_delay_seconds
+        self.input_queue = queue.Queue()
+        self.stop_event = threading.Event()
+
+    def drain_input_queue(self):
+        while True:
+            try:
+                self.input_queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def run(self):
+        batch = []
+        batch_start_ts = None
+        while not self.stop_event.is_set():
+            timeout = 1
+            if batch_start_ts is not None:
+                timeout = max(0, batch_start_ts + self.max_batch_age_seconds - time.monotonic())
+            try:
+                batch.append(self.input_queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            else:
+                if batch_start_ts is None:
+                    batch_start_ts = time.monotonic()
+            if batch and (len(batch) >= self.batch_size
+                          or time.monotonic() >= batch_start_ts + self.max_batch_age_seconds):
+                self.flush_batch(batch)
+                batch = []
+                batch_start_ts = None
+
+    def store_batch(self, batch):
+        """Store the batch, return the failed (event_d, message_key) items"""
+        included_event_ds = set(id(event_d) for event_d in self.event_store.filter_batch(ed for ed, _ in batch))
+        event_info = {}
+        for event_d, message_key in batch:
+            if id(event_d) not in included_event_ds:
+                self.worker.inc_counter("skipped_events", self.event_store.name)
+                self.worker.message_done(message_key)
+                continue
+            event_metadata = event_d["_zentral"]
+            event_info[(event_metadata["id"], event_metadata["index"])] = (event_d, message_key)
+        if not event_info:
+            return []
+        failed_items = []
+        if self.batch_size > 1:
+            # the stores pop the metadata, keep copies for the retries
+            retry_copies = {event_key: copy_event_envelope(event_d)
+                            for event_key, (event_d, _) in event_info.items()}
+            try:
+                for stored_event_key in self.event_store.bulk_store(ed for ed, _ in list(event_info.values())):
+                    try:
+                        _, message_key = event_info.pop(stored_event_key)
+                    except KeyError:
+                        self.worker.log_error("store %s: unknown stored event %s",
+                                              self.event_store.name, stored_event_key)
+                    else:
+                        self.worker.inc_counter("stored_events", self.event_store.name)
+                        self.worker.message_done(message_key)
+            except Exception:
+                logger.exception("Could not add events to store %s", self.event_store.name)
+            failed_items = [(retry_copies[event_key], message_key)
+                            for event_key, (_, message_key) in event_info.items()]
+        else:
+            for event_d, message_key in event_info.values():
+                retry_copy = copy_event_envelope(event_d)
+                try:
+                    self.event_store.store(event_d)
+                except Exception:
+                    logger.exception("Could add event to store %s", self.event_store.name)
+                    failed_items.append((retry_copy, message_key))
+                else:
+                    self.worker.inc_counter("stored_events", self.event_store.name)
+                    self.worker.message_done(message_key)
+        return failed_items
+
+    def flush_batch(self, batch):
+        # skip the events of the messages from a previous channel, they will be redelivered
+        batch = [item for item in batch if self.worker.is_live_message(item[1])]
+        for attempt in range(self.max_retries):
+            if attempt:
+                self.worker.log_error("store %s: retry %s failed event(s) in %ss",
+                                      self.event_store.name, len(batch), self.requeue_delay_seconds)
+                time.sleep(self.requeue_delay_seconds)
+            try:
+                batch = self.store_batch(batch)
+            except Exception:
+                logger.exception("Could not process batch for store %s", self.event_store.name)
+            if not batch:
+                return
+        for event_d, message_key in batch:
+            save_dead_letter(event_d, f"event store {self.event_store.name} error")
+            self.worker.inc_counter("dead_letter_events", self.event_store.name)
+            self.worker.message_done(message_key)
+
+
+class MultiplexedStoreWorker(ConsumerMixin, BaseWorker):
+    """Consume the enriched events once, and dispatch them to all the stores.
+
+    Each store has its own thread, batch and max batch age. A message is acked
+    once all the stores are done with it. The prefetch count limits the number
+    of messages waiting for the slowest store.
+    """
+    name = "multiplexed store worker"
+    dispatcher_stop_timeout_seconds = 10
+    counters = (
+        ("skipped_events", "store"),
+        ("stored_events", "store"),
+        ("dead_letter_events", "store"),
+    )
+
+    def __init__(self, connection, event_stores, requeue_delay_seconds):
+        self.connection = connection
+        self.dispatchers = [StoreDispatcherThread(self, event_store, requeue_delay_seconds)
+                            for event_store in event_stores]
+        self.prefetch_count = max(10, 2 * max(d.batch_size for d in self.dispatchers))
+        self.input_queue = Queue('multiplexed_store_events',
+                                 exchange=enriched_events_exchange,
+                                 durable=True)
+        self.message_keys = itertools.count()
+        self.first_live_message_key = 0
+        self.pending_messages = {}
+        self.done_message_keys = queue.Queue()
+
+    def unbind_store_queues(self):
+        # the store queues of the non-multiplexed store workers are not consumed anymore.
+        # they are unbound to stop accumulating the enriched events, but not deleted,
+        # because they could still contain some events to store.
+        for dispatcher in self.dispatchers:
+            store_queue = get_store_events_queue(dispatcher.event_store)
+            try:
+                with self.connection.channel() as channel:
+                    bound_store_queue = store_queue(channel)
+                    bound_store_queue.queue_declare(passive=True)
+                    bound_store_queue.unbind_from(enriched_events_exchange)
+            except self.connection.channel_errors:
+                # the store queue does not exist
+                continue
+            self.log_info("store queue %s unbound", store_queue.name)
+
+    def run(self, *args, **kwargs):
+        self.log_info("run")
+        super().setup_metrics_exporter(*args, **kwargs)
+        try:
+            self.unbind_store_queues()
+            for dispatcher in self.dispatchers:
+                dispatcher.start()
+            super().run(*args, **kwargs)
+        finally:
+            self.stop_dispatchers()
+
+    def stop_dispatchers(self):
+        # the unacked messages will be redelivered, the pending batches are not flushed
+        for dispatcher in self.dispatchers:
+            dispatcher.stop_event.set()
+        for dispatcher in self.dispatchers:
+            if dispatcher.is_alive():
+                dispatcher.join(self.dispatcher_stop_timeout_seconds)
+                if dispatcher.is_alive():
+                    self.log_error("store %s: dispatcher thread still running", dispatcher.event_store.name)
+            dispatcher.event_store.close()
+
+    def get_consumers(self, _, default_channel):
+        return [Consumer(default_channel,
+                         queues=[self.input_queue],
+                         accept=['json'],
+                         prefetch_count=self.prefetch_count,
+                         callbacks=[self.dispatch_event])]
+
+    def dispatch_event(self, body, message):
+        # own keys, because the delivery tags are reset with the channel
+        message_key = next(self.message_keys)
+        self.pending_messages[message_key] = [message, len(self.dispatchers)]
+        for dispatcher in self.dispatchers:
+            dispatcher.input_queue.put((copy_event_envelope(body), message_key))
+
+    def is_live_message(self, message_key):
+        # called from the dispatcher threads
+        return message_key >= self.first_live_message_key
+
+    def message_done(self, message_key):
+        # called from the dispatcher threads
+        self.done_message_keys.put(message_key)
+
+    def ack_done_messages(self):
+        while True:
+            try:
+                message_key = self.done_message_keys.get_nowait()
+            except queue.Empty:
+                break
+            pending_message = self.pending_messages.get(message_key)
+            if pending_message is None:
+                # message from a previous channel
+                continue
+            pending_message[1] -= 1
+            if pending_message[1] == 0:
+                del self.pending_messages[message_key]
+                pending_message[0].ack()
+
+    def on_iteration(self):
+        self.ack_done_messages()
+        super().on_iteration()
+
+    def on_connection_revived(self):
+        # the unacked messages of the previous channel will be redelivered.
+        # forget them, and do not store their events, to avoid storing them twice.
+        self.first_live_message_key = next(self.message_keys) + 1
+        self.pending_messages = {}
+        for dispatcher in self.dispatchers:
+            dispatcher.drain_input_queue()
+        super().on_connection_revived()
+
+
 class EventQueues(BaseEventQueues):
     def __init__(self, config_d):
         super().__init__(config_d)
         self.backend_url = config_d['backend_url']
         self.transport_options = config_d.get('transport_options')
+        # batch mode for the enrich and process workers
+        self.batch_size = int(config_d.get('batch_size', 1))
+        self.max_batch_age_seconds = float(config_d.get('max_batch_age_seconds', 1))
+        self.requeue_delay_seconds = float(config_d.get('requeue_delay_seconds', 1))
+        # one worker for all the stores
+        self.multiplexed_store_worker = bool(config_d.get('multiplexed_store_worker', False))
         self.connection = self._get_connection()
 
     def _get_connection(self):
@@ -243,15 +708,47 @@ class EventQueues(BaseEventQueues):
     def get_preprocess_worker(self):
         return PreprocessWorker(self._get_connection())
 
-    def get_enrich_worker(self, enrich_event):
-        return EnrichWorker(self._get_connection(), enrich_event)
+    def get_enrich_worker(self, enrich_event, iter_cache_counters=None):
+        if self.batch_size > 1:
+            return BatchEnrichWorker(self._get_connection(), enrich_event,
+                                     self.batch_size, self.max_batch_age_seconds, self.requeue_delay_seconds,
+                                     iter_cache_counters)
+        return EnrichWorker(self._get_connection(), enrich_event, iter_cache_counters)
 
     def get_process_worker(self, process_event):
+        if self.batch_size > 1:
+            return BatchProcessWorker(self._get_connection(), process_event,
+                                      self.batch_size, self.max_batch_age_seconds, self.requeue_delay_seconds)
         return ProcessWorker(self._get_connection(), process_event)
 
     def get_store_worker(self, event_store):
+        if event_store.worker_batch_size > 1:
+            return BulkStoreWorker(self._get_connection(), event_store, self.requeue_delay_seconds)
         return StoreWorker(self._get_connection(), event_store)
 
+    def get_store_workers(self, event_stores):
+        if not self.multiplexed_store_worker:
+            yield from super().get_store_workers(event_stores)
+            return
+        event_stores = list(event_stores)
+        if event_stores:
+            yield MultiplexedStoreWorker(self._get_connection(), event_stores, self.requeue_delay_seconds)
+
+    def get_worker_queue_depth(self, worker):
+        if isinstance(worker, EnrichWorker):
+            worker_queue = enrich_events_queue
+        elif isinstance(worker, ProcessWorker):
+            worker_queue = process_events_queue
+        elif isinstance(worker, (StoreWorker, MultiplexedStoreWorker)):
+            worker_queue = worker.input_queue
+        else:
+            # the preprocess worker consumes multiple raw event queues
+            return
+        # dedicated short-lived connection, the workers are forked from the supervisor
+        with self._get_connection() as connection, connection.channel() as channel:
+            _, message_count, _ = worker_queue(channel).queue_declare(passive=True)
+        return message_count
+
     def post_raw_event(self, routing_key, raw_event):
         with producers[self.connection].acquire(block=True) as producer:
             producer.publish(raw_event,
@@ -262,7 +759,8 @@ class EventQueues(BaseEventQueues):
 
     def post_event(self, event):
         with producers[self.connection].acquire(block=True) as producer:
-            producer.publish(event.serialize(machine_metadata=False),
-                             serializer='json',
+            producer.publish(event.serialize_bytes(machine_metadata=False),
+                             content_type='application/json',
+                             content_encoding='utf-8',
                              exchange=events_exchange,
                              declare=[events_exchange])
@@ -0,0 +1,495 @@
+from importlib import import_module
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from django.utils.functional import cached_property
+from kombu.utils import json
+import redis
+from base.notifier import build_redis_kwargs
+from zentral.conf import settings
+from zentral.core.queues.backends.base import BaseEventQueues
+from zentral.core.queues.exceptions import RetryLater
+from zentral.utils.json import dumps_bytes, save_dead_letter
+
+
+logger = logging.getLogger('zentral.core.queues.backends.redis_streams')
+
+
+# Streams
+#
+# {prefix}raw_events:{routing_key} → consumer group "preprocess"
+# {prefix}events                   → consumer group "enrich"
+# {prefix}enriched_events          → consumer group "process", and one consumer group per store
+#
+# The messages are read in batches with XREADGROUP. The produced messages and the acknowledgements
+# are sent together in a MULTI/EXEC pipeline. The messages that could not be processed are left
+# pending, and claimed again with XAUTOCLAIM once they have been idle for claim_min_idle_seconds.
+# After max_deliveries deliveries, they are saved as dead letters and acknowledged.
+
+
+class BaseWorker:
+    name = "UNDEFINED"
+    group = "UNDEFINED"
+    group_start_id = "0"
+    counters = ()
+
+    def __init__(self, event_queues):
+        self.event_queues = event_queues
+        self.batch_size = event_queues.batch_size
+        self.block_ms = int(event_queues.block_seconds * 1000)
+        self.claim_min_idle_ms = int(event_queues.claim_min_idle_seconds * 1000)
+        self.max_deliveries = event_queues.max_deliveries
+        self.consumer_max_idle_ms = int(event_queues.consumer_max_idle_seconds * 1000)
+        self.stop_event = threading.Event()
+        self.last_claim_ts = None
+        self.metrics_exporter = None
+
+    def get_streams(self):
+        raise NotImplementedError
+
+    # metrics
+
+    def setup_metrics_exporter(self, *args, **kwargs):
+        self.metrics_exporter = kwargs.pop("metrics_exporter", None)
+        if self.metrics_exporter:
+            for name, label in self.counters:
+                self.metrics_exporter.add_counter(name, [label])
+            self.metrics_exporter.start()
+
+    def inc_counter(self, name, label):
+        if self.metrics_exporter:
+            self.metrics_exporter.inc(name, label)
+
+    # logging
+
+    def log(self, msg, level, *args):
+        logger.log(level, "{} - {}".format(self.name, msg), *args)
+
+    def log_debug(self, msg, *args):
+        self.log(msg, logging.DEBUG, *args)
+
+    def log_info(self, msg, *args):
+        self.log(msg, logging.INFO, *args)
+
+    def log_error(self, msg, *args):
+        self.log(msg, logging.ERROR, *args)
+
+    # read
+
+    def decode_messages(self, stream, messages):
+        for message_id, fields in messages:
+            if fields is None:
+                # trimmed before it could be claimed
+                continue
+            try:
+                body = json.loads(fields[b"data"])
+            except Exception:
+                self.log_error("could not decode message %s from stream %s", message_id, stream)
+                self.client.xack(stream, self.group, message_id)
+            else:
+                yield stream, message_id, body
+
+    def get_times_delivered(self, stream, message_ids):
+        pipeline = self.client.pipeline(transaction=False)
+        for message_id in message_ids:
+            pipeline.xpending_range(stream, self.group, min=message_id, max=message_id, count=1)
+        times_delivered = {}
+        for pending_messages in pipeline.execute():
+            for pending_message in pending_messages:
+                times_delivered[pending_message["message_id"]] = pending_message["times_delivered"]
+        return times_delivered
+
+    def claim_messages(self):
+        now = time.monotonic()
+        if self.last_claim_ts and now - self.last_claim_ts < self.event_queues.claim_min_idle_seconds:
+            return []
+        self.last_claim_ts = now
+        batch = []
+        for stream in self.get_streams():
+            response = self.client.xautoclaim(stream, self.group, self.consumer, self.claim_min_idle_ms,
+                                              count=self.batch_size)
+            claimed_messages = list(self.decode_messages(stream, response[1]))
+            if not claimed_messages:
+                continue
+            # the delivery count includes this claim
+            times_delivered = self.get_times_delivered(stream, [message_id for _, message_id, _ in claimed_messages])
+            for claimed_message in claimed_messages:
+                _, message_id, body = claimed_message
+                if times_delivered.get(message_id, 0) > self.max_deliveries:
+                    self.log_error("message %s from stream %s delivered more than %s times. Dead letter",
+                                   message_id, stream, self.max_deliveries)
+                    save_dead_letter(body, f"{self.name} max deliveries")
+                    self.client.xack(stream, self.group, message_id)
+                else:
+                    batch.append(claimed_message)
+        if batch:
+            self.log_info("%s pending message(s) claimed", len(batch))
+        return batch
+
+    def read_messages(self):
+        streams = self.get_streams()
+        if not streams:
+            self.stop_event.wait(self.block_ms / 1000)
+            return []
+        batch = self.claim_messages()
+        if batch:
+            return batch
+        response = self.client.xreadgroup(self.group, self.consumer,
+                                          {stream: ">" for stream in streams},
+                                          count=self.batch_size, block=self.block_ms)
+        if isinstance(response, dict):
+            # RESP3
+            response = [(stream, messages[0]) for stream, messages in response.items()]
+        for stream, messages in response or []:
+            if isinstance(stream, bytes):
+                stream = stream.decode("utf-8")
+            batch.extend(self.decode_messages(stream, messages))
+        return batch
+
+    # process
+
+    def process_batch(self, pipeline, batch):
+        """Must yield a (stream, message_id, success) tuple for each message of the batch"""
+        raise NotImplementedError
+
+    def handle_batch(self, batch):
+        self.log_debug("handle %d message(s)", len(batch))
+        pipeline = self.client.pipeline(transaction=True)
+        acked_message_ids = {}
+        for stream, message_id, success in self.process_batch(pipeline, batch):
+            if success:
+                acked_message_ids.setdefault(stream, []).append(message_id)
+        for stream, message_ids in acked_message_ids.items():
+            pipeline.xack(stream, self.group, *message_ids)
+        pipeline.execute()
+        acked_message_count = sum(len(message_ids) for message_ids in acked_message_ids.values())
+        if acked_message_count < len(batch):
+            self.log_error("%s/%s message(s) left pending", len(batch) - acked_message_count, len(batch))
+
+    # consumers
+
+    def delete_idle_consumers(self, stream):
+        # the consumers are named after the host and the process, and are not reused.
+        # the idle ones without pending messages are left by the previous worker processes.
+        for consumer_info in self.client.xinfo_consumers(stream, self.group):
+            consumer = consumer_info["name"]
+            if isinstance(consumer, bytes):
+                consumer = consumer.decode("utf-8")
+            if (
+                consumer != self.consumer
+                and consumer_info["pending"] == 0
+                and consumer_info["idle"] >= self.consumer_max_idle_ms
+            ):
+                self.client.xgroup_delconsumer(stream, self.group, consumer)
+                self.log_info("idle consumer %s deleted from stream %s", consumer, stream)
+
+    # run
+
+    def handle_signal(self, signum, frame):
+        self.log_info("received signal %s", signal.Signals(signum).name)
+        self.stop_event.set()
+
+    def run(self, *args, **kwargs):
+        self.log_info("run")
+        self.setup_metrics_exporter(*args, **kwargs)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.handle_signal)
+        self.client = self.event_queues.get_client()
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        groups_ready = False
+        while not self.stop_event.is_set():
+            try:
+                if not groups_ready:
+                    for stream in self.get_streams():
+                        self.event_queues.ensure_group(self.client, stream, self.group, self.group_start_id)
+                        self.delete_idle_consumers(stream)
+                    groups_ready = True
+                batch = self.read_messages()
+                if batch:
+                    self.handle_batch(batch)
+            except redis.ConnectionError as e:
+                delay = random.uniform(1, 3)
+                self.log_error("connection error: %s. Retry in %.1fs", e, delay)
+                self.stop_event.wait(delay)
+        self.log_info("stopped")
+
+
+class PreprocessWorker(BaseWorker):
+    name = "preprocess worker"
+    group = "preprocess"
+    counters = (
+        ("preprocessed_events", "routing_key"),
+        ("produced_events", "event_type"),
+    )
+
+    @cached_property
+    def preprocessors(self):
+        preprocessors = {}
+        for app in settings['apps']:
+            try:
+                preprocessors_module = import_module("{}.preprocessors".format(app))
+            except ImportError:
+                pass
+            else:
+                for preprocessor in getattr(preprocessors_module, "get_preprocessors")():
+                    preprocessors[self.event_queues.get_raw_events_stream(preprocessor.routing_key)] = preprocessor
+        return preprocessors
+
+    def get_streams(self):
+        return list(self.preprocessors.keys())
+
+    def process_batch(self, pipeline, batch):
+        for stream, message_id, body in batch:
+            preprocessor = self.preprocessors[stream]
+            routing_key = preprocessor.routing_key
+            # the produced events are only added to the pipeline if the message is processed
+            produced_events = []
+            try:
+                for event in preprocessor.process_raw_event(body):
+                    produced_events.append((event.event_type, event.serialize_bytes(machine_metadata=False)))
+            except RetryLater:
+                self.log_error("Message with routing key %s could not be preprocessed. Left pending", routing_key)
+                yield stream, message_id, False
+            else:
+                for event_type, data in produced_events:
+                    self.event_queues.add_message(pipeline, self.event_queues.events_stream, data)
+                    self.inc_counter("produced_events", event_type)
+                yield stream, message_id, True
+                self.inc_counter("preprocessed_events", routing_key)
+
+
+class EnrichWorker(BaseWorker):
+    name = "enrich worker"
+    group = "enrich"
+    counters = (
+        ("enriched_events", "event_type"),
+        ("produced_events", "event_type"),
+    )
+
+    def __init__(self, event_queues, enrich_event):
+        super().__init__(event_queues)
+        self.enrich_event = enrich_event
+
+    def get_streams(self):
+        return [self.event_queues.events_stream]
+
+    def process_batch(self, pipeline, batch):
+        for stream, message_id, body in batch:
+            event_type = body['_zentral']['type']
+            # the produced events are only added to the pipeline if the message is processed
+            produced_events = []
+            try:
+                for event in self.enrich_event(body):
+                    produced_events.append((event.event_type, event.serialize_bytes(machine_metadata=True)))
+            except Exception:
+                logger.exception("Could not enrich event")
+                yield stream, message_id, False
+            else:
+                for produced_event_type, data in produced_events:
+                    self.event_queues.add_message(pipeline, self.event_queues.enriched_events_stream, data)
+                    self.inc_counter("produced_events", produced_event_type)
+                yield stream, message_id, True
+                self.inc_counter("enriched_events", event_type)
+
+
+class ProcessWorker(BaseWorker):
+    name = "process worker"
+    group = "process"
+    counters = (
+        ("processed_events", "event_type"),
+    )
+
+    def __init__(self, event_queues, process_event):
+        super().__init__(event_queues)
+        self.process_event = process_event
+
+    def get_streams(self):
+        return [self.event_queues.enriched_events_stream]
+
+    def process_batch(self, pipeline, batch):
+        for stream, message_id, body in batch:
+            event_type = body['_zentral']['type']
+            try:
+                self.process_event(body)
+            except Exception:
+                logger.exception("Could not process event")
+                yield stream, message_id, False
+            else:
+                yield stream, message_id, True
+                self.inc_counter("processed_events", event_type)
+
+
+class StoreWorker(BaseWorker):
+    # only the new events are stored
+    group_start_id = "$"
+    counters = (
+        ("skipped_events", "event_type"),
+        ("stored_events", "event_type"),
+    )
+
+    def __init__(self, event_queues, event_store):
+        super().__init__(event_queues)
+        self.event_store = event_store
+        self.name = "store worker {}".format(self.event_store.name)
+        self.group = event_queues.get_store_worker_group(event_store)
+        if event_store.worker_batch_size > 1:
+            self.batch_size = event_store.worker_batch_size
+
+    def get_streams(self):
+        return [self.event_queues.enriched_events_stream]
+
+    def store_events(self, batch):
+        for stream, message_id, body in batch:
+            event_type = body['_zentral']['type']
+            try:
+                self.event_store.store(body)
+            except Exception:
+                logger.exception("Could add event to store %s", self.event_store.name)
+                save_dead_letter(body, f"event store {self.event_store.name} error")
+            else:
+                self.inc_counter("stored_events", event_type)
+            yield stream, message_id, True
+
+    def bulk_store_events(self, batch):
+        event_info = {}
+        for stream, message_id, body in batch:
+            event_metadata = body['_zentral']
+            event_info[(event_metadata["id"], event_metadata["index"])] = (stream, message_id, event_metadata["type"])
+        stored_event_count = 0
+        try:
+            for stored_event_key in self.event_store.bulk_store(body for _, _, body in batch):
+                try:
+                    stream, message_id, event_type = event_info.pop(stored_event_key)
+                except KeyError:
+                    self.log_error("unknown stored event %s", stored_event_key)
+                else:
+                    yield stream, message_id, True
+                    self.inc_counter("stored_events", event_type)
+                    stored_event_count += 1
+        except Exception:
+            logger.exception("Could not add events to store %s", self.event_store.name)
+        # not stored
+        for stream, message_id, _ in event_info.values():
+            yield stream, message_id, False
+
+    def process_batch(self, pipeline, batch):
+        included_batch = []
+        included_bodies = set(id(body) for body in self.event_store.filter_batch(body for _, _, body in batch))
+        for stream, message_id, body in batch:
+            if id(body) not in included_bodies:
+                self.inc_counter("skipped_events", body['_zentral']['type'])
+                yield stream, message_id, True
+            else:
+                included_batch.append((stream, message_id, body))
+        if not included_batch:
+            return
+        if self.event_store.worker_batch_size > 1:
+            yield from self.bulk_store_events(included_batch)
+        else:
+            yield from self.store_events(included_batch)
+
+
+class EventQueues(BaseEventQueues):
+    def __init__(self, config_d):
+        super().__init__(config_d)
+        # redis connection. Defaults to the notifier redis server.
+        if config_d.get("url"):
+            self.redis_config = config_d
+        else:
+            self.redis_config = settings.get("notifier")
+        self.prefix = config_d.get("prefix", "zentral:")
+        # approximate max number of messages kept in each stream
+        self.max_len = int(config_d.get("max_len", 100000))
+        # consumers
+        self.batch_size = int(config_d.get("batch_size", 100))
+        self.block_seconds = float(config_d.get("block_seconds", 1))
+        self.claim_min_idle_seconds = float(config_d.get("claim_min_idle_seconds", 60))
+        self.max_deliveries = int(config_d.get("max_deliveries", 5))
+        self.consumer_max_idle_seconds = float(config_d.get("consumer_max_idle_seconds", 3600))
+
+    def get_client(self):
+        return redis.Redis(**build_redis_kwargs(self.redis_config, decode_responses=False))
+
+    @cached_property
+    def client(self):
+        return self.get_client()
+
+    # streams
+
+    def get_raw_events_stream(self, routing_key):
+        return f"{self.prefix}raw_events:{routing_key}"
+
+    @property
+    def events_stream(self):
+        return f"{self.prefix}events"
+
+    @property
+    def enriched_events_stream(self):
+        return f"{self.prefix}enriched_events"
+
+    def add_message(self, client, stream, data):
+        client.xadd(stream, {"data": data}, maxlen=self.max_len, approximate=True)
+
+    @staticmethod
+    def ensure_group(client, stream, group, start_id):
+        try:
+            client.xgroup_create(stream, group, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if not str(e).startswith("BUSYGROUP"):
+                raise
+        else:
+            logger.info("Consumer group %s created on stream %s", group, stream)
+
+    # workers
+
+    def get_preprocess_worker(self):
+        return PreprocessWorker(self)
+
+    def get_enrich_worker(self, enrich_event, iter_cache_counters=None):
+        return EnrichWorker(self, enrich_event)
+
+    def get_process_worker(self, process_event):
+        return ProcessWorker(self, process_event)
+
+    def get_store_worker(self, event_store):
+        return StoreWorker(self, event_store)
+
+    @staticmethod
+    def get_store_worker_group(event_store):
+        return f"store:{event_store.pk}"
+
+    def setup_store_worker_queue(self, event_store):
+        self.ensure_group(self.client, self.enriched_events_stream,
+                          self.get_store_worker_group(event_store), StoreWorker.group_start_id)
+
+    def mark_store_worker_queue_for_deletion(self, event_store):
+        self.client.xgroup_destroy(self.enriched_events_stream, self.get_store_worker_group(event_store))
+
+    def get_worker_queue_depth(self, worker):
+        if not isinstance(worker, BaseWorker):
+            return
+        queue_depth = 0
+        for stream in worker.get_streams():
+            for group_info in self.client.xinfo_groups(stream):
+                group_name = group_info["name"]
+                if isinstance(group_name, bytes):
+                    group_name = group_name.decode("utf-8")
+                if group_name == worker.group:
+                    lag = group_info.get("lag")
+                    if lag is None:
+                        # redis < 7, or lag not available after a trimming
+                        return
+                    queue_depth += lag
+        return queue_depth
+
+    # post events
+
+    def post_raw_event(self, routing_key, raw_event):
+        self.add_message(self.client, self.get_raw_events_stream(routing_key), dumps_bytes(raw_event))
+
+    def post_event(self, event):
+        self.add_message(self.client, self.events_stream, event.serialize_bytes(machine_metadata=False))
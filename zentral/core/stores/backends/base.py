@@ -26,11 +26,23 @@ class BaseStore(Backend):
         self.events_url_authorized_roles = list(self.instance.events_url_authorized_roles.all())
         self.events_url_authorized_role_pk_set = set(r.pk for r in self.events_url_authorized_roles)
         self.event_filter_set = EventFilterSet.from_mapping(self.instance.event_filters)
+        self.event_filter_set.compile()
         self.configured = False
 
+    @property
+    def worker_batch_size(self):
+        # number of events per store worker batch
+        return self.batch_size
+
+    def close(self):
+        pass
+
     def is_serialized_event_included(self, serialized_event):
         return self.event_filter_set.match_serialized_event(serialized_event)
 
+    def filter_batch(self, serialized_events):
+        return self.event_filter_set.filter_batch(serialized_events)
+
     def wait_and_configure(self):
         self.configured = True
 
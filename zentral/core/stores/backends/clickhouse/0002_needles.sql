@@ -0,0 +1,26 @@
+-- Events needles
+-- ordered by needle, to fetch the machine, object and probe events without scanning the events table
+
+CREATE TABLE IF NOT EXISTS `{database}`.`{table_name}_needles`
+(
+    `needle` String CODEC(ZSTD(1)),
+    `created_at` DateTime64(9, 'UTC') CODEC(Delta(8), ZSTD(1)),
+    `type` LowCardinality(String) CODEC(ZSTD(1)),
+    `id` String CODEC(ZSTD(1)),
+    `idx` Int64 CODEC(ZSTD(1))
+)
+ENGINE = {table_engine}
+PARTITION BY toDate(created_at)
+ORDER BY (needle, created_at, id, idx)
+TTL created_at + toIntervalDay({ttl_days})
+SETTINGS ttl_only_drop_parts = 1;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS `{database}`.`{table_name}_needles_mv` TO `{database}`.`{table_name}_needles`
+AS SELECT
+    needles AS needle,
+    created_at,
+    type,
+    metadata.id.:String AS id,
+    metadata.index.:Int64 AS idx
+FROM `{database}`.`{table_name}`
+ARRAY JOIN needles;
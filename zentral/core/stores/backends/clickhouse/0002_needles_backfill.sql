@@ -0,0 +1,13 @@
+-- Events needles backfill
+-- the materialized view only indexes the new events, the existing events are indexed once, when the table is created
+
+INSERT INTO `{database}`.`{table_name}_needles`
+SELECT
+    needles AS needle,
+    created_at,
+    type,
+    metadata.id.:String AS id,
+    metadata.index.:Int64 AS idx
+FROM `{database}`.`{table_name}`
+ARRAY JOIN needles
+WHERE created_at < toDateTime64('{backfill_before}', 9, 'UTC');
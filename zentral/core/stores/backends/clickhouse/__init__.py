@@ -4,10 +4,10 @@ import os
 import clickhouse_connect
 from django.utils.functional import cached_property
 from django.utils.timezone import is_naive, make_aware, make_naive
-from kombu.utils import json
 from rest_framework import serializers
 from zentral.core.events import event_from_event_d, event_types
 from zentral.core.stores.backends.base import BaseStore, serialize_needles
+from zentral.utils.json import dumps
 
 
 logger = logging.getLogger('zentral.core.stores.backends.clickhouse')
@@ -36,6 +36,9 @@ class ClickHouseStore(BaseStore):
         "table_name",
         "ttl_days",
         "batch_size",
+        "async_insert",
+        "wait_for_async_insert",
+        "needles_table",
     )
     encrypted_kwargs_paths = (
         ["password"],
@@ -51,6 +54,8 @@ class ClickHouseStore(BaseStore):
     default_tls_port = 8443
     default_ttl_days = 90
     max_batch_size = 1000
+    max_async_insert_batch_size = 10000
+    insert_chunk_size = 1000
     column_names = (
         "created_at",
         "type",
@@ -75,22 +80,33 @@ class ClickHouseStore(BaseStore):
 
     def migrate(self):
         # TODO: much to be done here in the future!
-        migration_filepath = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            "0001_initial.sql"
-        )
-        with open(migration_filepath) as f:
-            sql = f.read()
-        sql = sql.format(
-            database=self.database,
-            table_name=self.table_name,
-            table_engine=self.table_engine,
-            ttl_days=self.ttl_days,
-        )
-        for statement in (s.strip() for s in sql.split(";")):
-            if not statement:
-                continue
-            self.client.command(statement)
+        migration_filenames = ["0001_initial.sql"]
+        backfill_before = None
+        if self.needles_table:
+            migration_filenames.append("0002_needles.sql")
+            if not self.client.command(f"EXISTS TABLE `{self.database}`.`{self.table_name}_needles`"):
+                # new needles table → index the existing events.
+                # the materialized view only indexes the events inserted after its creation.
+                backfill_before = self._serialize_datetime(datetime.utcnow())
+                migration_filenames.append("0002_needles_backfill.sql")
+        for migration_filename in migration_filenames:
+            migration_filepath = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                migration_filename
+            )
+            with open(migration_filepath) as f:
+                sql = f.read()
+            sql = sql.format(
+                database=self.database,
+                table_name=self.table_name,
+                table_engine=self.table_engine,
+                ttl_days=self.ttl_days,
+                backfill_before=backfill_before,
+            )
+            for statement in (s.strip() for s in sql.split(";")):
+                if not statement:
+                    continue
+                self.client.command(statement)
 
     def wait_and_configure(self):
         self.migrate()
@@ -107,7 +123,7 @@ class ClickHouseStore(BaseStore):
         tags = metadata.pop("tags", [])
         needles = serialize_needles(metadata)
         serial_number = metadata.get("machine_serial_number") or ""
-        payload = json.dumps(event_d)
+        payload = dumps(event_d)
         return (
             # event key
             (metadata["id"], metadata["index"]),
@@ -129,14 +145,36 @@ class ClickHouseStore(BaseStore):
         event_d["_zentral"]["created_at"] = self._datetime_to_zentral(result["created_at"])
         return event_from_event_d(event_d)
 
-    def _insert(self, data):
-        self.wait_and_configure_if_necessary()
-        self.client.insert(
+    @cached_property
+    def insert_settings(self):
+        if not self.async_insert:
+            return {}
+        # server side batching
+        return {"async_insert": 1,
+                "wait_for_async_insert": 0 if self.wait_for_async_insert is False else 1}
+
+    @cached_property
+    def insert_context(self):
+        # reusable context, to fetch the column types only once
+        return self.client.create_insert_context(
             self.table_name,
-            data,
             column_names=self.column_names,
+            column_oriented=True,
+            settings=self.insert_settings,
         )
 
+    def _insert(self, rows):
+        self.wait_and_configure_if_necessary()
+        insert_context = self.insert_context
+        try:
+            self.client.insert(
+                data=[list(column) for column in zip(*rows)],
+                context=insert_context,
+            )
+        finally:
+            # reset the context if the insert failed
+            insert_context.data = None
+
     def store(self, event):
         _, event_t = self._serialize_event(event)
         self._insert([event_t])
@@ -144,13 +182,19 @@ class ClickHouseStore(BaseStore):
     def bulk_store(self, events):
         self.wait_and_configure_if_necessary()
         event_keys = []
-        data = []
+        rows = []
         for event in events:
             event_key, event_t = self._serialize_event(event)
             event_keys.append(event_key)
-            data.append(event_t)
-        self._insert(data)
-        return event_keys
+            rows.append(event_t)
+            if len(rows) >= self.insert_chunk_size:
+                self._insert(rows)
+                yield from event_keys
+                event_keys = []
+                rows = []
+        if rows:
+            self._insert(rows)
+            yield from event_keys
 
     # common
 
@@ -190,43 +234,113 @@ class ClickHouseStore(BaseStore):
             aggs[result["type"]] = result["sum(count)"]
         return aggs
 
-    def _fetch_needle_events(self, needle, from_dt, to_dt=None, event_type=None, limit=10, cursor=None):
-        self.wait_and_configure_if_necessary()
+    def _get_needle_wheres(self, needle_where, id_column, index_column,
+                           needle, from_dt, to_dt=None, event_type=None, cursor=None):
         wheres = [
-            "has(needles, {needle:String})",
+            needle_where,
             "created_at >= toDateTime64({from_dt:String}, 9, 'UTC')",
         ]
         params = {
             "needle": needle,
             "from_dt": self._serialize_datetime(from_dt),
-            "limit": limit
         }
-        if cursor or to_dt:
+        if to_dt:
             wheres.append("created_at < toDateTime64({to_dt:String}, 9, 'UTC')")
-            if cursor:
-                to_dt = cursor
+            params["to_dt"] = self._serialize_datetime(to_dt)
+        if cursor:
+            if isinstance(cursor, str):
+                # created_at only legacy cursor
+                cursor = (cursor, None, None)
+            params["cursor_created_at"], cursor_id, cursor_index = cursor
+            if cursor_id is None:
+                wheres.append("created_at < toDateTime64({cursor_created_at:String}, 9, 'UTC')")
             else:
-                to_dt = self._serialize_datetime(to_dt)
-            params["to_dt"] = to_dt
+                # keyset pagination, same order as the query
+                wheres.append(
+                    "(created_at < toDateTime64({cursor_created_at:String}, 9, 'UTC') OR "
+                    "(created_at = toDateTime64({cursor_created_at:String}, 9, 'UTC') AND "
+                    f"({id_column}, {index_column}) > ({{cursor_id:String}}, {{cursor_index:Int64}})))"
+                )
+                params["cursor_id"] = cursor_id
+                params["cursor_index"] = cursor_index
         if event_type:
             wheres.append("type = {event_type:String}")
             params["event_type"] = event_type
-        wheres = " AND ".join(wheres)
+        return " AND ".join(wheres), params
+
+    def _fetch_events_by_keys(self, event_keys):
+        # the events table is ordered by (type, created_at)
         query_ctx = self.client.create_query_context(
             query=(
-                f"SELECT metadata, type, tags, created_at, payload FROM `{self.table_name}` WHERE {wheres} "
-                "ORDER BY created_at DESC, metadata.id.:String ASC, metadata.idx.:UInt32 ASC LIMIT {limit:UInt32}"
+                f"SELECT metadata, type, tags, created_at, payload FROM `{self.table_name}` "
+                "WHERE type IN {types:Array(String)} "
+                "AND created_at >= toDateTime64({min_created_at:String}, 9, 'UTC') "
+                "AND created_at <= toDateTime64({max_created_at:String}, 9, 'UTC') "
+                "AND metadata.id.:String IN {ids:Array(String)}"
             ),
-            parameters=params
+            parameters={
+                "types": sorted(set(k["type"] for k in event_keys)),
+                "min_created_at": self._serialize_datetime(min(k["created_at"] for k in event_keys)),
+                "max_created_at": self._serialize_datetime(max(k["created_at"] for k in event_keys)),
+                "ids": sorted(set(k["id"] for k in event_keys)),
+            }
         )
-        events = []
-        cursor = None
+        events = {}
         for result in self.client.query(context=query_ctx).named_results():
             event = self._deserialize_event(result)
-            if cursor is None or cursor > event.metadata.created_at:
-                cursor = event.metadata.created_at
-            events.append(event)
-        return events, self._serialize_datetime(cursor)
+            events[(str(event.metadata.uuid), event.metadata.index)] = event
+        # same order as the keys
+        return [events[key] for key in ((k["id"], k["idx"]) for k in event_keys) if key in events]
+
+    def _fetch_needle_events(self, needle, from_dt, to_dt=None, event_type=None, limit=10, cursor=None):
+        self.wait_and_configure_if_necessary()
+        if self.needles_table:
+            # page of event keys from the needles table, then the events
+            wheres, params = self._get_needle_wheres(
+                "needle = {needle:String}", "id", "idx",
+                needle, from_dt, to_dt, event_type, cursor
+            )
+            params["limit"] = limit
+            query_ctx = self.client.create_query_context(
+                query=(
+                    f"SELECT created_at, type, id, idx FROM `{self.table_name}_needles` WHERE {wheres} "
+                    "ORDER BY created_at DESC, id ASC, idx ASC LIMIT {limit:UInt32}"
+                ),
+                parameters=params
+            )
+            event_keys = list(self.client.query(context=query_ctx).named_results())
+            if not event_keys:
+                return [], None
+            events = self._fetch_events_by_keys(event_keys)
+            last_key = event_keys[-1]
+            next_cursor = [self._serialize_datetime(last_key["created_at"]), last_key["id"], last_key["idx"]]
+            result_count = len(event_keys)
+        else:
+            wheres, params = self._get_needle_wheres(
+                "has(needles, {needle:String})", "metadata.id.:String", "metadata.index.:Int64",
+                needle, from_dt, to_dt, event_type, cursor
+            )
+            params["limit"] = limit
+            query_ctx = self.client.create_query_context(
+                query=(
+                    f"SELECT metadata, type, tags, created_at, payload FROM `{self.table_name}` WHERE {wheres} "
+                    "ORDER BY created_at DESC, metadata.id.:String ASC, metadata.index.:Int64 ASC "
+                    "LIMIT {limit:UInt32}"
+                ),
+                parameters=params
+            )
+            events = [self._deserialize_event(result)
+                      for result in self.client.query(context=query_ctx).named_results()]
+            next_cursor = None
+            if events:
+                last_event = events[-1]
+                next_cursor = [self._serialize_datetime(last_event.metadata.created_at),
+                               str(last_event.metadata.uuid),
+                               last_event.metadata.index]
+            result_count = len(events)
+        if result_count < limit:
+            next_cursor = None
+        return events, next_cursor
 
     # machine events
 
@@ -365,8 +479,11 @@ class ClickHouseStoreSerializer(serializers.Serializer):
     batch_size = serializers.IntegerField(
         min_value=1, required=False,
         default=ClickHouseStore.default_batch_size,
-        max_value=ClickHouseStore.max_batch_size,
+        max_value=ClickHouseStore.max_async_insert_batch_size,
     )
+    async_insert = serializers.BooleanField(default=False, required=False)
+    wait_for_async_insert = serializers.BooleanField(default=True, required=False)
+    needles_table = serializers.BooleanField(default=False, required=False)
 
     def validate(self, data):
         username = data.get("username")
@@ -374,4 +491,10 @@ class ClickHouseStoreSerializer(serializers.Serializer):
         access_token = data.get("access_token")
         if access_token and (username or password):
             raise serializers.ValidationError("Cannot use both access_token and username/password")
+        batch_size = data.get("batch_size")
+        if batch_size and batch_size > ClickHouseStore.max_batch_size and not data.get("async_insert"):
+            raise serializers.ValidationError({
+                "batch_size": f"Ensure this value is less than or equal to {ClickHouseStore.max_batch_size} "
+                              "without async_insert."
+            })
         return data
@@ -621,7 +621,8 @@ class ESOSStore(BaseStore):
                 for b in r['aggregations']['buckets']['buckets']]
 
     def close(self):
-        self._client.close()
+        if self.configured:
+            self._client.close()
 
 
 # Serializers
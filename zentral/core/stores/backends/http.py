@@ -1,14 +1,20 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import gzip
 import logging
 import queue
 import threading
 import time
 from urllib.parse import urlparse
 from django.utils.functional import cached_property
-from kombu.utils import json
 import requests
+try:
+    from compression import zstd
+except ImportError:
+    from backports import zstd
 from rest_framework import serializers
 from .base import BaseStore
 from base.utils import deployment_info
+from zentral.utils.json import dumps_bytes
 from zentral.utils.requests import CustomHTTPAdapter
 
 
@@ -20,10 +26,12 @@ class HTTPStoreClient:
     max_request_timeout = 600
     default_max_retries = 3
     max_max_retries = 5
+    compression_choices = ["none", "gzip", "zstd"]
 
-    def __init__(self, store, name="client"):
+    def __init__(self, store, name="client", pool_maxsize=None, retry_post=False):
         self.endpoint_url = store.endpoint_url
         self.name = name
+        self.compression = store.compression
         # Session
         self.session = requests.Session()
         self.session.verify = store.verify_tls
@@ -33,7 +41,15 @@ class HTTPStoreClient:
             self.session.headers.update({h["name"]: h["value"] for h in store.headers})
         if store.username and store.password:
             self.session.auth = (store.username, store.password)
-        self.session.mount(self.endpoint_url, CustomHTTPAdapter(store.request_timeout, store.max_retries))
+        adapter_kwargs = {}
+        if pool_maxsize:
+            # keep-alive connections shared by the threads
+            adapter_kwargs["pool_maxsize"] = pool_maxsize
+        if retry_post:
+            # the POST requests are also retried
+            adapter_kwargs["allowed_methods"] = None
+        self.session.mount(self.endpoint_url,
+                           CustomHTTPAdapter(store.request_timeout, store.max_retries, **adapter_kwargs))
 
     def _serialize_event(self, event):
         if not isinstance(event, dict):
@@ -44,10 +60,26 @@ class HTTPStoreClient:
         payload[namespace] = event
         return payload
 
+    def _post(self, data, headers=None):
+        if headers is None:
+            headers = {}
+        if self.compression == "gzip":
+            data = gzip.compress(data, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        elif self.compression == "zstd":
+            data = zstd.compress(data)
+            headers["Content-Encoding"] = "zstd"
+        r = self.session.post(self.endpoint_url, data=data, headers=headers)
+        r.raise_for_status()
+
     def store_event(self, event):
         payload = self._serialize_event(event)
-        r = self.session.post(self.endpoint_url, data=json.dumps(payload))
-        r.raise_for_status()
+        self._post(dumps_bytes(payload))
+
+    def store_payloads(self, payloads):
+        # newline-delimited JSON
+        self._post(b"".join(dumps_bytes(payload) + b"\n" for payload in payloads),
+                   {"Content-Type": "application/x-ndjson"})
 
 
 class HTTPStoreThread(threading.Thread):
@@ -92,13 +124,29 @@ class HTTPStore(BaseStore):
         "headers",
         "concurrency",
         "max_retries",
-        "request_timeout"
+        "request_timeout",
+        "batch_size",
+        "compression",
     )
     encrypted_kwargs_paths = (
         ["headers", "*", "value"],
         ["password"],
     )
     max_concurrency = 20
+    max_batch_size = 500
+
+    def load(self):
+        super().load()
+        self.concurrency = self.concurrency or 1
+        # maximum number of events per request
+        self.batch_size = self.batch_size or 1
+
+    @property
+    def worker_batch_size(self):
+        if self.batch_size > 1:
+            # the store worker batches are split in concurrent requests
+            return self.batch_size * self.concurrency
+        return 1
 
     def get_process_thread_constructor(self):
         def constructor(thread_id, in_queue, out_queue, stop_event):
@@ -107,11 +155,60 @@ class HTTPStore(BaseStore):
 
     @cached_property
     def client(self):
+        if self.batch_size > 1:
+            return HTTPStoreClient(self, pool_maxsize=self.concurrency, retry_post=True)
         return HTTPStoreClient(self)
 
+    @cached_property
+    def executor(self):
+        return ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"HTTP store {self.slug}")
+
+    def close(self):
+        if "executor" in self.__dict__:
+            self.executor.shutdown(wait=True)
+            del self.executor
+        if "client" in self.__dict__:
+            self.client.session.close()
+            del self.client
+
     def store(self, event):
         self.client.store_event(event)
 
+    def _store_payloads(self, payloads):
+        self.client.store_payloads(payloads)
+        return [(payload["id"], payload["index"]) for payload in payloads]
+
+    def _iter_payload_batches(self, events):
+        payloads = []
+        for event in events:
+            payloads.append(self.client._serialize_event(event))
+            if len(payloads) >= self.batch_size:
+                yield payloads
+                payloads = []
+        if payloads:
+            yield payloads
+
+    def bulk_store(self, events):
+        if self.batch_size < 2:
+            raise RuntimeError("bulk_store is not available when batch_size < 2")
+        in_flight = set()
+        for payloads in self._iter_payload_batches(events):
+            if len(in_flight) >= self.concurrency:
+                # bounded number of requests in flight
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from self._get_stored_event_keys(future)
+            in_flight.add(self.executor.submit(self._store_payloads, payloads))
+        for future in wait(in_flight).done:
+            yield from self._get_stored_event_keys(future)
+
+    def _get_stored_event_keys(self, future):
+        try:
+            return future.result()
+        except Exception:
+            logger.exception("Could not store %s events", self.name)
+            return []
+
 
 # Serializers
 
@@ -153,6 +250,8 @@ class HTTPStoreSerializer(serializers.Serializer):
         max_value=HTTPStoreClient.max_max_retries,
         default=HTTPStoreClient.default_max_retries,
     )
+    batch_size = serializers.IntegerField(min_value=1, max_value=HTTPStore.max_batch_size, default=1)
+    compression = serializers.ChoiceField(choices=HTTPStoreClient.compression_choices, default="none")
 
     def validate(self, data):
         username = data.get("username")
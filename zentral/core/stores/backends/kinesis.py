@@ -1,14 +1,82 @@
+import hashlib
 import logging
+import time
 import boto3
-from kombu.utils import json
 from rest_framework import serializers
 from zentral.core.stores.backends.base import BaseStore, AWSAuthSerializer
 from zentral.utils.boto3 import make_refreshable_assume_role_session
+from zentral.utils.json import dumps, dumps_bytes
 
 
 logger = logging.getLogger('zentral.core.stores.backends.kinesis')
 
 
+# KPL aggregated records
+# see https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md
+
+
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(bits | 0x80)
+        else:
+            encoded.append(bits)
+            return bytes(encoded)
+
+
+def _encode_bytes_field(field_number, value):
+    return _encode_varint(field_number << 3 | 2) + _encode_varint(len(value)) + value
+
+
+class AggregatedRecord:
+    """Build a KPL aggregated record, with many events in one Kinesis record"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.partition_key = None
+        self.partition_key_indexes = {}
+        self.encoded_partition_keys = []
+        self.encoded_records = []
+        self.event_keys = []
+        self.size = len(KPL_MAGIC) + 16  # magic + MD5 digest
+
+    def add(self, data, partition_key, event_key):
+        """Add the event data to the record. Returns False if the record is full"""
+        new_partition_key_index = len(self.partition_key_indexes)
+        partition_key_index = self.partition_key_indexes.get(partition_key, new_partition_key_index)
+        encoded_partition_key = b""
+        if partition_key_index == new_partition_key_index:
+            encoded_partition_key = _encode_bytes_field(1, partition_key.encode("utf-8"))
+        encoded_record = _encode_bytes_field(
+            3,
+            _encode_varint(1 << 3) + _encode_varint(partition_key_index)  # partition_key_index
+            + _encode_bytes_field(3, data)  # data
+        )
+        size = self.size + len(encoded_partition_key) + len(encoded_record)
+        if self.event_keys and size + len(self.partition_key) > self.max_size:
+            return False
+        if self.partition_key is None:
+            # the partition key of the Kinesis record
+            self.partition_key = partition_key
+        if encoded_partition_key:
+            self.partition_key_indexes[partition_key] = partition_key_index
+            self.encoded_partition_keys.append(encoded_partition_key)
+        self.encoded_records.append(encoded_record)
+        self.event_keys.append(event_key)
+        self.size = size
+        return True
+
+    def serialize(self):
+        message = b"".join(self.encoded_partition_keys + self.encoded_records)
+        return KPL_MAGIC + message + hashlib.md5(message).digest()
+
+
 class KinesisStore(BaseStore):
     kwargs_keys = (
         "stream",
@@ -18,6 +86,7 @@ class KinesisStore(BaseStore):
         "assume_role_arn",
         "batch_size",
         "serialization_format",
+        "aggregation",
     )
     encrypted_kwargs_paths = (
         ["aws_secret_access_key"],
@@ -25,6 +94,19 @@ class KinesisStore(BaseStore):
 
     max_batch_size = 500
     serialization_format_choices = ["zentral", "firehose_v1"]
+    # same default as the KPL AggregationMaxSize
+    aggregated_record_max_size = 51200
+    # PutRecords limits
+    max_put_records_count = 500
+    max_put_records_size = 5 * 2**20
+    # failed records
+    max_put_records_attempts = 3
+    put_records_retry_delay = 0.1  # seconds, doubled after each attempt
+
+    def __init__(self, instance, load=True):
+        # adjusted from the throttling feedback
+        self.put_records_count = self.max_put_records_count
+        super().__init__(instance, load)
 
     def wait_and_configure(self):
         session_kwargs = {}
@@ -45,6 +127,11 @@ class KinesisStore(BaseStore):
 
     def _serialize_event(self, event):
         if not isinstance(event, dict):
+            if self.serialization_format == "zentral":
+                # reuse the cached encoded event
+                metadata = event.metadata
+                event_id = str(metadata.uuid)
+                return event.serialize_bytes(), f"{event_id}{metadata.index}", event_id, metadata.index
             event_d = event.serialize()
         else:
             event_d = event
@@ -64,11 +151,11 @@ class KinesisStore(BaseStore):
                 "tags": tags,
                 "probes": [probe_d["pk"] for probe_d in metadata.get("probes", [])],
                 "objects": [f"{k}:{v}" for k in objects for v in objects[k]],
-                "metadata": json.dumps(metadata),
-                "payload": json.dumps(event_d),
+                "metadata": dumps(metadata),
+                "payload": dumps(event_d),
                 "serial_number": serial_number
             }
-        return json.dumps(event_d).encode("utf-8"), partition_key, event_id, event_index
+        return dumps_bytes(event_d), partition_key, event_id, event_index
 
     def store(self, event):
         self.wait_and_configure_if_necessary()
@@ -83,25 +170,96 @@ class KinesisStore(BaseStore):
         if self.batch_size < 2:
             raise RuntimeError("bulk_store is not available when batch_size < 2")
 
-        event_keys = []
-        records = []
-        for event in events:
-            data, partition_key, event_id, event_index = self._serialize_event(event)
-            event_keys.append((event_id, event_index))
-            records.append({'Data': data, 'PartitionKey': partition_key})
+        if self.aggregation:
+            records = self._iter_aggregated_records(events)
+        else:
+            records = self._iter_records(events)
+        records = list(records)
         if not records:
             return
 
-        response = self.client.put_records(Records=records, StreamName=self.stream)
-        failed_record_count = response.get("FailedRecordCount", 0)
-        if failed_record_count == 0:
-            # shortcut
-            yield from event_keys
-            return
-        logger.warning("%s failed record(s)", failed_record_count)
-        for key, record in zip(event_keys, response.get("Records", [])):
-            if record.get("SequenceNumber") and record.get("ShardId"):
-                yield key
+        attempt = 1
+        while True:
+            records = yield from self._put_records(records)
+            if not records:
+                break
+            if attempt >= self.max_put_records_attempts:
+                logger.error("%s record(s) not stored after %s attempts", len(records), attempt)
+                break
+            time.sleep(self.put_records_retry_delay * 2 ** (attempt - 1))
+            attempt += 1
+
+    def _iter_records(self, events):
+        for event in events:
+            data, partition_key, event_id, event_index = self._serialize_event(event)
+            yield {'Data': data, 'PartitionKey': partition_key}, [(event_id, event_index)]
+
+    def _iter_aggregated_records(self, events):
+        aggregated_record = AggregatedRecord(self.aggregated_record_max_size)
+        for event in events:
+            data, partition_key, event_id, event_index = self._serialize_event(event)
+            if not aggregated_record.add(data, partition_key, (event_id, event_index)):
+                yield ({'Data': aggregated_record.serialize(), 'PartitionKey': aggregated_record.partition_key},
+                       aggregated_record.event_keys)
+                aggregated_record = AggregatedRecord(self.aggregated_record_max_size)
+                aggregated_record.add(data, partition_key, (event_id, event_index))
+        if aggregated_record.event_keys:
+            yield ({'Data': aggregated_record.serialize(), 'PartitionKey': aggregated_record.partition_key},
+                   aggregated_record.event_keys)
+
+    def _iter_put_records_batches(self, records):
+        batch = []
+        batch_size = 0
+        for record, event_keys in records:
+            record_size = len(record['Data']) + len(record['PartitionKey'])
+            if batch and (len(batch) >= self.put_records_count
+                          or batch_size + record_size > self.max_put_records_size):
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append((record, event_keys))
+            batch_size += record_size
+        if batch:
+            yield batch
+
+    def _update_put_records_count(self, throttled):
+        if throttled:
+            # multiplicative decrease
+            self.put_records_count = max(1, self.put_records_count // 2)
+            logger.warning("Throttled. PutRecords count: %s", self.put_records_count)
+        elif self.put_records_count < self.max_put_records_count:
+            # additive increase
+            self.put_records_count = min(self.max_put_records_count,
+                                         self.put_records_count + max(1, self.put_records_count // 10))
+
+    def _put_records(self, records):
+        """Yield the event keys of the stored records, return the failed records"""
+        failed_records = []
+        for batch in self._iter_put_records_batches(records):
+            response = self.client.put_records(Records=[record for record, _ in batch], StreamName=self.stream)
+            failed_record_count = response.get("FailedRecordCount", 0)
+            if failed_record_count == 0:
+                # shortcut
+                self._update_put_records_count(False)
+                for _, event_keys in batch:
+                    yield from event_keys
+                continue
+            logger.warning("%s failed record(s)", failed_record_count)
+            throttled = False
+            record_responses = response.get("Records", [])
+            for idx, (record, event_keys) in enumerate(batch):
+                try:
+                    record_response = record_responses[idx]
+                except IndexError:
+                    record_response = {}
+                if record_response.get("SequenceNumber") and record_response.get("ShardId"):
+                    yield from event_keys
+                else:
+                    failed_records.append((record, event_keys))
+                    if record_response.get("ErrorCode") == "ProvisionedThroughputExceededException":
+                        throttled = True
+            self._update_put_records_count(throttled)
+        return failed_records
 
 
 # Serializers
@@ -117,3 +275,4 @@ class KinesisStoreSerializer(AWSAuthSerializer):
     serialization_format = serializers.ChoiceField(
         choices=KinesisStore.serialization_format_choices,
     )
+    aggregation = serializers.BooleanField(default=False)
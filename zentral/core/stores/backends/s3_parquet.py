@@ -1,12 +1,14 @@
 from datetime import datetime
 import logging
+import os.path
 import secrets
-from kombu.utils import json
+import tempfile
 import pyarrow as pa
-from pyarrow.fs import S3FileSystem
+from pyarrow.fs import LocalFileSystem, S3FileSystem, copy_files
 import pyarrow.parquet as pq
 from rest_framework import serializers
 from zentral.core.stores.backends.base import AWSAuthSerializer, BaseStore, serialize_needles
+from zentral.utils.json import dumps
 
 
 logger = logging.getLogger('zentral.core.stores.backends.s3_parquet')
@@ -22,6 +24,8 @@ class S3ParquetStore(BaseStore):
         "assume_role_arn",
         "batch_size",
         "max_batch_age_seconds",
+        "partitioning",
+        "row_group_size",
     )
     encrypted_kwargs_paths = (
         ["aws_secret_access_key"],
@@ -33,6 +37,10 @@ class S3ParquetStore(BaseStore):
     default_max_batch_age_seconds = 300
     min_max_batch_age_seconds = 10
     max_max_batch_age_seconds = 1200
+    partitioning_choices = ["none", "date", "date_type"]
+    default_row_group_size = 10000
+    min_row_group_size = 1000
+    max_row_group_size = 100000
 
     @staticmethod
     def _get_schema():
@@ -65,14 +73,29 @@ class S3ParquetStore(BaseStore):
         self._writer_id = secrets.token_hex(4)
         self._schema = self._get_schema()
         self._fs = self._get_filesystem()
+        self._local_fs = LocalFileSystem()
         self.configured = True
         logger.info("Writer ID: %s", self._writer_id)
 
-    def _get_parquet_path(self):
-        n = datetime.utcnow()
+    def _get_partition(self, row):
+        # Hive style partition keys, not named after the columns, to avoid conflicts.
+        # The events are only acknowledged once their file is uploaded, so each worker batch
+        # is written as one file per partition. With date_type, a batch can produce many small files.
+        if self.partitioning == "date":
+            return f"event_date={row['created_at']:%Y-%m-%d}/"
+        elif self.partitioning == "date_type":
+            return f"event_date={row['created_at']:%Y-%m-%d}/event_type={row['type']}/"
+
+    def _get_parquet_path(self, partition=None):
+        if partition is None:
+            n = datetime.utcnow()
+            return (
+                f"{self.bucket}/{self.prefix}{n:%Y/%m/%d}/"
+                f"{self._writer_id}/{self._batch_index:08d}.parquet"
+            )
         return (
-            f"{self.bucket}/{self.prefix}{n:%Y/%m/%d}/"
-            f"{self._writer_id}/{self._batch_index:08d}.parquet"
+            f"{self.bucket}/{self.prefix}{partition}"
+            f"{self._writer_id}_{self._batch_index:08d}.parquet"
         )
 
     def _serialize_event(self, event):
@@ -95,8 +118,8 @@ class S3ParquetStore(BaseStore):
             "tags": tags,
             "needles": needles,
             "serial_number": serial_number,
-            "metadata": json.dumps(metadata),
-            "payload": json.dumps(event_d),
+            "metadata": dumps(metadata),
+            "payload": dumps(event_d),
         }, event_id, event_index
 
     def store(self, event):
@@ -111,18 +134,51 @@ class S3ParquetStore(BaseStore):
         if self.batch_size < 2:
             raise RuntimeError("bulk_store is not available when batch_size < 2")
 
-        event_keys = []
-        rows = []
-        for event in events:
-            row, event_id, event_index = self._serialize_event(event)
-            event_keys.append((event_id, event_index))
-            rows.append(row)
-
-        table = pa.Table.from_pylist(rows, schema=self._schema)
-        pq.write_table(table, self._get_parquet_path(), filesystem=self._fs)
-        self._batch_index += 1
-
-        yield from event_keys
+        row_group_size = self.row_group_size or self.default_row_group_size
+
+        with tempfile.TemporaryDirectory(prefix="zentral_s3_parquet_") as tmp_dir:
+            # spill the rows to one local file per partition, one row group at a time
+            partitions = {}
+            try:
+                for event in events:
+                    row, event_id, event_index = self._serialize_event(event)
+                    partition = self._get_partition(row)
+                    try:
+                        local_path, writer, rows, event_keys = partitions[partition]
+                    except KeyError:
+                        local_path = os.path.join(tmp_dir, f"{len(partitions):06d}.parquet")
+                        writer = pq.ParquetWriter(local_path, self._schema, filesystem=self._local_fs)
+                        rows = []
+                        event_keys = []
+                        partitions[partition] = (local_path, writer, rows, event_keys)
+                    rows.append(row)
+                    event_keys.append((event_id, event_index))
+                    if len(rows) >= row_group_size:
+                        writer.write_table(pa.Table.from_pylist(rows, schema=self._schema))
+                        rows.clear()
+                for _, writer, rows, _ in partitions.values():
+                    if rows:
+                        writer.write_table(pa.Table.from_pylist(rows, schema=self._schema))
+                        rows.clear()
+            finally:
+                for _, writer, _, _ in partitions.values():
+                    writer.close()
+
+            # the batch index is incremented before the uploads,
+            # to never overwrite the files of a partially uploaded batch
+            uploads = [(local_path, self._get_parquet_path(partition), event_keys)
+                       for partition, (local_path, _, _, event_keys) in partitions.items()]
+            self._batch_index += 1
+
+            # upload the files, and only acknowledge the events of the uploaded files
+            for local_path, parquet_path, event_keys in uploads:
+                copy_files(
+                    local_path,
+                    parquet_path,
+                    source_filesystem=self._local_fs,
+                    destination_filesystem=self._fs,
+                )
+                yield from event_keys
 
 
 # Serializers
@@ -141,3 +197,12 @@ class S3ParquetStoreSerializer(AWSAuthSerializer):
         min_value=S3ParquetStore.min_max_batch_age_seconds,
         max_value=S3ParquetStore.max_max_batch_age_seconds,
     )
+    partitioning = serializers.ChoiceField(
+        choices=S3ParquetStore.partitioning_choices,
+        default="none",
+    )
+    row_group_size = serializers.IntegerField(
+        default=S3ParquetStore.default_row_group_size,
+        min_value=S3ParquetStore.min_row_group_size,
+        max_value=S3ParquetStore.max_row_group_size,
+    )
@@ -3,13 +3,57 @@ from datetime import datetime
 import json
 import logging
 import os
+import uuid
 from django.utils import timezone
 from django.utils.text import get_valid_filename
+from kombu.utils import json as kombu_json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logger = logging.getLogger("zentral.utils.json")
 
 
+# fast JSON encoding
+#
+# orjson is used when available. The output can be decoded by the kombu JSON serializer:
+# the datetime objects are passed through to the kombu JSON encoder, to get the same envelopes.
+# The UUID objects are natively serialized by orjson as strings.
+# The stdlib fallback produces the same compact UTF-8 output, with the same UUID strings.
+
+
+if orjson is not None:
+    _orjson_default = kombu_json.JSONEncoder().default
+    _orjson_option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class _FallbackJSONEncoder(kombu_json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, uuid.UUID):
+            # like orjson, not the kombu envelope
+            return str(o)
+        return super().default(o)
+
+
+def dumps_bytes(obj):
+    """Serialize obj to UTF-8 encoded JSON bytes"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_orjson_default, option=_orjson_option)
+        except TypeError:
+            # orjson.JSONEncodeError, for example with integers > 64 bits
+            pass
+    return kombu_json.dumps(obj, cls=_FallbackJSONEncoder,
+                            ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(obj):
+    """Serialize obj to a JSON str"""
+    return dumps_bytes(obj).decode("utf-8")
+
+
 def prepare_loaded_plist(obj):
     if isinstance(obj, bytes):
         obj = b64encode(obj).decode("ascii")
@@ -167,6 +167,188 @@ class MTObjectManager(models.Manager):
                 created = True
         return obj, created
 
+    # bulk commit
+
+    @staticmethod
+    def _has_custom_save(model):
+        return model.save is not AbstractMTObject.save
+
+    def _collect_bulk_commit_nodes(self, model, tree, nodes, model_fields):
+        model_nodes = nodes.setdefault(model, {})
+        mt_hash = tree['mt_hash']
+        if mt_hash in model_nodes:
+            return
+        fields = model_fields.get(model)
+        if fields is None:
+            fields = model_fields[model] = {}
+        obj = model()
+        children = []
+        for k, v in tree.items():
+            if k == 'mt_hash':
+                continue
+            if k not in fields:
+                if isinstance(v, dict):
+                    try:
+                        f = obj.get_mt_field(k, many_to_one=True)
+                    except MTOError:
+                        # JSONField ???
+                        f = obj.get_mt_field(k)
+                        if not isinstance(f, models.JSONField):
+                            raise MTOError('Cannot set field "{}" to dict value'.format(k))
+                elif isinstance(v, list):
+                    f = obj.get_mt_field(k, many_to_many=True)
+                else:
+                    f = obj.get_mt_field(k)
+                fields[k] = f
+            f = fields[k]
+            if f.many_to_one:
+                if not isinstance(v, dict):
+                    raise MTOError('Cannot set field "{}" to {} value'.format(k, type(v).__name__))
+                children.append((f.related_model, v))
+            elif f.many_to_many:
+                if not isinstance(v, list):
+                    raise MTOError('Cannot set field "{}" to {} value'.format(k, type(v).__name__))
+                children.extend((f.related_model, sv) for sv in v)
+        model_nodes[mt_hash] = tree
+        if self._has_custom_save(model):
+            # committed with the regular path
+            return
+        for child_model, child_tree in children:
+            self._collect_bulk_commit_nodes(child_model, child_tree, nodes, model_fields)
+
+    def _get_bulk_commit_height(self, model, tree, pks, model_fields, heights):
+        key = (model, tree['mt_hash'])
+        if key in pks:
+            return -1
+        try:
+            return heights[key]
+        except KeyError:
+            pass
+        height = 0
+        if not self._has_custom_save(model):
+            for k, v in tree.items():
+                if k == 'mt_hash':
+                    continue
+                f = model_fields[model][k]
+                if f.many_to_one:
+                    child_trees = [v]
+                elif f.many_to_many:
+                    child_trees = v
+                else:
+                    continue
+                for child_tree in child_trees:
+                    height = max(height,
+                                 self._get_bulk_commit_height(f.related_model, child_tree,
+                                                              pks, model_fields, heights) + 1)
+        heights[key] = height
+        return height
+
+    @staticmethod
+    def _build_bulk_commit_obj(model, tree, pks, model_fields):
+        obj = model(mt_hash=tree['mt_hash'])
+        m2m_fields = []
+        related_fields = []
+        for k, v in tree.items():
+            if k == 'mt_hash':
+                continue
+            f = model_fields[model][k]
+            if f.many_to_one:
+                setattr(obj, f.attname, pks[(f.related_model, v['mt_hash'])])
+                related_fields.append(k)
+            elif f.many_to_many:
+                m2m_fields.append((f, [pks[(f.related_model, sv['mt_hash'])] for sv in v]))
+                related_fields.append(k)
+            elif isinstance(f, models.JSONField):
+                t = copy.deepcopy(v)
+                cleanup_commit_tree(t)
+                setattr(obj, k, t)
+            else:
+                setattr(obj, k, v)
+        # same verification as the regular commit,
+        # with the related object hashes taken from the tree to avoid the queries
+        h = Hasher()
+        for f in obj._meta.get_fields():
+            if f.name in obj.mt_excluded_field_set or f.auto_created:
+                continue
+            if f.many_to_one:
+                v = tree.get(f.name, {}).get('mt_hash')
+            elif f.many_to_many:
+                v = [sv['mt_hash'] for sv in tree.get(f.name, [])]
+            else:
+                v = getattr(obj, f.name)
+                if isinstance(f, models.JSONField) and v:
+                    t = copy.deepcopy(v)
+                    prepare_commit_tree(t)
+                    v = t['mt_hash']
+            h.add_field(f.name, v)
+        if not h.hexdigest() == obj.mt_hash:
+            raise MTOError('Obj {} Hash missmatch!!!'.format(obj))
+        obj.full_clean(exclude=related_fields, validate_unique=False, validate_constraints=False)
+        return obj, m2m_fields
+
+    def bulk_commit(self, tree):
+        """
+        Commit a tree with a constant number of queries per model.
+
+        The existing objects are resolved with one mt_hash IN query per model,
+        and only the missing objects are created, bottom-up, with bulk inserts
+        ignoring the conflicts with concurrent commits.
+        """
+        prepare_commit_tree(tree)
+        mt_hash = tree['mt_hash']
+        # fast path: the whole tree is already committed
+        obj = self.filter(mt_hash=mt_hash).first()
+        if obj:
+            return obj, False
+        # collect all the nodes, and validate the fields
+        nodes = {}
+        model_fields = {}
+        self._collect_bulk_commit_nodes(self.model, tree, nodes, model_fields)
+        # resolve the existing objects
+        pks = {}
+        for model, model_nodes in nodes.items():
+            for node_mt_hash, pk in model.objects.filter(mt_hash__in=model_nodes.keys()).values_list("mt_hash", "pk"):
+                pks[(model, node_mt_hash)] = pk
+        # sort the missing objects by height, to create them bottom-up
+        heights = {}
+        levels = {}
+        for model, model_nodes in nodes.items():
+            for node_tree in model_nodes.values():
+                height = self._get_bulk_commit_height(model, node_tree, pks, model_fields, heights)
+                if height >= 0:
+                    levels.setdefault(height, {}).setdefault(model, []).append(node_tree)
+        with transaction.atomic():
+            for height in sorted(levels):
+                for model, node_trees in levels[height].items():
+                    if self._has_custom_save(model):
+                        for node_tree in node_trees:
+                            node_obj, _ = model.objects.commit(node_tree)
+                            pks[(model, node_obj.mt_hash)] = node_obj.pk
+                        continue
+                    objs = []
+                    m2m_values = []
+                    for node_tree in sorted(node_trees, key=lambda t: t['mt_hash']):
+                        node_obj, node_m2m_fields = self._build_bulk_commit_obj(model, node_tree, pks, model_fields)
+                        objs.append(node_obj)
+                        m2m_values.append((node_obj.mt_hash, node_m2m_fields))
+                    model.objects.bulk_create(objs, ignore_conflicts=True)
+                    for node_mt_hash, pk in (model.objects.filter(mt_hash__in=[o.mt_hash for o in objs])
+                                                          .values_list("mt_hash", "pk")):
+                        pks[(model, node_mt_hash)] = pk
+                    through_objs = {}
+                    for node_mt_hash, node_m2m_fields in m2m_values:
+                        pk = pks[(model, node_mt_hash)]
+                        for f, related_pks in node_m2m_fields:
+                            through = f.remote_field.through
+                            through_objs.setdefault(through, []).extend(
+                                through(**{f"{f.m2m_field_name()}_id": pk,
+                                           f"{f.m2m_reverse_field_name()}_id": related_pk})
+                                for related_pk in related_pks
+                            )
+                    for through, objs in through_objs.items():
+                        through.objects.bulk_create(objs, ignore_conflicts=True)
+        return self.get(mt_hash=mt_hash), True
+
 
 class AbstractMTObject(models.Model):
     mt_hash = models.CharField(max_length=40, unique=True)
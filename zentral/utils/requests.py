@@ -3,14 +3,16 @@ from requests.packages.urllib3.util import Retry
 
 
 class CustomHTTPAdapter(HTTPAdapter):
-    def __init__(self, default_timeout, retries):
+    def __init__(self, default_timeout, retries, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, **kwargs):
         self.default_timeout = default_timeout
         super().__init__(
             max_retries=Retry(
                 total=retries + 1,
                 backoff_factor=1,
-                status_forcelist=[429, 500, 502, 503, 504]
-            )
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=allowed_methods,
+            ),
+            **kwargs
         )
 
     def send(self, *args, **kwargs):